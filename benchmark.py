@@ -0,0 +1,471 @@
+"""Offline benchmarks of the download pipeline
+
+    python benchmark.py -o results.json
+    python benchmark.py --only throughput,history --rows 10000,100000
+    python benchmark.py --quick -o new.json --compare old.json
+
+Downloads come from a RangeServer on localhost serving generated files, and StubExtractor
+hands yt-dlp info dicts that point at them, so nothing goes to the network. The suites:
+- throughput: end-to-end downloads through DownloadManager at several concurrency levels
+- extraction: yt-dlp format processing, FormatPolicy.select and the metadata cache per video
+- progress: cost of one DownloadJob.progress_hook call
+- history: DatabaseManager inserts and queries with 10k to 1M rows, and the GUI's
+  load_history refresh (when PyQt5 is installed)
+The results file records the environment and every measurement; --compare prints the
+change of each number against an earlier results file.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+
+import yt_dlp
+
+from downloader_core import (DatabaseManager, MetadataCache, DownloadManager, DownloadJob, BandwidthScheduler,
+                             FormatPolicy, ProgressThrottle, get_video_id, parse_rate)
+from downloader_backends import DownloadBackend, create_backend
+from range_server import RangeServer
+
+MB = 1024 * 1024
+# Where the suites write their summaries; main() sends everything else on stdout to devnull
+summary_stream = sys.stdout
+WORDS = ('lofi', 'piano', 'live', 'tutorial', 'python', 'music', 'review', 'trailer', 'news', 'podcast',
+         'guitar', 'jazz', 'cooking', 'travel', 'gaming', 'study', 'rain', 'remix', 'official', 'video')
+
+
+def summary(text):
+    """Show a suite's result as soon as it is measured"""
+    summary_stream.write(text + '\n')
+    summary_stream.flush()
+
+
+def video_id_for(index):
+    """An 11 character YouTube-style video ID for a benchmark item"""
+    return f"bench{index:06d}"
+
+
+def measure(function, repeat=5):
+    """Mean and minimum wall time of function() in milliseconds"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    return {'mean_ms': round(sum(times) / len(times), 3), 'min_ms': round(min(times), 3)}
+
+
+class StubExtractor(DownloadBackend):
+    """Wraps a backend so that jobs 'extract' prepared info dicts instead of going to YouTube"""
+
+    def __init__(self, backend, catalog, delay=0.0):
+        self.backend = backend
+        self.name = backend.name
+        # video_id -> info dict
+        self.catalog = catalog
+        self.delay = delay
+
+    def configure(self, options):
+        return self.backend.configure(options)
+
+    def create_ydl(self, options, throttle=None):
+        ydl = self.backend.create_ydl(options, throttle)
+        ydl.extract_info = self.extract_info
+        return ydl
+
+    def extract_info(self, url, download=False, process=False, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        # yt-dlp adds to the info dict while processing it
+        return copy.deepcopy(self.catalog[get_video_id(url)])
+
+
+def media_info(video_id, title, url, size, duration=60):
+    """Info dict of a video with one progressive MP4 format, which needs no ffmpeg"""
+    return {
+        'id': video_id,
+        'title': title,
+        'duration': duration,
+        'uploader': "Benchmark",
+        'extractor': 'benchmark',
+        'extractor_key': 'Benchmark',
+        'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+        'formats': [{
+            'format_id': '18',
+            'url': url,
+            'ext': 'mp4',
+            'protocol': 'http',
+            'vcodec': 'avc1.42001E',
+            'acodec': 'mp4a.40.2',
+            'width': 640,
+            'height': 360,
+            'filesize': size,
+            'tbr': size * 8 / 1000 / duration
+        }]
+    }
+
+
+def youtube_formats(duration=600):
+    """A format list shaped like YouTube's: DASH video in three codecs, DASH audio and one muxed format"""
+    formats = []
+    for height, kbps in ((144, 100), (240, 250), (360, 600), (480, 1100), (720, 2500), (1080, 4500),
+                         (1440, 9000), (2160, 18000)):
+        for codec, factor in (('avc1.640028', 1.0), ('vp9', 0.7), ('av01.0.08M.08', 0.6)):
+            formats.append({
+                'format_id': f"{codec.split('.')[0]}-{height}", 'url': f"http://127.0.0.1:9/{codec}/{height}",
+                'ext': 'mp4' if codec.startswith('avc1') else 'webm', 'protocol': 'https',
+                'vcodec': codec, 'acodec': 'none', 'height': height, 'width': height * 16 // 9, 'fps': 30,
+                'tbr': kbps * factor, 'filesize': int(kbps * factor * 125 * duration)
+            })
+    for codec, kbps in (('mp4a.40.5', 48), ('mp4a.40.2', 129), ('opus', 50), ('opus', 70), ('opus', 135)):
+        formats.append({
+            'format_id': f"{codec}-{kbps}", 'url': f"http://127.0.0.1:9/{codec}/{kbps}",
+            'ext': 'm4a' if codec.startswith('mp4a') else 'webm', 'protocol': 'https',
+            'vcodec': 'none', 'acodec': codec, 'abr': kbps, 'tbr': kbps, 'filesize': kbps * 125 * duration
+        })
+    formats.append({
+        'format_id': '18', 'url': "http://127.0.0.1:9/18", 'ext': 'mp4', 'protocol': 'https',
+        'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'height': 360, 'width': 640, 'tbr': 500
+    })
+    return formats
+
+
+def bench_throughput(args):
+    """Download args.files generated files through DownloadManager at each concurrency level"""
+    results = {}
+    with tempfile.TemporaryDirectory() as media_dir, tempfile.TemporaryDirectory() as output_dir:
+        catalog = {}
+        server = RangeServer(media_dir, rate=args.server_rate).start()
+        try:
+            for index in range(args.files):
+                name = f"media{index}.mp4"
+                with open(os.path.join(media_dir, name), 'wb') as f:
+                    f.write(os.urandom(args.file_size))
+                video_id = video_id_for(index)
+                catalog[video_id] = media_info(video_id, f"Benchmark {index}", server.url_for(name), args.file_size)
+
+            for concurrency in args.concurrency:
+                for name in os.listdir(output_dir):
+                    os.remove(os.path.join(output_dir, name))
+                backend = StubExtractor(create_backend(args.downloader, args.connections), catalog,
+                                        args.extract_delay)
+                manager = DownloadManager(max_concurrent=concurrency, per_host_limit=concurrency,
+                                          backend=backend, post_processing_workers=0, prefetch=args.prefetch)
+                started = time.perf_counter()
+                for video_id in catalog:
+                    manager.submit(f"https://www.youtube.com/watch?v={video_id}", output_dir)
+                manager.wait()
+                elapsed = time.perf_counter() - started
+                manager.shutdown()
+
+                jobs = list(manager.jobs.values())
+                completed = sum(1 for job in jobs if job.status == 'completed')
+                phases = {}
+                for job in jobs:
+                    for phase, seconds in job.trace.phases.items():
+                        phases.setdefault(phase, []).append(seconds)
+                results[f"concurrency_{concurrency}"] = {
+                    'seconds': round(elapsed, 3),
+                    'mb_per_s': round(completed * args.file_size / MB / elapsed, 2),
+                    'failed': len(jobs) - completed,
+                    'phase_mean_ms': {phase: round(sum(values) / len(values) * 1000, 3)
+                                      for phase, values in phases.items()}
+                }
+                summary(f"throughput: {concurrency} parallel: {results[f'concurrency_{concurrency}']['mb_per_s']} MB/s")
+        finally:
+            server.stop()
+    return results
+
+
+def bench_extraction(args):
+    """Per-video cost of what happens between extraction and the first byte"""
+    info = {
+        'id': video_id_for(0), 'title': "Benchmark", 'duration': 600, 'extractor': 'benchmark',
+        'extractor_key': 'Benchmark', 'webpage_url': f"https://www.youtube.com/watch?v={video_id_for(0)}",
+        'formats': youtube_formats()
+    }
+    policy = FormatPolicy()
+    ydl = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'simulate': True, 'format': 'bv*+ba/b'})
+    results = {
+        'formats': len(info['formats']),
+        'format_policy_select': measure(lambda: policy.select(info['formats'], 'best', info['duration']),
+                                        args.repeat * 20),
+        'ytdlp_process_info': measure(lambda: ydl.process_ie_result(copy.deepcopy(info), download=False),
+                                      args.repeat * 4)
+    }
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = MetadataCache(os.path.join(cache_dir, "metadata_cache.db"))
+        results['metadata_cache_put'] = measure(lambda: cache.put(info['id'], info), args.repeat * 4)
+        results['metadata_cache_get'] = measure(lambda: cache.get(info['id']), args.repeat * 4)
+    summary(f"extraction: yt-dlp processing {results['ytdlp_process_info']['mean_ms']} ms, "
+            f"FormatPolicy {results['format_policy_select']['mean_ms']} ms")
+    return results
+
+
+def bench_progress(args):
+    """Microseconds per progress_hook call, as yt-dlp calls it for every block it reads"""
+    results = {}
+    for name, limit in (('unlimited', None), ('scheduled', 1e12)):
+        bandwidth = BandwidthScheduler(limit)
+        job = DownloadJob(1, f"https://www.youtube.com/watch?v={video_id_for(0)}", tempfile.gettempdir(),
+                          bandwidth=bandwidth)
+        throttle = ProgressThrottle(lambda percent, speed, title, status: None, 4.0)
+        job.progress_callback = lambda percent, speed, title, status, final: throttle.update(
+            percent, speed, title, status, force=final)
+        bandwidth.add_job(job.job_id, job.priority, job.rate_limit)
+        block = 16 * 1024
+        total = block * args.hook_calls
+        started = time.perf_counter()
+        for index in range(args.hook_calls):
+            job.progress_hook({'status': 'downloading', 'filename': 'benchmark.mp4', 'downloaded_bytes': index * block,
+                               'total_bytes': total, 'speed': 10 * MB, 'info_dict': {}})
+        elapsed = time.perf_counter() - started
+        results[name] = {'calls': args.hook_calls, 'us_per_call': round(elapsed / args.hook_calls * 1e6, 3)}
+        summary(f"progress: {name} {results[name]['us_per_call']} us per progress_hook call")
+    return results
+
+
+def seed_history(db_manager, count, start=0):
+    """Insert count synthetic history rows in one transaction; returns the rows per second"""
+    random.seed(count)
+    base = datetime(2020, 1, 1)
+    rows = []
+    for index in range(start, start + count):
+        video_id = f"{index:011d}"
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        title = ' '.join(random.sample(WORDS, 4)) + f" {index}"
+        rows.append((title, url, f"Channel {index % 500}", "3:45", "1,234", random.choice(('best', '720p', 'audio_only')),
+                     f"/downloads/{title}.mp4", (base + timedelta(minutes=index)).strftime('%Y-%m-%d %H:%M:%S'),
+                     'failed' if index % 20 == 0 else 'completed', video_id))
+    started = time.perf_counter()
+    with db_manager.lock, db_manager.conn:
+        db_manager.conn.executemany('''
+            INSERT INTO download_history
+            (title, url, uploader, duration, view_count, quality, output_path, download_date, status, video_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    return count / (time.perf_counter() - started)
+
+
+def bench_history(args):
+    """History database inserts and queries, and the GUI refresh, at each table size"""
+    results = {}
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_manager = DatabaseManager(os.path.join(db_dir, "download_history.db"))
+            seed_rate = seed_history(db_manager, rows - args.inserts)
+
+            def insert(start, count):
+                for index in range(start, start + count):
+                    db_manager.save_download(f"Inserted {index}", f"https://www.youtube.com/watch?v={index:011d}",
+                                             "Benchmark", "1:00", "0", "best", f"/downloads/{index}.mp4")
+
+            # One writer waits for each commit; concurrent writers share the writer thread's batches
+            half = args.inserts // 2
+            started = time.perf_counter()
+            insert(rows - args.inserts, half)
+            sequential = half / (time.perf_counter() - started)
+            writers = [threading.Thread(target=insert, args=(rows - args.inserts + half + index * (half // 8), half // 8))
+                       for index in range(8)]
+            started = time.perf_counter()
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+            concurrent = (half // 8) * 8 / (time.perf_counter() - started)
+            db_manager.flush()
+
+            middle = db_manager.query('SELECT download_date, id FROM download_history ORDER BY download_date DESC, id '
+                                      'DESC LIMIT 1 OFFSET ?', (rows // 2,))[0]
+            some_id = f"{rows // 3:011d}"
+            result = {
+                'seed_rows_per_s': round(seed_rate),
+                'insert_rows_per_s': round(sequential),
+                'insert_rows_per_s_8_threads': round(concurrent),
+                'first_page': measure(lambda: db_manager.get_history_page(None, 200), args.repeat),
+                'middle_page': measure(lambda: db_manager.get_history_page(tuple(middle), 200), args.repeat),
+                'count': measure(lambda: db_manager.count_history(), args.repeat),
+                'search': measure(lambda: db_manager.get_history_page(None, 200, {'search': 'lofi piano'}),
+                                  args.repeat),
+                'search_count': measure(lambda: db_manager.count_history({'search': 'lofi piano'}), args.repeat),
+                'status_filter': measure(lambda: db_manager.get_history_page(None, 200, {'status': 'failed'}),
+                                         args.repeat),
+                'downloaded_video_ids': measure(db_manager.get_downloaded_video_ids, args.repeat),
+                'find_downloads': measure(lambda: db_manager.find_downloads(some_id), args.repeat)
+            }
+            result['gui_load_history'] = bench_gui_refresh(db_manager, args)
+            results[f"rows_{rows}"] = result
+            summary(f"history: {rows} rows: first page {result['first_page']['mean_ms']} ms, "
+                    f"search {result['search']['mean_ms']} ms, {result['insert_rows_per_s']} inserts/s")
+    return results
+
+
+def bench_gui_refresh(db_manager, args):
+    """What load_history costs: HistoryModel.reload() plus rendering the text of the first page"""
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication
+        from PyQt5.QtCore import Qt
+    except ImportError:
+        return {'skipped': "PyQt5 is not installed"}
+    import importlib.util
+    app = QApplication.instance() or QApplication([])
+    spec = importlib.util.spec_from_file_location(
+        'youtube_downloader', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'youtube-downloader.py'))
+    gui = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gui)
+    model = gui.HistoryModel(db_manager, None)
+
+    def render():
+        for row in range(model.rowCount()):
+            for column in range(model.columnCount()):
+                model.data(model.index(row, column), Qt.DisplayRole)
+
+    def scroll():
+        model.reload()
+        for _ in range(10):
+            model.fetchMore()
+
+    result = {
+        'reload': measure(model.reload, args.repeat),
+        'reload_and_render': measure(lambda: (model.reload(), render()), args.repeat),
+        'scroll_10_pages': measure(scroll, args.repeat)
+    }
+    app.processEvents()
+    return result
+
+
+SUITES = {
+    'throughput': bench_throughput,
+    'extraction': bench_extraction,
+    'progress': bench_progress,
+    'history': bench_history
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only"""
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(baseline, current, out=sys.stdout):
+    """Print each measurement of current next to the baseline's"""
+    old = flatten(baseline.get('results', {}))
+    new = flatten(current.get('results', {}))
+    out.write(f"Compared with {baseline.get('version') or 'baseline'} ({baseline.get('time')}):\n")
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            out.write(f"  {key}: {old[key]} -> {new[key]} ({change:+.1f}%)\n")
+        else:
+            out.write(f"  {key}: {new[key]} (new)\n")
+
+
+def size(text):
+    """A count or size such as 16M; unlike a rate it can't be unlimited"""
+    value = parse_rate(text)
+    if value is None:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+    return value
+
+
+def comma_list(text):
+    return [size(part) for part in text.split(',') if part.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline offline")
+    parser.add_argument('-o', '--output', default="benchmark_results.json", help="results file to write")
+    parser.add_argument('--only', help=f"comma separated suites to run, from {','.join(SUITES)}")
+    parser.add_argument('--compare', metavar='RESULTS', help="print the change against an earlier results file")
+    parser.add_argument('--quick', action='store_true', help="small sizes, for a smoke test")
+    parser.add_argument('--files', type=int, default=16, help="files downloaded at each concurrency level")
+    parser.add_argument('--file-size', type=size, default=16 * MB, help="size of each file, e.g. 16M")
+    parser.add_argument('--concurrency', type=comma_list, default=[1, 2, 4, 8], help="parallel downloads, e.g. 1,4,8")
+    parser.add_argument('--server-rate', type=parse_rate, help="per-connection rate of the media server, e.g. 4M")
+    parser.add_argument('--downloader', default='yt-dlp', help="download backend, as in downloader_cli.py")
+    parser.add_argument('--connections', type=int, default=8, help="connections per file for segmented")
+    parser.add_argument('--extract-delay', type=float, default=0.0, metavar='SECONDS',
+                        help="simulated extract_info latency of each video")
+    parser.add_argument('--prefetch', type=int, default=2, help="queued videos extracted ahead, 0 disables it")
+    parser.add_argument('--rows', type=comma_list, default=[10000, 100000, 1000000],
+                        help="history table sizes, e.g. 10k,100k,1M")
+    parser.add_argument('--inserts', type=int, default=2000, help="rows inserted one by one at each size")
+    parser.add_argument('--hook-calls', type=int, default=100000, help="progress_hook calls")
+    parser.add_argument('--repeat', type=int, default=5, help="repetitions of each query")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.files, args.file_size, args.concurrency = 4, 2 * MB, [1, 4]
+        args.rows, args.inserts, args.hook_calls, args.repeat = [10000], 400, 10000, 3
+    suites = [name.strip() for name in args.only.split(',')] if args.only else list(SUITES)
+    unknown = [name for name in suites if name not in SUITES]
+    if unknown:
+        parser.error(f"unknown suite {unknown[0]}")
+
+    report = {
+        'version': git_revision(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'yt_dlp': yt_dlp.version.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'only')},
+        'results': {}
+    }
+    # The engine's diagnostics would drown the results
+    global summary_stream
+    stdout = summary_stream = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    failed = []
+    try:
+        for name in suites:
+            stdout.write(f"Running {name}...\n")
+            stdout.flush()
+            try:
+                report['results'][name] = SUITES[name](args)
+            except Exception as e:
+                # A broken suite is recorded and the others still run
+                import traceback
+                traceback.print_exc(file=sys.stderr)
+                failed.append(name)
+                report['results'][name] = {'failed': f"{type(e).__name__}: {e}"}
+            stdout.write(json.dumps(report['results'][name], indent=2) + '\n')
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+    if failed:
+        print(f"Failed suites: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,559 @@
+"""Optional local HTTP/JSON API for submitting and monitoring downloads
+
+Endpoints:
+    POST   /jobs               {"url": ..., "quality": "720p", "playlist": false} -> queue a download
+    GET    /jobs               status of all jobs
+    GET    /jobs/<id>          status of one job
+    GET    /jobs/<id>/events   Server-Sent Events stream of status changes until the job ends
+    PATCH  /jobs/<id>          {"priority": "high", "rate_limit": "1M"} -> change a job's bandwidth settings
+    DELETE /jobs/<id>          cancel a job
+    GET    /bandwidth          global limit, time-of-day profiles and the current rate of each running job
+    PUT    /bandwidth          {"limit": "2M", "profiles": "23:00-07:00=unlimited"} -> change the limits live
+    GET    /history?limit=50   rows of the download history, newest first; filter with
+                               q (full-text), status, quality, from and to (UTC 'YYYY-MM-DD HH:MM:SS')
+    GET    /formats?url=...    formats a download would use and their predicted size; optional quality
+    GET    /qualities          accepted quality keys
+    GET    /metrics            counters, histograms and phase timings in the Prometheus text format
+
+Request bodies must be sent as Content-Type: application/json, which browsers can't do
+cross-origin without asking first. A server started with a token answers only requests
+with an "Authorization: Bearer <token>" header. output_dir is a directory inside the
+server's save directory.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from downloader_core import (DatabaseManager, MetadataCache, ThumbnailCache, DownloadManager, JobJournal,
+                             DuplicateFinder, BandwidthScheduler, FormatPolicy, RetryPolicy, FORMAT_MAPPING,
+                             FINAL_STATES, AUDIO_FORMATS, PRIORITIES, VIDEO_CODECS, AUDIO_CODECS, clean_youtube_url, parse_item_range, parse_rate,
+                             parse_bandwidth_profiles, parse_video_codecs, parse_audio_codecs, preview_formats)
+from downloader_backends import create_backend
+from downloader_metrics import REGISTRY
+
+
+class JobStatusBoard:
+    """Keeps a snapshot of every job's status so API readers never touch the download workers
+
+    Like the manager's jobs, only the last keep_finished finished jobs are kept.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.snapshots = {}
+        # Ids of finished jobs, oldest first
+        self.finished = deque()
+        self.version = 0
+        self.changed = threading.Condition()
+        manager.add_listener(self.on_event)
+
+    def on_event(self, event, job_id, data):
+        if job_id is None:
+            return
+        with self.changed:
+            snapshot = self.snapshots.get(job_id)
+            if snapshot is None:
+                # A cancelled job's thread may report progress after it was finished and dropped
+                job = self.manager.jobs.get(job_id)
+                if job is None or job.status in FINAL_STATES:
+                    return
+                snapshot = {
+                    'job_id': job_id,
+                    'url': job.url,
+                    'quality': job.quality,
+                    'state': 'queued',
+                    'title': '',
+                    'format': None,
+                    'predicted_size': None,
+                    'percent': 0.0,
+                    'speed': None,
+                    'downloaded_bytes': None,
+                    'total_bytes': None,
+                    'eta': None,
+                    'message': '',
+                    'attempt': 0,
+                    'error': None,
+                    'retry_at': None,
+                    'output_path': ''
+                }
+                self.snapshots[job_id] = snapshot
+            elif snapshot['state'] in FINAL_STATES:
+                return
+            if event == 'started':
+                snapshot['state'] = 'downloading'
+            elif event == 'postprocessing':
+                snapshot['state'] = 'postprocessing'
+            elif event == 'retrying':
+                snapshot.update({
+                    'state': 'retrying',
+                    'message': data['message'],
+                    'attempt': data['attempt'],
+                    'retry_at': time.time() + data['delay'],
+                    'error': data['error']
+                })
+            elif event == 'format_selected':
+                snapshot['format'] = f"{data['format_id']} {data['description']}"
+                snapshot['predicted_size'] = data['size']
+            elif event == 'progress':
+                status = data['status']
+                snapshot.update({
+                    'title': data['title'],
+                    'percent': round(data['percent'], 2),
+                    'speed': status.get('speed'),
+                    'downloaded_bytes': status.get('downloaded_bytes'),
+                    'total_bytes': status.get('total_bytes'),
+                    'eta': status.get('eta')
+                })
+            elif event == 'finished':
+                job = data['job']
+                snapshot.update({
+                    'state': job.status,
+                    'title': data['title'],
+                    'message': data['message'],
+                    'output_path': job.output_path
+                })
+                if data['success']:
+                    snapshot['percent'] = 100.0
+                self.finished.append(job_id)
+                while len(self.finished) > self.manager.keep_finished:
+                    self.snapshots.pop(self.finished.popleft(), None)
+            else:
+                return
+            snapshot['updated'] = time.time()
+            self.version += 1
+            self.changed.notify_all()
+
+    def get(self, job_id):
+        with self.changed:
+            snapshot = self.snapshots.get(job_id)
+            return dict(snapshot) if snapshot else None
+
+    def get_all(self):
+        with self.changed:
+            return [dict(snapshot) for snapshot in self.snapshots.values()]
+
+    def wait_for_change(self, version, timeout):
+        """Block until the board changes after `version`; returns the new version"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    server_version = "YouTubeDownloaderAPI/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json({'error': message}, status)
+
+    def authorized(self):
+        """Check the bearer token of a server started with one; otherwise answers 401 and returns False"""
+        token = self.server.token
+        if not token:
+            return True
+        given = self.headers.get('Authorization', '').encode('utf-8')
+        if hmac.compare_digest(given, f"Bearer {token}".encode('utf-8')):
+            return True
+        # The body wasn't read, so the connection can't be reused
+        self.close_connection = True
+        self.send_json({'error': "Missing or wrong API token"}, 401, {'WWW-Authenticate': 'Bearer'})
+        return False
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def read_request(self):
+        """Read a JSON object body; answers 415 or 400 and returns None if it isn't one"""
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.close_connection = True
+            self.send_error_json(415, "Content-Type must be application/json")
+            return None
+        try:
+            request = self.read_json()
+        except ValueError:
+            self.send_error_json(400, "Invalid JSON body")
+            return None
+        if not isinstance(request, dict):
+            self.send_error_json(400, "The JSON body must be an object")
+            return None
+        return request
+
+    def resolve_output_dir(self, output_dir):
+        """Return output_dir inside the server's save directory, or None if it leads outside of it"""
+        root = os.path.realpath(self.server.output_dir)
+        path = os.path.realpath(os.path.join(root, output_dir or ''))
+        try:
+            return path if os.path.commonpath([root, path]) == root else None
+        except ValueError:
+            # Another drive
+            return None
+
+    def route(self):
+        """Split the request path into its parts and query parameters"""
+        parsed = urlparse(self.path)
+        parts = [part for part in parsed.path.split('/') if part]
+        return parts, parse_qs(parsed.query)
+
+    def parse_job_id(self, text):
+        try:
+            return int(text)
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        board = self.server.board
+        if parts == ['jobs']:
+            self.send_json(board.get_all())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            snapshot = board.get(self.parse_job_id(parts[1]))
+            if snapshot is None:
+                self.send_error_json(404, "Unknown job")
+            else:
+                self.send_json(snapshot)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            self.stream_events(self.parse_job_id(parts[1]))
+        elif parts == ['history']:
+            try:
+                limit = max(1, min(int(query.get('limit', ['50'])[0]), 1000))
+            except ValueError:
+                self.send_error_json(400, "limit must be a number")
+                return
+            columns = ('id', 'title', 'url', 'uploader', 'duration', 'view_count', 'quality',
+                       'output_path', 'download_date', 'status')
+            filters = {
+                'search': query.get('q', [''])[0],
+                'status': query.get('status', [''])[0],
+                'quality': query.get('quality', [''])[0],
+                'date_from': query.get('from', [''])[0],
+                'date_to': query.get('to', [''])[0]
+            }
+            rows = self.server.db_manager.get_history_page(None, limit, filters)
+            self.send_json([dict(zip(columns, row)) for row in rows])
+        elif parts == ['formats']:
+            url = query.get('url', [''])[0]
+            quality = query.get('quality', ['best'])[0]
+            if not url:
+                self.send_error_json(400, "url is required")
+            elif quality not in FORMAT_MAPPING:
+                self.send_error_json(400, f"quality must be one of {', '.join(FORMAT_MAPPING)}")
+            else:
+                manager = self.server.manager
+                try:
+                    self.send_json(preview_formats(clean_youtube_url(url), quality, manager.format_policy,
+                                                   manager.metadata_cache))
+                except Exception as e:
+                    self.send_error_json(502, str(e))
+        elif parts == ['qualities']:
+            self.send_json(list(FORMAT_MAPPING))
+        elif parts == ['metrics']:
+            self.send_text(REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif parts == ['bandwidth']:
+            self.send_json(self.server.manager.bandwidth.status())
+        else:
+            self.send_error_json(404, "Not found")
+
+    def read_bandwidth_settings(self, request):
+        """Validate the priority and rate_limit fields of a request body; returns the settings or None"""
+        settings = {}
+        if 'priority' in request:
+            if request['priority'] not in PRIORITIES:
+                self.send_error_json(400, f"priority must be one of {', '.join(PRIORITIES)}")
+                return None
+            settings['priority'] = request['priority']
+        if 'rate_limit' in request:
+            try:
+                settings['rate_limit'] = parse_rate(request['rate_limit'])
+            except ValueError:
+                self.send_error_json(400, "rate_limit must be a rate like 500K or 2M")
+                return None
+        return settings
+
+    def do_PATCH(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            self.send_error_json(404, "Not found")
+            return
+        job_id = self.parse_job_id(parts[1])
+        request = self.read_request()
+        if request is None:
+            return
+        settings = self.read_bandwidth_settings(request)
+        if settings is None:
+            return
+        job = self.server.manager.jobs.get(job_id)
+        if job is None or not self.server.manager.set_job_bandwidth(job_id, **settings):
+            self.send_error_json(404, "Unknown job")
+            return
+        self.send_json({'job_id': job_id, 'priority': job.priority, 'rate_limit': job.rate_limit})
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if parts != ['bandwidth']:
+            self.send_error_json(404, "Not found")
+            return
+        request = self.read_request()
+        if request is None:
+            return
+        bandwidth = self.server.manager.bandwidth
+        try:
+            limit = parse_rate(request['limit']) if 'limit' in request else bandwidth.limit
+            profiles = parse_bandwidth_profiles(request['profiles']) if 'profiles' in request else None
+        except ValueError as e:
+            self.send_error_json(400, str(e))
+            return
+        bandwidth.set_limit(limit)
+        if profiles is not None:
+            bandwidth.set_profiles(profiles)
+        self.send_json(bandwidth.status())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if parts != ['jobs']:
+            self.send_error_json(404, "Not found")
+            return
+        request = self.read_request()
+        if request is None:
+            return
+
+        url = request.get('url')
+        quality = request.get('quality', 'best')
+        if not isinstance(url, str) or not url.strip():
+            self.send_error_json(400, "url is required")
+            return
+        url = url.strip()
+        if quality not in FORMAT_MAPPING:
+            self.send_error_json(400, f"quality must be one of {', '.join(FORMAT_MAPPING)}")
+            return
+        output_dir = request.get('output_dir') or ''
+        if not isinstance(output_dir, str) or self.resolve_output_dir(output_dir) is None:
+            self.send_error_json(400, "output_dir must be a directory inside the save directory")
+            return
+        output_dir = self.resolve_output_dir(output_dir)
+        if not os.path.isdir(output_dir):
+            self.send_error_json(400, "output_dir is not a directory")
+            return
+        settings = self.read_bandwidth_settings(request)
+        if settings is None:
+            return
+
+        manager = self.server.manager
+        if request.get('playlist'):
+            item_range = parse_item_range(str(request.get('items', '')))
+            if item_range is None:
+                self.send_error_json(400, "items must be a range like 1-50, 10- or 5")
+                return
+            skip_ids = self.server.db_manager.get_downloaded_video_ids() if request.get('only_new') else None
+            # The priority and rate limit apply to every video of the playlist
+            manager.submit_playlist(url, output_dir, quality, item_range[0], item_range[1], skip_ids, **settings)
+            self.send_json({'playlist': url, 'state': 'expanding', **settings}, 202)
+        else:
+            job_id = manager.submit(clean_youtube_url(url), output_dir, quality,
+                                    priority=settings.pop('priority', 'normal'))
+            if settings:
+                manager.set_job_bandwidth(job_id, **settings)
+            self.send_json(self.server.board.get(job_id) or {'job_id': job_id}, 201)
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            self.send_error_json(404, "Not found")
+            return
+        job_id = self.parse_job_id(parts[1])
+        if self.server.board.get(job_id) is None:
+            self.send_error_json(404, "Unknown job")
+        elif self.server.manager.cancel(job_id):
+            # The job is finished at once; its thread stops and removes its files in the background
+            self.send_json({'job_id': job_id, 'state': 'cancelled'})
+        else:
+            self.send_error_json(409, "Job has already finished")
+
+    def stream_events(self, job_id):
+        """Send the job's status as Server-Sent Events whenever it changes"""
+        board = self.server.board
+        snapshot = board.get(job_id)
+        if snapshot is None:
+            self.send_error_json(404, "Unknown job")
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        version = None
+        last_sent = None
+        try:
+            while True:
+                snapshot = board.get(job_id)
+                if snapshot is None:
+                    # Dropped with the oldest finished jobs
+                    return
+                if snapshot != last_sent:
+                    self.wfile.write(f"data: {json.dumps(snapshot)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    last_sent = snapshot
+                if snapshot['state'] in FINAL_STATES:
+                    return
+                new_version = board.wait_for_change(version, timeout=15)
+                if new_version == version:
+                    # Keep idle connections alive through proxies
+                    self.wfile.write(b": keep-alive\n\n")
+                    self.wfile.flush()
+                version = new_version
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+class JobApiServer:
+    """Embedded HTTP server exposing a DownloadManager; runs on its own thread"""
+
+    def __init__(self, manager, db_manager, output_dir, host="127.0.0.1", port=8765, verbose=False, token=None):
+        self.board = JobStatusBoard(manager)
+        self.httpd = ThreadingHTTPServer((host, port), ApiRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.manager = manager
+        self.httpd.db_manager = db_manager
+        self.httpd.board = self.board
+        self.httpd.output_dir = output_dir
+        self.httpd.verbose = verbose
+        # Bearer token every request must carry; None accepts any local program
+        self.httpd.token = token
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print(f'[DEBUG] Job API listening on http://{self.address[0]}:{self.address[1]}')
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the download job API without the GUI")
+    parser.add_argument('--host', default="127.0.0.1", help="address to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on")
+    parser.add_argument('-o', '--output-dir', default=os.path.expanduser("~/Downloads"), help="default save directory")
+    parser.add_argument('-j', '--jobs', type=int, default=3, help="number of parallel downloads")
+    parser.add_argument('--per-host', type=int, default=2, help="parallel downloads allowed per host")
+    parser.add_argument('-N', '--fragments', type=int, default=4,
+                        help="DASH/HLS fragments fetched in parallel per download")
+    parser.add_argument('--pp-workers', type=int, metavar='N',
+                        help="processes for merging, MP3 conversion and thumbnail embedding (default: one per CPU "
+                             "core); 0 runs them in the download slot")
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help="queued videos whose info is extracted while others download; 0 disables it")
+    parser.add_argument('--downloader', default='yt-dlp',
+                        help="yt-dlp, segmented (multi-connection) or an external program such as aria2c")
+    parser.add_argument('--connections', type=int, default=8, help="connections per file for segmented and aria2c")
+    parser.add_argument('-r', '--limit-rate', type=parse_rate, metavar='RATE',
+                        help="total download rate shared by all downloads, e.g. 500K or 2M")
+    parser.add_argument('--job-limit', type=parse_rate, metavar='RATE', help="download rate limit of each download")
+    parser.add_argument('--bandwidth-schedule', type=parse_bandwidth_profiles, default=[], metavar='PROFILES',
+                        help="time-of-day rate limits replacing --limit-rate, e.g. '23:00-07:00=unlimited,09:00-17:00=1M'")
+    parser.add_argument('--max-filesize', type=parse_rate, metavar='SIZE',
+                        help="prefer formats whose predicted size fits, e.g. 200M")
+    parser.add_argument('--vcodec', type=parse_video_codecs, metavar='CODECS',
+                        help=f"preferred video codecs in order, from {','.join(VIDEO_CODECS)}")
+    parser.add_argument('--acodec', type=parse_audio_codecs, metavar='CODECS',
+                        help=f"preferred audio codecs in order, from {','.join(AUDIO_CODECS)}")
+    parser.add_argument('--target-bitrate', type=float, metavar='KBPS',
+                        help="prefer the formats closest to this total bitrate in kbit/s")
+    parser.add_argument('--no-transcode', action='store_true',
+                        help="prefer formats that need no merging, and AAC audio")
+    parser.add_argument('--audio-format', default='original', choices=AUDIO_FORMATS,
+                        help="audio_only output: the original Opus/AAC stream without re-encoding, or MP3")
+    parser.add_argument('--retries', type=int, default=5, metavar='N',
+                        help="retry failed downloads up to N times, depending on the error; 0 disables retries")
+    parser.add_argument('--db', default="download_history.db", help="history database path")
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="append phase timings and errors as JSON lines to PATH ('-' for stderr)")
+    parser.add_argument('--token', default=os.environ.get('DOWNLOADER_API_TOKEN'),
+                        help="require 'Authorization: Bearer TOKEN' on every request (default: $DOWNLOADER_API_TOKEN)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every request")
+    args = parser.parse_args(argv)
+
+    if args.log_json:
+        REGISTRY.log.open(args.log_json)
+    db_manager = DatabaseManager(args.db)
+    manager = DownloadManager(max_concurrent=max(1, args.jobs), per_host_limit=max(1, args.per_host),
+                              fragment_workers=max(1, args.fragments),
+                              metadata_cache=MetadataCache(), thumbnail_cache=ThumbnailCache(),
+                              duplicate_finder=DuplicateFinder(db_manager),
+                              backend=create_backend(args.downloader, max(1, args.connections)),
+                              bandwidth=BandwidthScheduler(args.limit_rate, args.bandwidth_schedule),
+                              job_rate_limit=args.job_limit, post_processing_workers=args.pp_workers,
+                              format_policy=FormatPolicy(args.max_filesize, args.vcodec, args.acodec,
+                                                         args.target_bitrate, args.no_transcode),
+                              audio_format=args.audio_format, retry_policy=RetryPolicy(max(0, args.retries)),
+                              prefetch=max(0, args.prefetch))
+    manager.add_listener(
+        lambda event, job_id, data: db_manager.save_job(data['job'], data['success'])
+        if event == 'finished' else None)
+    server = JobApiServer(manager, db_manager, args.output_dir, args.host, args.port, args.verbose, args.token)
+    journal = JobJournal(manager, db_manager)
+    journal.resume()
+    server.start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        # The downloads are interrupted, not cancelled, and resumed when the API starts again
+        manager.stop(preserve=True)
+        manager.join_cancelled(timeout=10)
+        server.stop()
+        manager.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,463 @@
+"""Download backends: how the streams chosen by yt-dlp are fetched
+
+DownloadBackend leaves everything to yt-dlp's own downloaders, ExternalBackend hands
+the downloads to an external program such as aria2c, and SegmentedBackend fetches large
+progressive HTTP formats over several connections with SegmentedDownloader.
+"""
+import os
+import json
+import time
+import queue
+import random
+import shutil
+import base64
+import socket
+import threading
+import http.client
+import urllib.request
+from urllib.parse import urlparse, urljoin, unquote
+
+import yt_dlp
+
+from downloader_metrics import REGISTRY
+
+
+class SegmentedDownloader:
+    """Downloads one URL over several connections with Range requests into a preallocated file
+
+    The file is split into chunks that a pool of connections fetches in parallel, each
+    writing at its own offset. Every worker keeps its connection alive from one chunk to
+    the next. Finished chunks are recorded in a .segments file next to the download so an
+    interrupted download continues where it stopped.
+
+    proxies is a yt-dlp proxy map ({'all': ..., 'https': ..., 'no': ...}); only http://
+    proxies are supported. cookiejar supplies the Cookie header of every request URL.
+    """
+    READ_SIZE = 64 * 1024
+    MAX_REDIRECTS = 5
+
+    def __init__(self, connections=8, chunk_size=8 * 1024 * 1024, timeout=30, retries=5):
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def proxy_for(url, proxies):
+        """Return the proxy URL to use for url, or None for a direct connection"""
+        if not proxies:
+            return None
+        parsed = urlparse(url)
+        if proxies.get('no') and urllib.request.proxy_bypass_environment(parsed.hostname or '',
+                                                                         {'no': proxies['no']}):
+            return None
+        proxy = proxies.get(parsed.scheme, proxies.get('all'))
+        if not proxy or proxy == '__noproxy__':
+            return None
+        return proxy if '://' in proxy else 'http://' + proxy.lstrip('/')
+
+    @staticmethod
+    def proxy_headers(proxy):
+        """Proxy-Authorization for credentials in the proxy URL"""
+        if not proxy.username:
+            return {}
+        credentials = f'{unquote(proxy.username)}:{unquote(proxy.password or "")}'.encode('utf-8')
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials).decode('ascii')}
+
+    def connect(self, parsed, proxy):
+        """Return a connection to the server of parsed, through proxy if there is one"""
+        if proxy is None:
+            connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+            return connection_class(parsed.netloc, timeout=self.timeout)
+        proxy = urlparse(proxy)
+        if proxy.scheme != 'http':
+            raise IOError(f"Unsupported proxy type {proxy.scheme}")
+        if parsed.scheme != 'https':
+            return http.client.HTTPConnection(proxy.hostname, proxy.port, timeout=self.timeout)
+        # HTTPS goes through a CONNECT tunnel
+        connection = http.client.HTTPSConnection(proxy.hostname, proxy.port, timeout=self.timeout)
+        connection.set_tunnel(parsed.hostname, parsed.port, headers=self.proxy_headers(proxy))
+        return connection
+
+    def request(self, connection, url, headers, proxies=None, cookiejar=None):
+        """GET url, reusing connection if it is for the same server and following redirects
+
+        Returns (connection, response, final url); the connection is (key, HTTPConnection).
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            proxy = self.proxy_for(url, proxies)
+            key = (parsed.scheme, parsed.netloc, proxy)
+            if connection is None or connection[0] != key:
+                if connection is not None:
+                    connection[1].close()
+                connection = (key, self.connect(parsed, proxy))
+            request_headers = dict(headers)
+            if proxy is not None and parsed.scheme != 'https':
+                # A plain HTTP proxy is sent the whole URL
+                target = url.split('#')[0]
+                request_headers.update(self.proxy_headers(urlparse(proxy)))
+            else:
+                target = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+            # Cookies are looked up again after a redirect to another host or path
+            cookie = cookiejar.get_cookie_header(url) if cookiejar is not None else None
+            if cookie:
+                request_headers['Cookie'] = cookie
+            try:
+                connection[1].request('GET', target, headers=request_headers)
+                response = connection[1].getresponse()
+            except (http.client.HTTPException, OSError):
+                connection[1].close()
+                raise
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urljoin(url, location)
+                continue
+            return connection, response, url
+        raise IOError(f"Too many redirects for {url}")
+
+    def probe(self, url, headers, proxies=None, cookiejar=None):
+        """Return (final url, size, accepts_ranges) using a one-byte range request"""
+        connection, response, url = self.request(None, url, {**headers, 'Range': 'bytes=0-0'}, proxies, cookiejar)
+        try:
+            if response.status >= 400:
+                raise IOError(f"HTTP {response.status} {response.reason}")
+            content_range = response.getheader('Content-Range') or ''
+            if response.status == 206 and '/' in content_range:
+                size = content_range.rsplit('/', 1)[1]
+                return url, (int(size) if size.isdigit() else None), size.isdigit()
+            length = response.getheader('Content-Length')
+            return url, (int(length) if length and length.isdigit() else None), False
+        finally:
+            connection[1].close()
+
+    def download(self, url, path, headers=None, progress=None, throttle=None, proxies=None, cookiejar=None):
+        """Download url to path and return its size
+
+        progress(downloaded_bytes, total_bytes) is called about four times a second from
+        the calling thread; an exception raised by it stops the download. throttle(size) is
+        called by the connection that read size bytes and may sleep to limit the rate.
+        """
+        headers = dict(headers or {})
+        url, size, ranged = self.probe(url, headers, proxies, cookiejar)
+        if not ranged or not size:
+            print(f'[DEBUG] {url} does not support range requests, using one connection')
+            return self.download_single(url, path, headers, progress, throttle, proxies, cookiejar)
+
+        state_path = path + '.segments'
+        done = self.load_state(state_path, path, size)
+        if not done:
+            self.preallocate(path, size)
+        pending = queue.Queue()
+        downloaded = 0
+        for start in range(0, size, self.chunk_size):
+            end = min(start + self.chunk_size, size) - 1
+            if start in done:
+                downloaded += end - start + 1
+            else:
+                pending.put((start, end))
+
+        state = {'downloaded': downloaded, 'done': done, 'errors': [], 'stopped': False, 'connections': set()}
+        workers = [
+            threading.Thread(target=self.fetch_chunks,
+                             args=(url, path, headers, pending, state, state_path, size, throttle, proxies,
+                                   cookiejar), daemon=True)
+            for _ in range(min(self.connections, pending.qsize()))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            while True:
+                alive = [worker for worker in workers if worker.is_alive()]
+                if not alive:
+                    break
+                alive[0].join(0.25)
+                if progress:
+                    progress(state['downloaded'], size)
+        except BaseException:
+            # e.g. progress() raising for a cancelled job
+            state['stopped'] = True
+            self.abort(state)
+            for worker in workers:
+                worker.join()
+            raise
+        if state['errors']:
+            raise state['errors'][0]
+        if progress:
+            progress(size, size)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return size
+
+    def abort(self, state):
+        """Interrupt the reads of a stopped download instead of waiting for data or the timeout"""
+        with self.lock:
+            connections = list(state['connections'])
+        for connection in connections:
+            sock = connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def fetch_chunks(self, url, path, headers, pending, state, state_path, size, throttle, proxies=None,
+                     cookiejar=None):
+        connection = None
+        try:
+            # Each worker has its own file handle so seeks don't interfere
+            with open(path, 'r+b') as f:
+                while not state['stopped']:
+                    try:
+                        start, end = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        connection = self.fetch_chunk(connection, url, f, headers, start, end, state, throttle,
+                                                      proxies, cookiejar)
+                    except Exception as e:
+                        state['errors'].append(e)
+                        state['stopped'] = True
+                        return
+                    if state['stopped']:
+                        return
+                    with self.lock:
+                        state['done'].add(start)
+                        self.save_state(state_path, size, state['done'])
+        finally:
+            if connection is not None:
+                connection[1].close()
+                with self.lock:
+                    state['connections'].discard(connection[1])
+
+    def fetch_chunk(self, connection, url, f, headers, start, end, state, throttle=None, proxies=None,
+                    cookiejar=None):
+        """Fetch bytes start..end into f, resuming from the last byte written after a dropped connection
+
+        Returns the connection to use for the next chunk.
+        """
+        position = start
+        for attempt in range(self.retries + 1):
+            try:
+                connection, response, _ = self.request(connection, url, {**headers, 'Range': f'bytes={position}-{end}'},
+                                                       proxies, cookiejar)
+                with self.lock:
+                    state['connections'].add(connection[1])
+                if response.status != 206 or not (response.getheader('Content-Range') or '').startswith(
+                        f'bytes {position}-'):
+                    response.read()
+                    raise IOError(f"HTTP {response.status} for bytes {position}-{end}")
+                f.seek(position)
+                while position <= end:
+                    if state['stopped']:
+                        connection[1].close()
+                        return None
+                    data = response.read(min(self.READ_SIZE, end + 1 - position))
+                    if not data:
+                        raise IOError(f"Connection closed at byte {position} of chunk {start}-{end}")
+                    f.write(data)
+                    position += len(data)
+                    with self.lock:
+                        state['downloaded'] += len(data)
+                    if throttle:
+                        throttle(len(data))
+                return connection
+            except (http.client.HTTPException, OSError) as e:
+                if connection is not None:
+                    connection[1].close()
+                    connection = None
+                if state['stopped'] or attempt == self.retries:
+                    raise
+                print(f'[DEBUG] Retrying bytes {position}-{end}: {e}')
+                REGISTRY.inc('downloader_retries_total', kind='segment')
+                time.sleep(random.uniform(0, min(2 ** attempt, 30)))
+
+    def download_single(self, url, path, headers, progress, throttle=None, proxies=None, cookiejar=None):
+        """Fallback for servers without range support"""
+        connection, response, url = self.request(None, url, headers, proxies, cookiejar)
+        try:
+            if response.status >= 400:
+                raise IOError(f"HTTP {response.status} {response.reason}")
+            length = response.getheader('Content-Length')
+            total = int(length) if length and length.isdigit() else None
+            downloaded = 0
+            last_report = 0
+            with open(path, 'wb') as f:
+                while True:
+                    data = response.read(self.READ_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    downloaded += len(data)
+                    if throttle:
+                        throttle(len(data))
+                    now = time.monotonic()
+                    if progress and now - last_report >= 0.25:
+                        last_report = now
+                        progress(downloaded, total or downloaded)
+        finally:
+            connection[1].close()
+        if progress:
+            progress(downloaded, downloaded)
+        return downloaded
+
+    def preallocate(self, path, size):
+        with open(path, 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                # Windows, or a file system without fallocate: a sparse file of the right size
+                f.truncate(size)
+
+    def load_state(self, state_path, path, size):
+        """Return the start offsets of the chunks finished by an earlier attempt"""
+        try:
+            with open(state_path) as f:
+                saved = json.load(f)
+            if saved['size'] == size and saved['chunk_size'] == self.chunk_size and os.path.getsize(path) == size:
+                return set(saved['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return set()
+
+    def save_state(self, state_path, size, done):
+        temp_path = state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'size': size, 'chunk_size': self.chunk_size, 'done': sorted(done)}, f)
+        os.replace(temp_path, state_path)
+
+
+class DownloadBackend:
+    """yt-dlp's built-in downloaders"""
+    name = "yt-dlp"
+
+    def configure(self, options):
+        """Adjust a job's yt-dlp options"""
+        return options
+
+    def create_ydl(self, options, throttle=None):
+        """Return the YoutubeDL for a job
+
+        throttle(size) limits the job's bandwidth. yt-dlp's downloaders are limited through
+        the job's progress hook, so only backends that read data themselves call it.
+        """
+        return yt_dlp.YoutubeDL(options)
+
+
+class ExternalBackend(DownloadBackend):
+    """Hands the downloads to an external program supported by yt-dlp, e.g. aria2c"""
+
+    def __init__(self, tool="aria2c", args=None):
+        self.name = tool
+        self.args = list(args or [])
+
+    @property
+    def available(self):
+        return shutil.which(self.name) is not None
+
+    def configure(self, options):
+        if not self.available:
+            print(f"{self.name} was not found, using the built-in downloader")
+            return options
+        options = dict(options)
+        options['external_downloader'] = {'default': self.name}
+        if self.args:
+            options['external_downloader_args'] = {self.name: self.args}
+        return options
+
+
+class SegmentedBackend(DownloadBackend):
+    """Fetches large progressive HTTP formats with SegmentedDownloader; everything else goes to yt-dlp"""
+    name = "segmented"
+    # Smaller files finish before extra connections pay off
+    MIN_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, connections=8, chunk_size=8 * 1024 * 1024):
+        self.downloader = SegmentedDownloader(connections, chunk_size)
+
+    def create_ydl(self, options, throttle=None):
+        return SegmentedYoutubeDL(options, self, throttle)
+
+    def suitable(self, info, proxies=None):
+        size = info.get('filesize') or info.get('filesize_approx')
+        if not (info.get('protocol') in ('http', 'https') and bool(info.get('url'))
+                and not info.get('fragments') and (size is None or size >= self.MIN_SIZE)):
+            return False
+        # yt-dlp handles SOCKS and HTTPS proxies
+        proxy = self.downloader.proxy_for(info['url'], self.format_proxies(info, proxies))
+        return proxy is None or urlparse(proxy).scheme == 'http'
+
+    @staticmethod
+    def format_proxies(info, proxies):
+        """The proxy map for a format: a Ytdl-Request-Proxy header overrides the global one"""
+        for key, value in (info.get('http_headers') or {}).items():
+            if key.lower() == 'ytdl-request-proxy':
+                return {'all': value}
+        return proxies
+
+    def fetch(self, name, info, ydl, throttle=None):
+        """Download one format to name, reporting progress to the yt-dlp progress hooks
+
+        The requests carry the format's HTTP headers and the cookies of ydl's cookie jar and
+        go through ydl's proxy, as those of yt-dlp's own downloader do.
+        """
+        params = ydl.params
+        temp_name = name if params.get('nopart') else name + '.part'
+        hooks = params.get('progress_hooks') or []
+        headers = {key: value for key, value in (info.get('http_headers') or {}).items()
+                   if key.lower() not in ('ytdl-request-proxy', 'cookie')}
+        started = time.monotonic()
+
+        def report(downloaded, total, status='downloading'):
+            elapsed = time.monotonic() - started
+            speed = downloaded / elapsed if elapsed > 0 else None
+            d = {
+                'status': status,
+                'filename': name,
+                'tmpfilename': temp_name,
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'elapsed': elapsed,
+                'speed': speed,
+                'eta': (total - downloaded) / speed if speed else None,
+                'info_dict': info,
+                # The connections already passed every read to throttle
+                'bandwidth_charged': True
+            }
+            for hook in hooks:
+                hook(d)
+
+        print(f'[DEBUG] Segmented download of format {info.get("format_id")} with '
+              f'{self.downloader.connections} connections')
+        size = self.downloader.download(info['url'], temp_name, headers, report, throttle,
+                                        self.format_proxies(info, ydl.proxies), ydl.cookiejar)
+        if temp_name != name:
+            os.replace(temp_name, name)
+        report(size, size, 'finished')
+        return True
+
+
+class SegmentedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL that hands suitable single-file downloads to a SegmentedBackend"""
+
+    def __init__(self, params, backend, throttle=None):
+        super().__init__(params)
+        self.backend = backend
+        self.throttle = throttle
+
+    def dl(self, name, info, subtitle=False, test=False):
+        if subtitle or test or not self.backend.suitable(info, self.proxies):
+            return super().dl(name, info, subtitle, test)
+        # Same (success, real_download) result as yt-dlp's own downloaders
+        return self.backend.fetch(name, info, self, self.throttle), True
+
+
+def create_backend(name="yt-dlp", connections=8):
+    """Return the backend for a --downloader name: yt-dlp, segmented or an external program"""
+    if not name or name == DownloadBackend.name:
+        return DownloadBackend()
+    if name == SegmentedBackend.name:
+        return SegmentedBackend(connections)
+    return ExternalBackend(name, ['-x', str(connections), '-s', str(connections), '-k', '1M'] if name == 'aria2c' else None)
@@ -0,0 +1,271 @@
+"""Command line front end for headless and scheduled downloads; does not need PyQt5"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from downloader_core import (DatabaseManager, MetadataCache, ThumbnailCache, DownloadManager, JobJournal,
+                             DuplicateFinder, BandwidthScheduler, FormatPolicy, RetryPolicy, FORMAT_MAPPING,
+                             AUDIO_FORMATS, VIDEO_CODECS, AUDIO_CODECS, clean_youtube_url, parse_item_range, parse_rate,
+                             parse_bandwidth_profiles, parse_video_codecs, parse_audio_codecs, expand_playlist,
+                             preview_formats)
+from downloader_backends import create_backend
+from downloader_metrics import REGISTRY, MetricsServer
+
+
+def read_batch_file(path):
+    """Read URLs from a batch file, one per line; blank lines and # comments are ignored"""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+
+def simulate(urls, args, policy, metadata_cache, out):
+    """Print the formats that would be downloaded for each URL and their predicted size"""
+    item_range = parse_item_range(args.items)
+    failed = 0
+    for url in urls:
+        if args.playlist:
+            entries = [entry_url for entry_url, _ in expand_playlist(url, item_range[0], item_range[1])]
+        else:
+            entries = [clean_youtube_url(url)]
+        for entry_url in entries:
+            try:
+                record = preview_formats(entry_url, args.quality, policy, metadata_cache)
+            except Exception as e:
+                failed += 1
+                record = {'url': entry_url, 'error': str(e)}
+            if args.json:
+                out.write(json.dumps(record) + '\n')
+            elif 'error' in record:
+                out.write(f"{entry_url}: {record['error']}\n")
+            else:
+                size = f"~{record['size'] / (1024 * 1024):.1f} MB" if record['size'] else "size unknown"
+                out.write(f"{record['title']}: {record['format_id'] or 'chosen by yt-dlp'} "
+                          f"{record['description'] or ''} ({size})\n")
+            out.flush()
+    return 1 if failed else 0
+
+
+class ProgressReporter:
+    """Prints download events either as JSON lines or as human readable text"""
+
+    def __init__(self, manager, db_manager, out, as_json=False, interval=1.0):
+        self.manager = manager
+        self.db_manager = db_manager
+        self.out = out
+        self.as_json = as_json
+        self.interval = interval
+        self.last_progress = {}
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            if self.as_json:
+                self.out.write(json.dumps(record) + '\n')
+            else:
+                self.out.write(self.format_record(record) + '\n')
+            self.out.flush()
+
+    def format_record(self, record):
+        event = record['event']
+        prefix = f"[{record['job_id']}]" if record.get('job_id') else "[playlist]"
+        if event == 'added':
+            return f"{prefix} queued {record['url']}"
+        if event == 'started':
+            return f"{prefix} started"
+        if event == 'postprocessing':
+            return f"{prefix} post-processing"
+        if event == 'retrying':
+            return f"{prefix} {record['error']} error, retry {record['attempt']}/{record['retries']} in " \
+                   f"{record['delay']:.0f}s: {record['message']}"
+        if event == 'format_selected':
+            size = f" ~{record['size'] / (1024 * 1024):.1f} MB" if record['size'] else ""
+            return f"{prefix} format {record['format_id']} {record['description']}{size}"
+        if event == 'progress':
+            return f"{prefix} {record['percent']:.1f}% {record['speed']} {record['title']}"
+        if event == 'finished':
+            return f"{prefix} {record['status']}: {record['title']} {record['message']}"
+        if event == 'playlist_finished':
+            return f"{prefix} {record['message']} ({record['url']})"
+        return f"{prefix} {event}"
+
+    def on_event(self, event, job_id, data):
+        record = {'event': event, 'job_id': job_id, 'time': time.time()}
+        if event == 'added':
+            record['url'] = data['url']
+        elif event == 'progress':
+            now = time.monotonic()
+            if now - self.last_progress.get(job_id, 0) < self.interval:
+                return
+            self.last_progress[job_id] = now
+            status = data['status']
+            record.update({
+                'percent': round(data['percent'], 2),
+                'speed': data['speed'],
+                'title': data['title'],
+                'downloaded_bytes': status.get('downloaded_bytes'),
+                'total_bytes': status.get('total_bytes'),
+                'eta': status.get('eta')
+            })
+        elif event == 'finished':
+            job = data['job']
+            record.update({
+                'status': job.status,
+                'message': data['message'],
+                'title': data['title'],
+                'url': job.url,
+                'output_path': job.output_path
+            })
+            if not data['success']:
+                self.failed += 1
+            self.db_manager.save_job(job, data['success'])
+        elif event == 'playlist_finished':
+            record.update(data)
+            if not data['success']:
+                self.failed += 1
+        elif event in ('format_selected', 'retrying'):
+            record.update(data)
+        elif event == 'thumbnail':
+            return
+        self.write(record)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Download YouTube videos without the GUI")
+    parser.add_argument('urls', nargs='*', help="video, playlist or channel URLs")
+    parser.add_argument('-a', '--batch-file', help="file with one URL per line ('-' reads stdin)")
+    parser.add_argument('-o', '--output-dir', default=os.path.expanduser("~/Downloads"), help="save directory")
+    parser.add_argument('-q', '--quality', default='best', choices=list(FORMAT_MAPPING), help="video quality")
+    parser.add_argument('-j', '--jobs', type=int, default=3, help="number of parallel downloads")
+    parser.add_argument('--per-host', type=int, default=2, help="parallel downloads allowed per host")
+    parser.add_argument('-N', '--fragments', type=int, default=4,
+                        help="DASH/HLS fragments fetched in parallel per download")
+    parser.add_argument('--pp-workers', type=int, metavar='N',
+                        help="processes for merging, MP3 conversion and thumbnail embedding (default: one per CPU "
+                             "core); 0 runs them in the download slot")
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help="queued videos whose info is extracted while others download; 0 disables it")
+    parser.add_argument('--downloader', default='yt-dlp',
+                        help="yt-dlp, segmented (multi-connection) or an external program such as aria2c")
+    parser.add_argument('--connections', type=int, default=8, help="connections per file for segmented and aria2c")
+    parser.add_argument('-r', '--limit-rate', type=parse_rate, metavar='RATE',
+                        help="total download rate shared by all downloads, e.g. 500K or 2M")
+    parser.add_argument('--job-limit', type=parse_rate, metavar='RATE', help="download rate limit of each download")
+    parser.add_argument('--bandwidth-schedule', type=parse_bandwidth_profiles, default=[], metavar='PROFILES',
+                        help="time-of-day rate limits replacing --limit-rate, e.g. '23:00-07:00=unlimited,09:00-17:00=1M'")
+    parser.add_argument('--max-filesize', type=parse_rate, metavar='SIZE',
+                        help="prefer formats whose predicted size fits, e.g. 200M")
+    parser.add_argument('--vcodec', type=parse_video_codecs, metavar='CODECS',
+                        help=f"preferred video codecs in order, from {','.join(VIDEO_CODECS)}")
+    parser.add_argument('--acodec', type=parse_audio_codecs, metavar='CODECS',
+                        help=f"preferred audio codecs in order, from {','.join(AUDIO_CODECS)}")
+    parser.add_argument('--target-bitrate', type=float, metavar='KBPS',
+                        help="prefer the formats closest to this total bitrate in kbit/s")
+    parser.add_argument('--no-transcode', action='store_true',
+                        help="prefer formats that need no merging, and AAC audio")
+    parser.add_argument('--audio-format', default='original', choices=AUDIO_FORMATS,
+                        help="audio_only output: the original Opus/AAC stream without re-encoding, or MP3")
+    parser.add_argument('--simulate', action='store_true',
+                        help="print the formats that would be downloaded and their size, without downloading")
+    parser.add_argument('--playlist', action='store_true', help="treat the URLs as playlists or channels")
+    parser.add_argument('--items', default='', help="playlist index range, e.g. 1-50 or 100-")
+    parser.add_argument('--only-new', action='store_true', help="skip videos already in the download history")
+    parser.add_argument('--duplicates', default='skip', choices=['skip', 'link', 'download'],
+                        help="videos already on disk are skipped, linked into the output directory or downloaded again")
+    parser.add_argument('--retries', type=int, default=5, metavar='N',
+                        help="retry failed downloads up to N times, depending on the error; 0 disables retries")
+    parser.add_argument('--json', action='store_true', help="print progress as JSON lines on stdout")
+    parser.add_argument('--log-json', metavar='PATH',
+                        help="append phase timings and errors as JSON lines to PATH ('-' for stderr)")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics while downloading")
+    parser.add_argument('--db', default="download_history.db", help="history database path")
+    parser.add_argument('--no-cache', action='store_true', help="don't use the metadata and thumbnail caches")
+    parser.add_argument('--resume', action='store_true', help="also resume downloads interrupted in an earlier run")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    urls = list(args.urls)
+    if args.batch_file:
+        urls.extend(read_batch_file(args.batch_file))
+    if not urls and not args.resume:
+        parser.error("no URLs given")
+    if not args.simulate and not os.path.isdir(args.output_dir):
+        parser.error(f"the save path {args.output_dir} is invalid")
+    item_range = parse_item_range(args.items)
+    if item_range is None:
+        parser.error("--items must be a range like 1-50, 10- or 5")
+
+    # Keep stdout for progress records; engine diagnostics go to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    policy = FormatPolicy(args.max_filesize, args.vcodec, args.acodec, args.target_bitrate, args.no_transcode)
+    if args.simulate:
+        try:
+            return simulate(urls, args, policy, None if args.no_cache else MetadataCache(), out)
+        finally:
+            sys.stdout = out
+
+    if args.log_json:
+        REGISTRY.log.open(args.log_json)
+    if args.metrics_port:
+        MetricsServer(port=args.metrics_port).start()
+    db_manager = DatabaseManager(args.db)
+    manager = DownloadManager(
+        max_concurrent=max(1, args.jobs),
+        per_host_limit=max(1, args.per_host),
+        fragment_workers=max(1, args.fragments),
+        metadata_cache=None if args.no_cache else MetadataCache(),
+        thumbnail_cache=None if args.no_cache else ThumbnailCache(),
+        duplicate_finder=DuplicateFinder(db_manager),
+        duplicate_policy=args.duplicates,
+        backend=create_backend(args.downloader, max(1, args.connections)),
+        bandwidth=BandwidthScheduler(args.limit_rate, args.bandwidth_schedule),
+        job_rate_limit=args.job_limit,
+        post_processing_workers=args.pp_workers,
+        format_policy=policy,
+        audio_format=args.audio_format,
+        retry_policy=RetryPolicy(max(0, args.retries)),
+        prefetch=max(0, args.prefetch)
+    )
+    reporter = ProgressReporter(manager, db_manager, out, as_json=args.json)
+    manager.add_listener(reporter.on_event)
+    journal = JobJournal(manager, db_manager)
+    if args.resume:
+        journal.resume()
+
+    skip_ids = db_manager.get_downloaded_video_ids() if args.only_new else None
+    for url in urls:
+        if args.playlist:
+            manager.submit_playlist(url, args.output_dir, args.quality, item_range[0], item_range[1], skip_ids)
+        else:
+            manager.submit(clean_youtube_url(url), args.output_dir, args.quality)
+
+    try:
+        while not manager.wait(timeout=0.5):
+            pass
+    except KeyboardInterrupt:
+        # The downloads are interrupted, not cancelled, so --resume continues them
+        manager.stop(preserve=True)
+        manager.join_cancelled(timeout=10)
+        return 130
+    finally:
+        manager.shutdown()
+        sys.stdout = out
+    return 1 if reporter.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
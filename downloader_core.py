@@ -0,0 +1,3162 @@
+"""Qt-free download engine shared by the GUI, the command line tool and the job API"""
+import os
+import re
+import glob
+import json
+import math
+import time
+import queue
+import random
+import atexit
+import shutil
+import signal
+import socket
+import sqlite3
+import hashlib
+import weakref
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import (Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError,
+                                wait as wait_for_futures)
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque, OrderedDict
+from itertools import islice
+from urllib.parse import urlparse, parse_qs
+
+import yt_dlp
+from yt_dlp.postprocessor import get_postprocessor
+from yt_dlp.postprocessor import ffmpeg as ffmpeg_postprocessors
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.utils import (DownloadCancelled, DownloadError, ExtractorError, PostProcessingError, Popen, determine_ext,
+                          prepend_extension, replace_extension)
+
+from downloader_backends import DownloadBackend
+from downloader_metrics import REGISTRY, JobTrace, POSTPROCESSOR_PHASES
+
+
+# 更新格式映射
+FORMAT_MAPPING = {
+    'best': 'bv*+ba/b',
+    '1080p': 'bv[height<=1080]+ba/b[height<=1080]',
+    '720p': 'bv[height<=720]+ba/b[height<=720]',
+    '480p': 'bv[height<=480]+ba/b[height<=480]',
+    '360p': 'bv[height<=360]+ba/b[height<=360]',
+    'audio_only': 'ba/b'
+}
+
+# Quality combo box labels and the FORMAT_MAPPING keys they select
+QUALITY_MAPPING = {
+    "Best Quality": "best",
+    "1080p": "1080p",
+    "720p": "720p",
+    "480p": "480p",
+    "360p": "360p",
+    "Audio Only": "audio_only"
+}
+
+# Outputs of audio_only downloads: 'original' remuxes the downloaded Opus/AAC stream without
+# re-encoding it, 'mp3' converts it to MP3
+AUDIO_FORMATS = ('original', 'mp3')
+
+# Codec names accepted as format preferences and the vcodec/acodec prefixes they match
+VIDEO_CODECS = {
+    'av1': ('av01',),
+    'vp9': ('vp9', 'vp09'),
+    'h264': ('avc1', 'h264')
+}
+AUDIO_CODECS = {
+    'opus': ('opus',),
+    'aac': ('mp4a', 'aac'),
+    'vorbis': ('vorbis',),
+    'mp3': ('mp3',)
+}
+CODEC_LABELS = {'av1': 'AV1', 'vp9': 'VP9', 'h264': 'H.264', 'opus': 'Opus', 'aac': 'AAC', 'vorbis': 'Vorbis',
+                'mp3': 'MP3'}
+
+# Relative share of the bandwidth each job priority gets
+PRIORITIES = {
+    'low': 1,
+    'normal': 2,
+    'high': 4
+}
+
+# Job statuses after which nothing happens to a job any more
+FINAL_STATES = ('completed', 'skipped', 'failed', 'cancelled')
+
+# Why a download failed: (times it is retried, base backoff in seconds, whether the retry needs freshly
+# extracted stream URLs). 'unavailable' covers private, removed and blocked videos, which won't come back.
+ERROR_CLASSES = {
+    'expired': (3, 2, True),
+    'throttled': (5, 30, False),
+    'network': (5, 5, False),
+    'extractor': (3, 10, True),
+    'ffmpeg': (1, 5, False),
+    'unavailable': (0, 0, False),
+    'unknown': (1, 10, False)
+}
+
+# Classes recognized from the messages of the errors, in order, when the exceptions themselves don't tell
+ERROR_PATTERNS = (
+    ('expired', re.compile(r'HTTP Error (403|410)')),
+    ('throttled', re.compile(r'HTTP Error (429|503)|Too Many Requests')),
+    ('unavailable', re.compile(r'Video unavailable|Private video|members-only|has been removed|copyright|'
+                               r'not available in your country|Requested format is not available|'
+                               r'Unsupported URL|is not a valid URL', re.IGNORECASE)),
+    ('network', re.compile(r'timed out|Connection (reset|refused|aborted)|Remote end closed|IncompleteRead|'
+                           r'Temporary failure in name resolution|Network is unreachable|'
+                           r'Did not get any data blocks|HTTP Error 5\d\d', re.IGNORECASE)),
+    ('ffmpeg', re.compile(r'ffmpeg|ffprobe|Post-?processing', re.IGNORECASE))
+)
+
+
+def clean_youtube_url(url):
+    """
+    清理YouTube视频URL，只保留核心的视频标识符部分
+    
+    参数:
+    url (str): 原始的YouTube视频URL
+    
+    返回:
+    str: 清理后的基本URL，只包含视频ID部分
+    """
+    # 处理标准的watch?v=格式，及各个子域名
+    watch_pattern = r'(https?://(www|m|music)\.youtube\.com/watch\?v=[a-zA-Z0-9_-]+)'
+    match = re.match(watch_pattern, url)
+    if match:
+        return match.group(1)
+    
+    # 处理youtu.be短链接格式
+    short_pattern = r'(https?://youtu\.be/[a-zA-Z0-9_-]+)'
+    match = re.match(short_pattern, url)
+    if match:
+        return match.group(1)
+    
+    # 处理shorts、embed、live等其他格式，统一转换为watch?v=格式
+    video_id = get_video_id(url)
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+    
+    return url
+
+
+def get_video_id(url):
+    """Return the YouTube video ID of a watch, youtu.be, shorts, embed or live URL, or None if it has none"""
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if host in ('youtu.be', 'www.youtu.be'):
+        video_id = parsed.path.lstrip('/').split('/')[0]
+        return video_id or None
+    if host.endswith('youtube.com') or host.endswith('youtube-nocookie.com'):
+        video_id = parse_qs(parsed.query).get('v', [None])[0]
+        if video_id:
+            return video_id
+        # /embed/videoseries and /live/ channel pages have no video ID
+        match = re.match(r'/(?:shorts|embed|live|v|e)/(?!videoseries)([a-zA-Z0-9_-]{11})(?:[/?#]|$)', parsed.path)
+        return match.group(1) if match else None
+    return None
+
+
+def parse_item_range(text):
+    """Parse a playlist item range such as "1-50", "10-" or "5" into (start, end)"""
+    text = text.strip()
+    if not text:
+        return 1, None
+    match = re.fullmatch(r'(\d*)\s*(-?)\s*(\d*)', text)
+    if not match or not (match.group(1) or match.group(3)):
+        return None
+    start = int(match.group(1)) if match.group(1) else 1
+    if not match.group(2):
+        return start, start
+    end = int(match.group(3)) if match.group(3) else None
+    if start < 1 or (end is not None and end < start):
+        return None
+    return start, end
+
+
+def parse_rate(text):
+    """Parse a rate such as 500K or 2M into bytes per second; '', 0 and 'unlimited' give None
+
+    Raises ValueError for anything else.
+    """
+    text = str(text if text is not None else '').strip()
+    if text.lower() in ('', '0', 'unlimited', 'none'):
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)i?B?(?:/s)?', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid rate: {text}")
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')) or None
+
+
+def format_rate(rate):
+    return f"{rate / 1024 / 1024:.1f} MB/s" if rate and rate >= 1024 * 1024 else (
+        f"{rate / 1024:.0f} KB/s" if rate else "Unlimited")
+
+
+def parse_bandwidth_profiles(text):
+    """Parse time-of-day limits such as "23:00-07:00=unlimited, 09:00-17:00=1M"
+
+    Returns (start, end, rate) tuples with start and end in minutes after midnight; a
+    range may wrap past midnight. Raises ValueError if a part can't be parsed.
+    """
+    profiles = []
+    for part in str(text or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S+)', part)
+        if not match:
+            raise ValueError(f"invalid bandwidth profile: {part}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        if start > 24 * 60 or end > 24 * 60 or start == end:
+            raise ValueError(f"invalid bandwidth profile: {part}")
+        profiles.append((start, end, parse_rate(match.group(5))))
+    return profiles
+
+
+def format_bandwidth_profiles(profiles):
+    """The inverse of parse_bandwidth_profiles"""
+    def rate_text(rate):
+        if not rate:
+            return 'unlimited'
+        for unit, size in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+            if rate % size == 0:
+                return f"{rate // size}{unit}"
+        return str(rate)
+
+    return ', '.join(
+        f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}={rate_text(rate)}"
+        for start, end, rate in profiles)
+
+
+def format_duration(seconds):
+    """Format video duration"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def format_count(count):
+    """Format view count"""
+    if count >= 10**9:
+        return f"{count / 10**9:.1f}B"
+    if count >= 10**6:
+        return f"{count / 10**6:.1f}M"
+    if count >= 10**3:
+        return f"{count / 10**3:.1f}K"
+    return str(count)
+
+
+def get_thumbnail_url(info_dict):
+    """Unprocessed info may only carry the thumbnails list, so fall back to its best entry"""
+    if info_dict.get('thumbnail'):
+        return info_dict['thumbnail']
+    thumbnails = [t for t in info_dict.get('thumbnails') or [] if t.get('url')]
+    if thumbnails:
+        return max(thumbnails, key=lambda t: t.get('preference') or 0)['url']
+    return ''
+
+
+# File names of downloads; the [video ID] lets OutputFileIndex find them without the download history
+OUTPUT_TEMPLATE = '%(title)s [%(id)s].%(ext)s'
+
+
+def get_output_path(result, output_dir, title, quality, audio_format="mp3", video_id=None):
+    """Return the final file path reported by yt-dlp, falling back to a guess from the title and video ID"""
+    downloads = (result or {}).get('requested_downloads') or []
+    if downloads and downloads[-1].get('filepath'):
+        return downloads[-1]['filepath']
+    name = f"{title} [{video_id}]" if video_id else title
+    if quality != 'audio_only':
+        return os.path.join(output_dir, f"{name}.mp4")
+    return os.path.join(output_dir, f"{name}.{'mp3' if audio_format == 'mp3' else 'm4a'}")
+
+
+def codec_name(codec, codecs):
+    """Map a vcodec/acodec string such as 'avc1.640028' to its name in codecs ('h264'); None for 'none'"""
+    codec = (codec or '').lower()
+    if codec in ('', 'none'):
+        return None
+    for name, prefixes in codecs.items():
+        if codec.startswith(prefixes):
+            return name
+    return codec.split('.')[0]
+
+
+def parse_codecs(text, codecs):
+    """Parse a comma separated codec list such as 'vp9,h264' against the names in codecs"""
+    names = [name.strip().lower() for name in (text or '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in codecs]
+    if unknown:
+        raise ValueError(f"unknown codec {unknown[0]}, use one of: {', '.join(codecs)}")
+    return names
+
+
+def parse_video_codecs(text):
+    return parse_codecs(text, VIDEO_CODECS)
+
+
+def parse_audio_codecs(text):
+    return parse_codecs(text, AUDIO_CODECS)
+
+
+def format_size(f, duration=None):
+    """Size of a format in bytes: exact, approximate or from its bitrate (kbit/s) and the duration"""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 125 * duration
+    return size
+
+
+def describe_formats(formats):
+    """Short description of the formats of a download, e.g. '1080p60 AV1 + Opus'"""
+    parts = []
+    for f in formats:
+        video = codec_name(f.get('vcodec'), VIDEO_CODECS)
+        audio = codec_name(f.get('acodec'), AUDIO_CODECS)
+        label = []
+        if video:
+            fps = f.get('fps') or 0
+            label.append(f"{f.get('height') or '?'}p{int(fps) if fps > 30 else ''} {CODEC_LABELS.get(video, video)}")
+        if audio:
+            label.append(CODEC_LABELS.get(audio, audio) if video else
+                         f"{CODEC_LABELS.get(audio, audio)} {int(f['abr'])}k" if f.get('abr') else
+                         CODEC_LABELS.get(audio, audio))
+        parts.append('/'.join(label) or f.get('format_id', '?'))
+    return ' + '.join(parts)
+
+
+class FormatPolicy:
+    """Picks the formats to download from the formats yt-dlp extracted
+
+    Candidates are every video-only format paired with every audio-only format, plus the
+    formats that carry both, and they are ranked by
+    - fitting max_size (bytes); if nothing fits the smallest candidate wins
+    - using only the listed video and audio codecs, when possible
+    - the highest resolution (and frame rate) the quality allows, SDR before HDR
+    - the original audio track, as marked by the extractor
+    - the order of the preferred video and audio codecs
+    - the bitrate closest to target_bitrate (kbit/s), or the highest without a target
+    With avoid_transcode a single-file format beats a pair that has to be merged at the
+    same resolution, and AAC is preferred by default.
+    """
+    # Best compression first, like yt-dlp's own format sorting
+    DEFAULT_VIDEO_CODECS = ('av1', 'vp9', 'h264')
+    DEFAULT_AUDIO_CODECS = ('opus', 'aac')
+    
+    def __init__(self, max_size=None, video_codecs=None, audio_codecs=None, target_bitrate=None,
+                 avoid_transcode=False):
+        self.max_size = max_size
+        self.video_codecs = tuple(video_codecs or self.DEFAULT_VIDEO_CODECS)
+        # M4A plays everywhere, so it is the one to keep when audio isn't converted
+        self.audio_codecs = tuple(audio_codecs or (('aac', 'opus') if avoid_transcode else self.DEFAULT_AUDIO_CODECS))
+        self.target_bitrate = target_bitrate
+        self.avoid_transcode = avoid_transcode
+    
+    def select(self, formats, quality="best", duration=None):
+        """Return the best candidate as {'format_id', 'formats', 'size', 'description'}, or None
+
+        None means the formats don't say enough (no codecs), and yt-dlp's own selection should be used.
+        """
+        usable = [f for f in formats or [] if f.get('format_id') and not f.get('has_drm')
+                  and f.get('protocol') != 'mhtml' and (f.get('preference') or 0) > -1000]
+        videos = [f for f in usable if codec_name(f.get('vcodec'), VIDEO_CODECS) and
+                  codec_name(f.get('acodec'), AUDIO_CODECS) is None and f.get('acodec')]
+        audios = [f for f in usable if codec_name(f.get('acodec'), AUDIO_CODECS) and
+                  codec_name(f.get('vcodec'), VIDEO_CODECS) is None and f.get('vcodec')]
+        muxed = [f for f in usable if codec_name(f.get('vcodec'), VIDEO_CODECS) and
+                 codec_name(f.get('acodec'), AUDIO_CODECS)]
+        if quality == "audio_only":
+            candidates = [(f,) for f in audios] or [(f,) for f in muxed]
+        else:
+            max_height = int(quality[:-1]) if quality.endswith('p') and quality[:-1].isdigit() else None
+            if max_height:
+                videos = [f for f in videos if (f.get('height') or 0) <= max_height]
+                muxed = [f for f in muxed if (f.get('height') or 0) <= max_height]
+            candidates = [(video, audio) for video in videos for audio in audios] + [(f,) for f in muxed]
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda candidate: self.rank(candidate, duration))
+        sizes = [format_size(f, duration) for f in best]
+        return {
+            'format_id': '+'.join(f['format_id'] for f in best),
+            'formats': list(best),
+            'size': sum(sizes) if all(sizes) else None,
+            'description': describe_formats(best)
+        }
+    
+    def codec_rank(self, codec, codecs, preferred):
+        name = codec_name(codec, codecs)
+        return -preferred.index(name) if name in preferred else -len(preferred)
+    
+    def rank(self, candidate, duration):
+        """Sort key of a candidate; higher is better"""
+        sizes = [format_size(f, duration) for f in candidate]
+        size = sum(sizes) if all(sizes) else None
+        # Unknown sizes can't be checked and count as fitting
+        fits = not self.max_size or size is None or size <= self.max_size
+        video = next((f for f in candidate if codec_name(f.get('vcodec'), VIDEO_CODECS)), {})
+        audio = next((f for f in candidate if codec_name(f.get('acodec'), AUDIO_CODECS)), {})
+        bitrate = sum(f.get('tbr') or 0 for f in candidate)
+        listed = all(codec_name(f.get(key), codecs) in preferred for f, key, codecs, preferred in (
+            (video, 'vcodec', VIDEO_CODECS, self.video_codecs),
+            (audio, 'acodec', AUDIO_CODECS, self.audio_codecs)) if f)
+        return (
+            fits,
+            0 if fits else -size,
+            listed,
+            video.get('height') or 0,
+            video.get('fps') or 0,
+            self.avoid_transcode and len(candidate) == 1,
+            video.get('dynamic_range') in (None, 'SDR'),
+            audio.get('language_preference') or 0,
+            self.codec_rank(video.get('vcodec'), VIDEO_CODECS, self.video_codecs),
+            self.codec_rank(audio.get('acodec'), AUDIO_CODECS, self.audio_codecs),
+            audio.get('preference') or 0,
+            -abs(bitrate - self.target_bitrate) if self.target_bitrate else bitrate,
+            len(candidate) == 1
+        )
+
+
+class DatabaseManager:
+    # Schema migrations, applied in order as (version, statements, full-text statements); PRAGMA user_version
+    # holds the last applied version. The full-text statements run first and are left out when SQLite has no FTS5;
+    # init_database runs them once a build with FTS5 opens the database.
+    MIGRATIONS = [
+        (1, [
+            '''
+            CREATE TABLE IF NOT EXISTS download_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                uploader TEXT,
+                duration TEXT,
+                view_count TEXT,
+                quality TEXT,
+                output_path TEXT,
+                download_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'completed'
+            )
+            ''',
+            # Jobs that were running when the program stopped; removed once they finish
+            '''
+            CREATE TABLE IF NOT EXISTS active_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                output_dir TEXT NOT NULL,
+                quality TEXT,
+                format_id TEXT,
+                partial_path TEXT,
+                downloaded_bytes INTEGER DEFAULT 0,
+                total_bytes INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            '''
+        ], []),
+        (2, [
+            'CREATE INDEX IF NOT EXISTS idx_download_history_date ON download_history (download_date)',
+            'CREATE INDEX IF NOT EXISTS idx_download_history_url ON download_history (url)',
+            'CREATE INDEX IF NOT EXISTS idx_download_history_status ON download_history (status)'
+        ], []),
+        (3, [
+            'CREATE INDEX IF NOT EXISTS idx_download_history_quality ON download_history (quality)'
+        ], [
+            # Full-text index over title, uploader and URL, kept in sync by triggers
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS download_history_fts USING fts5(
+                title, uploader, url, content='download_history', content_rowid='id'
+            )
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS download_history_fts_insert AFTER INSERT ON download_history BEGIN
+                INSERT INTO download_history_fts (rowid, title, uploader, url)
+                VALUES (new.id, new.title, new.uploader, new.url);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS download_history_fts_delete AFTER DELETE ON download_history BEGIN
+                INSERT INTO download_history_fts (download_history_fts, rowid, title, uploader, url)
+                VALUES ('delete', old.id, old.title, old.uploader, old.url);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS download_history_fts_update AFTER UPDATE ON download_history BEGIN
+                INSERT INTO download_history_fts (download_history_fts, rowid, title, uploader, url)
+                VALUES ('delete', old.id, old.title, old.uploader, old.url);
+                INSERT INTO download_history_fts (rowid, title, uploader, url)
+                VALUES (new.id, new.title, new.uploader, new.url);
+            END
+            ''',
+            "INSERT INTO download_history_fts (download_history_fts) VALUES ('rebuild')"
+        ]),
+        # Video ID of each record for duplicate checks; youtube_video_id() is get_video_id
+        (4, [
+            'ALTER TABLE download_history ADD COLUMN video_id TEXT',
+            'UPDATE download_history SET video_id = youtube_video_id(url)',
+            'CREATE INDEX IF NOT EXISTS idx_download_history_video_id ON download_history (video_id)'
+        ], [
+            # Only text changes need to reach the full-text index
+            'DROP TRIGGER IF EXISTS download_history_fts_update',
+            '''
+            CREATE TRIGGER download_history_fts_update AFTER UPDATE OF title, uploader, url ON download_history BEGIN
+                INSERT INTO download_history_fts (download_history_fts, rowid, title, uploader, url)
+                VALUES ('delete', old.id, old.title, old.uploader, old.url);
+                INSERT INTO download_history_fts (rowid, title, uploader, url)
+                VALUES (new.id, new.title, new.uploader, new.url);
+            END
+            '''
+        ])
+    ]
+    # Maximum number of queued writes committed in one transaction
+    BATCH_SIZE = 500
+    
+    def __init__(self, db_path="download_history.db"):
+        self.db_path = db_path
+        # One connection shared by all threads; the lock serializes its use
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.create_function('youtube_video_id', 1, get_video_id, deterministic=True)
+        self.has_fts = False
+        self.init_database()
+        # Writes from all threads are queued and committed in batches by the writer thread
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        atexit.register(self.flush)
+    
+    def init_database(self):
+        """Initialize the database and bring its schema up to date
+
+        Each migration is applied in one transaction together with its user_version, so one
+        that fails leaves the schema as it was; the error is raised.
+        """
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            # SQLite builds without FTS5 get no full-text index and fall back to LIKE searches
+            fts_available = self.fts5_available()
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            # Migrated by a build without FTS5: the full-text statements of the applied migrations are still due
+            if fts_available and not self.fts_table_exists():
+                fts_statements = [statement for migration_version, _, statements in self.MIGRATIONS
+                                  if migration_version <= version for statement in statements]
+                if fts_statements:
+                    self.apply_migration(fts_statements, version)
+                    print('[DEBUG] Full-text index added to the database')
+            for migration_version, statements, fts_statements in self.MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                self.apply_migration((fts_statements if fts_available else []) + statements, migration_version)
+                print(f'[DEBUG] Database migrated to version {migration_version}')
+            self.has_fts = fts_available and self.fts_table_exists()
+    
+    def apply_migration(self, statements, version):
+        """Run statements and set user_version to version in one transaction"""
+        self.conn.execute('BEGIN')
+        try:
+            for statement in statements:
+                self.conn.execute(statement)
+            self.conn.execute(f'PRAGMA user_version = {version}')
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+    
+    def fts_table_exists(self):
+        return bool(self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'download_history_fts'").fetchone())
+    
+    def fts5_available(self):
+        """Whether this SQLite build can create FTS5 tables"""
+        try:
+            self.conn.execute('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(text)')
+        except sqlite3.OperationalError:
+            return False
+        self.conn.execute('DROP TABLE temp.fts5_probe')
+        return True
+    
+    def write(self, sql, params=(), wait=True):
+        """Queue a write; with wait the call blocks until it is committed and returns its lastrowid"""
+        future = Future()
+        self.write_queue.put((sql, params, future))
+        return future.result() if wait else future
+    
+    def flush(self):
+        """Wait until every queued write has been committed"""
+        self.write(None)
+    
+    def write_loop(self):
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            started = time.monotonic()
+            with self.lock:
+                try:
+                    results = []
+                    with self.conn:
+                        for sql, params, future in batch:
+                            results.append(self.conn.execute(sql, params).lastrowid if sql else None)
+                except Exception:
+                    # Run the statements one by one so a single bad write doesn't fail the others
+                    results = []
+                    for sql, params, future in batch:
+                        try:
+                            with self.conn:
+                                results.append(self.conn.execute(sql, params).lastrowid if sql else None)
+                        except Exception as e:
+                            results.append(e)
+            REGISTRY.observe('downloader_db_write_seconds', time.monotonic() - started)
+            for (sql, params, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+    
+    def query(self, sql, params=(), conn=None):
+        """Run a read query on the shared connection, or on a reader connection from connect_reader"""
+        if conn is not None:
+            return conn.execute(sql, params).fetchall()
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def connect_reader(self):
+        """Open a separate connection for long reads; with WAL it doesn't block the writer"""
+        return sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+    
+    def save_download(self, title, url, uploader, duration, view_count, quality, output_path, status="completed",
+                      wait=True):
+        """Save a download record to the database; without wait a Future of the record's id is returned"""
+        try:
+            return self.write('''
+                INSERT INTO download_history 
+                (title, url, uploader, duration, view_count, quality, output_path, status, video_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (title, url, uploader, duration, view_count, quality, output_path, status, get_video_id(url)), wait)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            print(f"Error saving download: {e}")
+            return None
+    
+    def save_job(self, job, success, wait=True):
+        """Save the result of a finished DownloadJob; failures are only recorded once the video is known
+
+        Without wait the write is only queued and a Future of the record's id is returned,
+        or None when there is nothing to save.
+        """
+        video_info = job.video_info
+        if not success and not video_info:
+            return None
+        # Skipped duplicates are already in the history
+        if job.status == 'skipped':
+            return None
+        started = job.trace.clock()
+        result = self.save_download(
+            title=video_info.get('title', 'Unknown Video'),
+            url=job.url,
+            uploader=video_info.get('uploader', 'Unknown Uploader'),
+            duration=video_info.get('duration', '0:00'),
+            view_count=video_info.get('view_count', '0'),
+            quality=job.quality,
+            output_path=job.output_path if success else "",
+            status="completed" if success else "failed",
+            wait=wait
+        )
+        # The db_write phase lasts until the record is committed
+        if wait or result is None:
+            job.trace.record('db_write', job.trace.clock() - started)
+        else:
+            result.add_done_callback(lambda _: job.trace.record('db_write', job.trace.clock() - started))
+        return result
+    
+    def get_download_history(self, limit=50):
+        """Get download history from the database"""
+        try:
+            return self.query('''
+                SELECT id, title, url, uploader, duration, view_count, quality, 
+                       output_path, download_date, status
+                FROM download_history 
+                ORDER BY download_date DESC 
+                LIMIT ?
+            ''', (limit,))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            print(f"Error getting download history: {e}")
+            return []
+    
+    def history_filter(self, filters, ordered=False):
+        """Build the WHERE conditions for history filters: search, status, quality, date_from and date_to"""
+        conditions, params = [], []
+        words = re.findall(r'\w+', filters.get('search') or '')
+        if words and self.has_fts:
+            # Every word must match the start of a word in the title, uploader or URL
+            conditions.append('id IN (SELECT rowid FROM download_history_fts WHERE download_history_fts MATCH ?)')
+            params.append(' '.join(f'"{word}"*' for word in words))
+        for word in (words if not self.has_fts else []):
+            conditions.append('(title LIKE ? OR uploader LIKE ? OR url LIKE ?)')
+            params.extend([f'%{word}%'] * 3)
+        for column in ('status', 'quality'):
+            if filters.get(column):
+                # For pages in date order a unary + keeps SQLite walking the date index and stopping
+                # after `limit` rows, instead of sorting every row the status or quality index returns
+                conditions.append(f"{'+' if ordered else ''}{column} = ?")
+                params.append(filters[column])
+        if filters.get('date_from'):
+            conditions.append('download_date >= ?')
+            params.append(filters['date_from'])
+        if filters.get('date_to'):
+            conditions.append('download_date < ?')
+            params.append(filters['date_to'])
+        return conditions, params
+    
+    def select_history(self, after=None, limit=200, filters=None, conn=None):
+        """Query a page of history; unlike get_history_page errors are raised to the caller"""
+        conditions, params = self.history_filter(filters or {}, ordered=True)
+        if after is not None:
+            conditions.append('(download_date, id) < (?, ?)')
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        # Keyset pagination stays fast at any depth, unlike OFFSET
+        return self.query(f'''
+            SELECT id, title, url, uploader, duration, view_count, quality, 
+                   output_path, download_date, status
+            FROM download_history 
+            {where}
+            ORDER BY download_date DESC, id DESC 
+            LIMIT ?
+        ''', (*params, limit), conn)
+    
+    def count_matching(self, filters=None, conn=None):
+        """Count the history rows matching filters; errors are raised to the caller"""
+        conditions, params = self.history_filter(filters or {})
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.query(f'SELECT COUNT(*) FROM download_history {where}', params, conn)[0][0]
+    
+    def get_history_page(self, after=None, limit=200, filters=None):
+        """Get the next page of history, newest first, starting after the (download_date, id) key `after`"""
+        try:
+            return self.select_history(after, limit, filters)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error getting history page: {e}")
+            return []
+    
+    def get_download(self, download_id):
+        """Get one history row by id"""
+        try:
+            rows = self.query('''
+                SELECT id, title, url, uploader, duration, view_count, quality, 
+                       output_path, download_date, status
+                FROM download_history 
+                WHERE id = ?
+            ''', (download_id,))
+            return rows[0] if rows else None
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error getting download: {e}")
+            return None
+    
+    def count_history(self, filters=None):
+        """Return the number of history rows matching filters"""
+        try:
+            return self.count_matching(filters)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error counting history: {e}")
+            return 0
+    
+    def clear_history(self):
+        """Clear all download history"""
+        try:
+            self.write('DELETE FROM download_history')
+            return True
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            print(f"Error clearing history: {e}")
+            return False
+    
+    def get_downloaded_video_ids(self):
+        """Return the video IDs of all completed downloads"""
+        try:
+            rows = self.query(
+                "SELECT DISTINCT video_id FROM download_history WHERE status = 'completed' AND video_id IS NOT NULL")
+            return {row[0] for row in rows}
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error getting downloaded video IDs: {e}")
+            return set()
+    
+    def find_downloads(self, video_id):
+        """Get the completed downloads of a video, newest first"""
+        try:
+            return self.query('''
+                SELECT title, uploader, duration, view_count, quality, output_path
+                FROM download_history
+                WHERE video_id = ? AND status = 'completed'
+                ORDER BY download_date DESC
+            ''', (video_id,))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error finding downloads: {e}")
+            return []
+    
+    def save_active_job(self, url, output_dir, quality):
+        """Record a job that has started downloading and return its row id"""
+        try:
+            return self.write('''
+                INSERT INTO active_jobs (url, output_dir, quality) VALUES (?, ?, ?)
+            ''', (url, output_dir, quality))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error saving active job: {e}")
+            return None
+    
+    def update_active_job(self, active_id, **fields):
+        """Update format_id, partial_path, downloaded_bytes or total_bytes of an active job"""
+        allowed = ('format_id', 'partial_path', 'downloaded_bytes', 'total_bytes')
+        fields = {key: value for key, value in fields.items() if key in allowed}
+        if not fields:
+            return
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        # Progress updates don't need to wait for the commit
+        self.write(
+            f"UPDATE active_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (*fields.values(), active_id),
+            wait=False
+        )
+    
+    def delete_active_job(self, active_id):
+        """Forget an active job once it has finished"""
+        self.write('DELETE FROM active_jobs WHERE id = ?', (active_id,), wait=False)
+    
+    def get_active_jobs(self):
+        """Get the jobs that were interrupted before they finished"""
+        try:
+            return self.query('''
+                SELECT id, url, output_dir, quality, format_id, partial_path, downloaded_bytes, total_bytes
+                FROM active_jobs
+                ORDER BY id
+            ''')
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error getting active jobs: {e}")
+            return []
+    
+    def delete_download(self, download_id):
+        """Delete a specific download record"""
+        try:
+            self.write('DELETE FROM download_history WHERE id = ?', (download_id,))
+            return True
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            print(f"Error deleting download: {e}")
+            return False
+
+
+class HistorySearch:
+    """Runs history searches on a background thread; a new search interrupts the one still running"""
+    
+    def __init__(self, db_manager, callback, limit=200):
+        self.db_manager = db_manager
+        self.callback = callback  # callback(generation, filters, rows, total), called on the search thread
+        self.limit = limit
+        self.conn = None
+        self.pending = None
+        self.generation = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def search(self, filters):
+        """Start a search and return its generation; results of older generations are dropped"""
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, dict(filters))
+            if self.conn is not None:
+                self.conn.interrupt()
+            self.condition.notify()
+            return self.generation
+    
+    def run(self):
+        conn = self.db_manager.connect_reader()
+        with self.condition:
+            self.conn = conn
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                generation, filters = self.pending
+                self.pending = None
+            try:
+                rows = self.db_manager.select_history(None, self.limit, filters, conn)
+                total = self.db_manager.count_matching(filters, conn)
+            except sqlite3.OperationalError as e:
+                # Interrupted by a newer search, or a malformed query
+                if generation == self.generation:
+                    print(f"Error searching history: {e}")
+                continue
+            if generation == self.generation:
+                self.callback(generation, filters, rows, total)
+
+
+class OutputFileIndex:
+    """Index of the files in output directories by the [video ID] in their names"""
+    ID_PATTERN = re.compile(r'\[([a-zA-Z0-9_-]{11})\]')
+    
+    def __init__(self):
+        self.dirs = {}  # directory -> (mtime, {video_id: [paths]})
+        self.lock = threading.Lock()
+    
+    def lookup(self, output_dir, video_id):
+        """Return the finished files of a video in output_dir, rescanning it only when it has changed"""
+        try:
+            mtime = os.stat(output_dir).st_mtime_ns
+        except OSError:
+            return []
+        with self.lock:
+            entry = self.dirs.get(output_dir)
+            if entry is None or entry[0] != mtime:
+                entry = (mtime, self.scan(output_dir))
+                self.dirs[output_dir] = entry
+            return list(entry[1].get(video_id, []))
+    
+    def scan(self, output_dir):
+        files = {}
+        try:
+            with os.scandir(output_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(('.part', '.ytdl', '.temp')) or not entry.is_file():
+                        continue
+                    for video_id in self.ID_PATTERN.findall(entry.name):
+                        files.setdefault(video_id, []).append(entry.path)
+        except OSError as e:
+            print(f"Error scanning {output_dir}: {e}")
+        return files
+
+
+class DuplicateFinder:
+    """Finds an existing file of a video from the download history and the output directory"""
+    AUDIO_EXTENSIONS = ('mp3', 'm4a', 'opus', 'ogg', 'aac', 'flac', 'wav')
+    
+    def __init__(self, db_manager, file_index=None):
+        self.db_manager = db_manager
+        self.file_index = file_index or OutputFileIndex()
+    
+    def find(self, url, output_dir, quality):
+        """Return {'path', 'video_info'} of an existing download of the same kind (audio or video), or None"""
+        video_id = get_video_id(url)
+        if not video_id:
+            return None
+        audio = quality == "audio_only"
+        for title, uploader, duration, view_count, row_quality, output_path in self.db_manager.find_downloads(video_id):
+            # History paths of moved or deleted files don't count
+            if (row_quality == "audio_only") == audio and output_path and os.path.isfile(output_path):
+                return {'path': output_path, 'video_info': {
+                    'title': title, 'uploader': uploader, 'duration': duration, 'view_count': view_count
+                }}
+        for path in self.file_index.lookup(output_dir, video_id):
+            if (os.path.splitext(path)[1][1:].lower() in self.AUDIO_EXTENSIONS) == audio:
+                title = self.file_index.ID_PATTERN.sub('', os.path.splitext(os.path.basename(path))[0]).strip()
+                return {'path': path, 'video_info': {'title': title}}
+        return None
+
+
+class ThumbnailCache:
+    """Disk and memory cache of thumbnail images shared by the GUI and the embed postprocessor
+
+    The files on disk are kept under max_bytes by removing the least recently used ones.
+    """
+    
+    def __init__(self, cache_dir="thumbnail_cache", memory_items=64, timeout=10, max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # path -> [lock, number of threads using it]; removed when the last one is done
+        self.key_locks = {}
+        self._session = None
+        os.makedirs(cache_dir, exist_ok=True)
+        # Size of each file on disk, least recently used first
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        # video ID -> path of its newest thumbnail, so history rows find it without listing the directory
+        self.video_files = {}
+        self.scan()
+    
+    def scan(self):
+        """Index the files left by earlier runs, least recently used first"""
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.path, stat.st_size))
+        except OSError as e:
+            print(f"Error scanning thumbnail cache: {e}")
+        with self.lock:
+            for mtime, path, size in sorted(entries):
+                self.files[path] = size
+                self.total_bytes += size
+                video_id = self.video_id_of(path)
+                if video_id:
+                    self.video_files[video_id] = path
+    
+    def video_id_of(self, path):
+        """The video ID in a file name from path_for, or None"""
+        video_id, separator, digest = os.path.splitext(os.path.basename(path))[0].rpartition('-')
+        return video_id if separator else None
+    
+    def touch(self, path):
+        """Mark a file as used; its modification time carries the order over to the next run"""
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    
+    def add_file(self, path, size):
+        """Account for a new file and remove the least recently used ones over max_bytes"""
+        evicted = []
+        with self.lock:
+            self.total_bytes += size - self.files.pop(path, 0)
+            self.files[path] = size
+            video_id = self.video_id_of(path)
+            if video_id:
+                self.video_files[video_id] = path
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                old_path, old_size = self.files.popitem(last=False)
+                self.total_bytes -= old_size
+                self.memory.pop(old_path, None)
+                old_video_id = self.video_id_of(old_path)
+                if self.video_files.get(old_video_id) == old_path:
+                    del self.video_files[old_video_id]
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    
+    @property
+    def session(self):
+        """Pooled HTTP session, created on first use so headless callers don't import requests"""
+        with self.lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+            return self._session
+    
+    def path_for(self, url, video_id=None):
+        """Cache file for a thumbnail URL; the video ID prefix lets history rows find it"""
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        name = f"{video_id}-{digest}" if video_id else digest
+        return os.path.join(self.cache_dir, f"{name}.{determine_ext(url, 'jpg')}")
+    
+    def remember(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+    
+    def get(self, url, video_id=None):
+        """Return the image data for a thumbnail URL, downloading it only once"""
+        path = self.path_for(url, video_id)
+        with self.lock:
+            if path in self.memory:
+                self.memory.move_to_end(path)
+                if path in self.files:
+                    self.files.move_to_end(path)
+                REGISTRY.inc('downloader_cache_requests_total', cache='thumbnail', result='hit')
+                return self.memory[path]
+            entry = self.key_locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        
+        # Concurrent requests for the same thumbnail wait for the first download
+        try:
+            with entry[0]:
+                data = self.load(url, path)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[path]
+        if data is not None:
+            self.remember(path, data)
+        return data
+    
+    def load(self, url, path):
+        """Read a thumbnail from disk or download it into the cache; None on errors"""
+        try:
+            if os.path.exists(path):
+                REGISTRY.inc('downloader_cache_requests_total', cache='thumbnail', result='hit')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.touch(path)
+            else:
+                REGISTRY.inc('downloader_cache_requests_total', cache='thumbnail', result='miss')
+                started = time.monotonic()
+                response = self.session.get(url, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.content
+                REGISTRY.observe('downloader_phase_seconds', time.monotonic() - started, phase='thumbnail')
+                temp_path = path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self.add_file(path, len(data))
+            return data
+        except Exception as e:
+            print(f"Error loading thumbnail: {e}")
+            return None
+    
+    def find(self, video_id):
+        """Return a cached thumbnail of a video without going to the network"""
+        if not video_id:
+            return None
+        with self.lock:
+            path = self.video_files.get(video_id)
+            if path is None:
+                return None
+            if path in self.memory:
+                return self.memory[path]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.touch(path)
+        self.remember(path, data)
+        return data
+    
+    def copy_to(self, url, target, video_id=None):
+        """Write a thumbnail to target, fetching it into the cache first if needed"""
+        data = self.get(url, video_id)
+        if data is None:
+            return False
+        # Written from memory, as the cache file may have been evicted already
+        with open(target, 'wb') as f:
+            f.write(data)
+        return True
+
+
+def get_stream_expiry(info_dict):
+    """Return the earliest expiry timestamp of the stream URLs in an info dict, if any"""
+    expiries = []
+    for fmt in info_dict.get('formats') or []:
+        for key in ('url', 'manifest_url', 'fragment_base_url'):
+            url = fmt.get(key)
+            if not url:
+                continue
+            # Progressive URLs carry ?expire=..., DASH/HLS manifests use /expire/.../
+            expire = parse_qs(urlparse(url).query).get('expire', [None])[0]
+            if expire is None:
+                match = re.search(r'/expire/(\d+)', url)
+                expire = match.group(1) if match else None
+            if expire and expire.isdigit():
+                expiries.append(int(expire))
+    return min(expiries) if expiries else None
+
+
+def streams_expiring(info_dict):
+    """Whether the stream URLs of an info dict expire within MetadataCache.EXPIRY_MARGIN"""
+    return (get_stream_expiry(info_dict) or math.inf) < time.time() + MetadataCache.EXPIRY_MARGIN
+
+
+class MetadataCache:
+    """On-disk cache of extract_info results keyed by video ID, with TTL and LRU eviction"""
+    # Stream URLs are considered stale this many seconds before they actually expire
+    EXPIRY_MARGIN = 300
+    
+    def __init__(self, db_path="metadata_cache.db", ttl=6 * 3600, max_entries=500):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.init_database()
+    
+    def init_database(self):
+        """Create the cache table if it doesn't exist"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS metadata_cache (
+                        video_id TEXT PRIMARY KEY,
+                        info_json TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL,
+                        expires_at REAL
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_metadata_cache_last_access ON metadata_cache (last_access)')
+                conn.commit()
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Metadata cache initialization error: {e}")
+    
+    def get(self, video_id):
+        """Return the cached info dict for a video, or None if missing, too old or expired"""
+        if not video_id:
+            return None
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT info_json, created_at, expires_at FROM metadata_cache WHERE video_id = ?
+                ''', (video_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                info_json, created_at, expires_at = row
+                now = time.time()
+                if now - created_at > self.ttl or (expires_at and now > expires_at - self.EXPIRY_MARGIN):
+                    cursor.execute('DELETE FROM metadata_cache WHERE video_id = ?', (video_id,))
+                    conn.commit()
+                    return None
+                cursor.execute('UPDATE metadata_cache SET last_access = ? WHERE video_id = ?', (now, video_id))
+                conn.commit()
+                return json.loads(info_json)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error reading metadata cache: {e}")
+            return None
+    
+    def put(self, video_id, info_dict):
+        """Store an info dict and evict the least recently used entries over the size cap"""
+        if not video_id or not info_dict:
+            return
+        try:
+            info_json = json.dumps(yt_dlp.YoutubeDL.sanitize_info(info_dict), default=str)
+            now = time.time()
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO metadata_cache
+                    (video_id, info_json, created_at, last_access, expires_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (video_id, info_json, now, now, get_stream_expiry(info_dict)))
+                cursor.execute('''
+                    DELETE FROM metadata_cache WHERE video_id IN (
+                        SELECT video_id FROM metadata_cache
+                        ORDER BY last_access DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+                conn.commit()
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error writing metadata cache: {e}")
+    
+    def invalidate(self, video_id):
+        """Drop a cached entry, e.g. after its stream URLs were rejected"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM metadata_cache WHERE video_id = ?', (video_id,))
+                conn.commit()
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error invalidating metadata cache: {e}")
+
+
+# Fields of a yt-dlp progress dict that are passed on to progress listeners
+PROGRESS_FIELDS = ('status', 'filename', 'tmpfilename', 'fragment_index', 'fragment_count')
+
+
+class RateEstimator:
+    """Job-wide progress, speed and ETA over all streams of a download and its post-processing
+
+    The speed is an exponentially weighted moving average of the rate measured over a
+    sliding window of recent samples, so it follows changes in throughput without
+    jumping around on every callback.
+    """
+    # Seconds of samples used to measure the current rate
+    WINDOW = 5.0
+    # Time constant of the moving average in seconds
+    TIME_CONSTANT = 8.0
+    # Rough ffmpeg throughput used to predict post-processing time
+    COPY_RATE = 150 * 1024 * 1024
+    TRANSCODE_SPEED = 40.0
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.expected_sizes = []
+        self.streams = {}
+        self.samples = deque()
+        self.rate = None
+        self.rate_time = None
+        self.postprocess_seconds = 0.0
+        self.postprocess_started = None
+        self.postprocess_steps = 0
+        self.postprocess_done = 0
+
+    def set_plan(self, sizes, copies=0, transcode_duration=0):
+        """Set the expected stream sizes and the post-processing work that follows them"""
+        self.expected_sizes = list(sizes)
+        total = sum(size for size in self.expected_sizes if size)
+        self.postprocess_seconds = copies * total / self.COPY_RATE + transcode_duration / self.TRANSCODE_SPEED
+
+    @property
+    def phase(self):
+        return 'postprocessing' if self.postprocess_started is not None else 'downloading'
+
+    def update_stream(self, key, downloaded, total, speed_hint=None, estimated=False):
+        """Record the progress of one stream; estimated totals give way to the planned size"""
+        now = self.clock()
+        if key not in self.streams:
+            # A new (or resumed) stream restarts the window so its offset isn't counted as speed
+            self.samples.clear()
+            index = len(self.streams)
+        else:
+            index = list(self.streams).index(key)
+            # Concurrent fragment workers may report out of order
+            downloaded = max(downloaded, self.streams[key][0])
+        if estimated and index < len(self.expected_sizes) and self.expected_sizes[index]:
+            total = self.expected_sizes[index]
+        self.streams[key] = (downloaded, max(total, downloaded))
+        done = self.downloaded_bytes
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.WINDOW:
+            self.samples.popleft()
+
+        start_time, start_bytes = self.samples[0]
+        if now - start_time >= 0.5:
+            current = (done - start_bytes) / (now - start_time)
+            if self.rate is None:
+                self.rate = current
+            else:
+                alpha = 1 - math.exp(-(now - self.rate_time) / self.TIME_CONSTANT)
+                self.rate += alpha * (current - self.rate)
+            self.rate_time = now
+        elif self.rate is None and speed_hint:
+            self.rate = speed_hint
+            self.rate_time = now
+
+    def start_postprocessing(self, steps=0):
+        """Enter the post-processing phase; steps is the number of postprocessors, if known"""
+        if self.postprocess_started is None:
+            self.postprocess_started = self.clock()
+        self.postprocess_steps = max(self.postprocess_steps, steps)
+
+    def postprocessor_finished(self):
+        self.postprocess_done += 1
+
+    @property
+    def postprocess_percent(self):
+        """Progress of the post-processing phase from its predicted time and the steps finished"""
+        by_time = (self.clock() - self.postprocess_started) / self.postprocess_seconds * 100 \
+            if self.postprocess_seconds else 0.0
+        by_steps = self.postprocess_done / self.postprocess_steps * 100 if self.postprocess_steps else 0.0
+        # Only the end of the last step means done
+        return min(max(by_time, by_steps), 99.0)
+
+    @property
+    def downloaded_bytes(self):
+        return sum(downloaded for downloaded, total in self.streams.values())
+
+    @property
+    def total_bytes(self):
+        seen = sum(total for downloaded, total in self.streams.values())
+        # yt-dlp downloads the requested formats in order, so the unseen ones are at the end
+        unseen = sum(size or 0 for size in self.expected_sizes[len(self.streams):])
+        return seen + unseen
+
+    @property
+    def percent(self):
+        if self.phase == 'postprocessing':
+            return self.postprocess_percent
+        total = self.total_bytes
+        return min(self.downloaded_bytes / total * 100, 100.0) if total else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds until the job is done, or None while there is no rate yet"""
+        if self.phase == 'postprocessing':
+            return max(self.postprocess_seconds - (self.clock() - self.postprocess_started), 0.0)
+        if not self.rate:
+            return None
+        remaining = max(self.total_bytes - self.downloaded_bytes, 0)
+        return remaining / self.rate + self.postprocess_seconds
+
+
+class ProgressThrottle:
+    """Limits a progress callback to max_rate calls per second
+
+    Updates arriving faster are coalesced: the newest one is kept and passed on by a timer
+    when the interval is over, so the last value always arrives; intermediate ones are dropped.
+    """
+
+    def __init__(self, callback, max_rate=4.0):
+        self.callback = callback
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.last_emit = 0
+        # Arguments of the newest update held back, and the timer that passes them on
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+        # Keeps the callbacks in order between the caller's threads and the timer
+        self.emit_lock = threading.Lock()
+
+    def update(self, *args, force=False):
+        """Pass the value on if the interval has elapsed (or force is set), otherwise once it has"""
+        with self.emit_lock:
+            with self.lock:
+                now = time.monotonic()
+                if not force and now - self.last_emit < self.interval:
+                    self.pending = args
+                    if self.timer is None:
+                        self.timer = threading.Timer(self.last_emit + self.interval - now, self.emit_pending)
+                        self.timer.daemon = True
+                        self.timer.start()
+                    return
+                self.last_emit = now
+                self.pending = None
+            self.callback(*args)
+
+    def emit_pending(self):
+        with self.emit_lock:
+            with self.lock:
+                args, self.pending = self.pending, None
+                self.timer = None
+                if args is None:
+                    return
+                self.last_emit = time.monotonic()
+            self.callback(*args)
+
+    def flush(self):
+        """Pass on a held back update now; nothing is called after this returns until the next update"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.emit_pending()
+
+
+class FormatRecorder(PostProcessor):
+    """Reports the selected formats before the download starts"""
+
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+
+    def run(self, info):
+        self.callback(info)
+        return [], info
+
+
+class CachedThumbnailWriter(PostProcessor):
+    """Puts the cached thumbnail where yt-dlp would write it, so writethumbnail doesn't download it again"""
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def run(self, info):
+        thumbnails = info.get('thumbnails') or []
+        # yt-dlp writes the last (best) thumbnail next to the temporary file name
+        if thumbnails and thumbnails[-1].get('url'):
+            url = thumbnails[-1]['url']
+            filename = self._downloader.prepare_filename(info, 'temp')
+            target = replace_extension(filename, determine_ext(url, 'jpg'), info.get('ext'))
+            if filename and not os.path.exists(target):
+                try:
+                    self.cache.copy_to(url, target, info.get('id'))
+                except OSError as e:
+                    print(f"Error copying cached thumbnail: {e}")
+        return [], info
+
+
+class FragmentConcurrency:
+    """Fragment workers per host for DASH/HLS downloads
+
+    Works like TCP congestion control: when a server throttles a job (fragment or HTTP
+    retries) the next jobs on that host use half as many workers, and every job that
+    finishes without being throttled adds one back, up to max_workers.
+    """
+    # Retry delays: base * 2**attempt seconds with full jitter, capped at MAX_DELAY
+    BASE_DELAY = 1.0
+    MAX_DELAY = 30.0
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def set_max_workers(self, max_workers):
+        with self.lock:
+            self.max_workers = max(1, max_workers)
+            for host in self.workers:
+                self.workers[host] = min(self.workers[host], self.max_workers)
+
+    def workers_for(self, host):
+        with self.lock:
+            return self.workers.get(host, self.max_workers)
+
+    def throttled(self, host):
+        with self.lock:
+            self.workers[host] = max(1, self.workers.get(host, self.max_workers) // 2)
+            print(f'[DEBUG] {host} is throttling, using {self.workers[host]} fragment worker(s)')
+
+    def succeeded(self, host):
+        with self.lock:
+            if host in self.workers:
+                self.workers[host] = min(self.workers[host] + 1, self.max_workers)
+
+    def retry_delay(self, attempt):
+        return random.uniform(0, min(self.BASE_DELAY * 2 ** attempt, self.MAX_DELAY))
+
+
+def error_chain(error):
+    """The error and what caused it; yt-dlp wraps the original exception in DownloadError and ExtractorError"""
+    errors = []
+    while isinstance(error, BaseException) and len(errors) < 10 and not any(error is e for e in errors):
+        errors.append(error)
+        exc_info = getattr(error, 'exc_info', None)
+        error = (exc_info[1] if exc_info else None) or getattr(error, 'cause', None) or error.__cause__ or \
+            error.__context__
+    return errors
+
+
+def classify_error(error):
+    """Return which of ERROR_CLASSES a failed download belongs to"""
+    errors = error_chain(error)
+    for e in errors:
+        # yt-dlp's HTTPError has a status, urllib's a code
+        status = getattr(e, 'status', None) or getattr(e, 'code', None)
+        if status in (403, 410):
+            return 'expired'
+        if status in (429, 503):
+            return 'throttled'
+        if isinstance(e, (TimeoutError, ConnectionError)):
+            return 'network'
+        if isinstance(e, PostProcessingError):
+            return 'ffmpeg'
+    message = ' '.join(str(e) for e in errors)
+    for kind, pattern in ERROR_PATTERNS:
+        if pattern.search(message):
+            return kind
+    extractor_errors = [e for e in errors if isinstance(e, ExtractorError)]
+    if extractor_errors:
+        # Expected errors are the ones yt-dlp explains to the user, such as a video needing a login
+        return 'unavailable' if all(e.expected for e in extractor_errors) else 'extractor'
+    return 'unknown'
+
+
+def get_retry_after(error):
+    """Seconds a throttling server asked to wait in its Retry-After header, if it did"""
+    for e in error_chain(error):
+        headers = getattr(getattr(e, 'response', None), 'headers', None) or getattr(e, 'headers', None)
+        value = headers.get('Retry-After') if hasattr(headers, 'get') else None
+        if value and str(value).strip().isdigit():
+            return int(value)
+    return None
+
+
+class RetryPolicy:
+    """When a failed job is tried again
+
+    Each class of ERROR_CLASSES has its own number of retries and base delay, doubled for
+    every further attempt and capped at max_delay. The delay is drawn between half and all
+    of that so jobs that failed together (a dropped connection, a throttling server) don't
+    all come back at once, and a longer Retry-After from the server wins.
+    """
+
+    def __init__(self, max_retries=5, max_delay=600):
+        # Upper bound of the retries of any class; 0 never retries
+        self.max_retries = max_retries
+        self.max_delay = max_delay
+
+    def retries_for(self, kind):
+        return min(ERROR_CLASSES.get(kind, ERROR_CLASSES['unknown'])[0], self.max_retries)
+
+    def delay(self, kind, attempt, retry_after=None):
+        """Seconds before retry number attempt (counting from 1), or None when the job should fail"""
+        if attempt > self.retries_for(kind):
+            return None
+        delay = min(ERROR_CLASSES.get(kind, ERROR_CLASSES['unknown'])[1] * 2 ** (attempt - 1), self.max_delay)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class TokenBucket:
+    """Allows rate bytes per second on average, with bursts of up to burst seconds' worth
+
+    Readers take what they have just read and sleep for the returned delay, so the bucket
+    goes into debt by at most one read per reader. No rate means no limit. Not thread
+    safe on its own; BandwidthScheduler guards its buckets with a lock.
+    """
+
+    def __init__(self, rate=None, burst=1.0, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = rate * burst if rate else 0
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * self.burst)
+        self.updated = now
+
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * self.burst) if rate else 0
+
+    def take(self, size):
+        """Take size bytes; returns the seconds to wait before reading more"""
+        self.refill()
+        if not self.rate:
+            return 0
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+def share_bandwidth(limit, demands):
+    """Divide limit among {key: (weight, cap)} in proportion to the weights
+
+    Keys whose cap is below their proportional share get their cap, and what they leave
+    is divided among the rest (weighted max-min fairness). A cap of None means no cap;
+    no limit gives every key its cap.
+    """
+    if not limit:
+        return {key: cap for key, (weight, cap) in demands.items()}
+    rates = {}
+    remaining = dict(demands)
+    budget = limit
+    while remaining:
+        total_weight = sum(weight for weight, cap in remaining.values())
+        capped = [key for key, (weight, cap) in remaining.items()
+                  if cap is not None and cap <= budget * weight / total_weight]
+        if not capped:
+            for key, (weight, cap) in remaining.items():
+                rates[key] = budget * weight / total_weight
+            break
+        for key in capped:
+            rates[key] = remaining.pop(key)[1]
+            budget -= rates[key]
+    return rates
+
+
+class BandwidthScheduler:
+    """Token-bucket rate limiting shared by all running downloads
+
+    The global limit, or that of the time-of-day profile in effect, is divided among the
+    running jobs in proportion to their priority. A job never gets more than its own
+    limit, and bandwidth a job leaves unused - because of its limit or a slow server - goes
+    to the others. Shares are recomputed every REBALANCE_INTERVAL seconds and whenever a
+    setting changes, so new limits apply to running downloads without restarting them.
+    """
+    REBALANCE_INTERVAL = 1.0
+    # Lowest rate offered to a job that isn't using its share
+    MIN_RATE = 16 * 1024
+
+    def __init__(self, limit=None, profiles=None, clock=time.monotonic, now=datetime.now):
+        self.limit = limit
+        self.profiles = list(profiles or [])
+        self.clock = clock
+        self.now = now
+        self.jobs = {}
+        self.current_limit = limit
+        self.last_measure = clock()
+        self.lock = threading.Lock()
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+            self.rebalance()
+
+    def set_profiles(self, profiles):
+        with self.lock:
+            self.profiles = list(profiles)
+            self.rebalance()
+
+    def effective_limit(self):
+        """The limit of the first profile covering the current time, else the global limit"""
+        now = self.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.profiles:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.limit
+
+    def add_job(self, job_id, priority="normal", rate_limit=None):
+        with self.lock:
+            self.jobs[job_id] = {
+                'priority': priority,
+                'limit': rate_limit,
+                'bucket': TokenBucket(clock=self.clock),
+                'rate': None,
+                # Rate the job has shown it can use, None while it uses its whole share
+                'demand': None,
+                'used': 0,
+                'waited': False
+            }
+            self.rebalance()
+
+    def update_job(self, job_id, **settings):
+        """Change a running job's 'priority' and/or 'rate_limit'"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            if 'priority' in settings:
+                job['priority'] = settings['priority']
+            if 'rate_limit' in settings:
+                job['limit'] = settings['rate_limit']
+            self.rebalance()
+
+    def remove_job(self, job_id):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is not None:
+                self.rebalance()
+
+    def measure(self):
+        """Update each job's demand from what it read since the last measurement"""
+        now = self.clock()
+        elapsed = now - self.last_measure
+        self.last_measure = now
+        for job in self.jobs.values():
+            # A job that never had to wait didn't need all of its share; offer it a bit more than it
+            # used and let the others have the rest. Once it has to wait it gets a full share again.
+            if job['rate'] and not job['waited']:
+                job['demand'] = max(job['used'] / elapsed * 1.25, self.MIN_RATE)
+            else:
+                job['demand'] = None
+            job['used'] = 0
+            job['waited'] = False
+
+    def rebalance(self):
+        """Recompute every job's rate; called with the lock held"""
+        self.current_limit = self.effective_limit()
+        demands = {}
+        for job_id, job in self.jobs.items():
+            cap = job['limit']
+            if self.current_limit and job['demand'] is not None:
+                cap = job['demand'] if cap is None else min(cap, job['demand'])
+            demands[job_id] = (PRIORITIES.get(job['priority'], PRIORITIES['normal']), cap)
+        for job_id, rate in share_bandwidth(self.current_limit, demands).items():
+            self.jobs[job_id]['rate'] = rate
+            self.jobs[job_id]['bucket'].set_rate(rate)
+
+    def consume(self, job_id, size, cancelled=lambda: False):
+        """Account for size bytes a job has read, sleeping while the job is over its rate"""
+        with self.lock:
+            if self.clock() - self.last_measure >= self.REBALANCE_INTERVAL:
+                self.measure()
+                self.rebalance()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job['used'] += size
+            delay = job['bucket'].take(size)
+            if delay:
+                job['waited'] = True
+        # Sleep in short steps so a cancelled download doesn't wait out a long delay
+        deadline = time.monotonic() + delay
+        while delay > 0 and not cancelled():
+            time.sleep(min(delay, 0.25))
+            delay = deadline - time.monotonic()
+
+    def rate_for(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job['rate'] if job else None
+
+    def status(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'effective_limit': self.effective_limit(),
+                'profiles': format_bandwidth_profiles(self.profiles),
+                'jobs': {job_id: {'priority': job['priority'], 'rate_limit': job['limit'], 'rate': job['rate']}
+                         for job_id, job in self.jobs.items()}
+            }
+
+
+# Job options holding callables, which can't be sent to a post-processing worker
+LOCAL_OPTIONS = ('progress_hooks', 'postprocessor_hooks', 'retry_sleep_functions')
+
+# Set in each post-processing worker process by init_post_processing_worker; post_processing_key is
+# the pool's key of the job the worker is running
+post_processing_events = None
+post_processing_key = None
+
+
+class ReportingPopen(Popen):
+    """Popen of yt-dlp's ffmpeg postprocessors in the workers; reports the processes so a cancelled job can kill them"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        post_processing_events.put((post_processing_key, 'process_started', self.pid))
+
+    def __exit__(self, *args):
+        try:
+            return super().__exit__(*args)
+        finally:
+            post_processing_events.put((post_processing_key, 'process_finished', self.pid))
+
+
+def kill_process(pid):
+    try:
+        # TerminateProcess on Windows
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def init_post_processing_worker(events):
+    global post_processing_events
+    post_processing_events = events
+    ffmpeg_postprocessors.Popen = ReportingPopen
+
+
+def run_post_processing(key, params, filename, info, files_to_move, pp_keys):
+    """Worker process side of PostProcessingPool; returns the info dict after post-processing"""
+    global post_processing_key
+    post_processing_key = key
+
+    def hook(d):
+        if post_processing_events is not None:
+            post_processing_events.put((key, d['status'], d.get('postprocessor')))
+
+    with yt_dlp.YoutubeDL(dict(params, postprocessor_hooks=[hook])) as ydl:
+        # Merging and fixups are added by yt-dlp during the download; rebuild them for this YoutubeDL
+        info['__postprocessors'] = [get_postprocessor(pp_key)(ydl) for pp_key in pp_keys]
+        info = ydl.post_process(filename, info, files_to_move)
+        info.pop('__postprocessors', None)
+        return yt_dlp.YoutubeDL.sanitize_info(info)
+
+
+class PostProcessingPool:
+    """Runs yt-dlp's post-processing of downloaded files on a pool of worker processes
+
+    Merging, fixups, MP3 conversion and thumbnail embedding can take as long as the
+    download itself. Handing them to the pool lets a job give its download slot to the
+    next one, and several jobs are post-processed in parallel. Workers are started on
+    first use; postprocessor hooks in the workers are relayed back to each job's listener.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.executor = None
+        self.events = None
+        self.listeners = {}
+        # Keys of the jobs whose ffmpeg processes are running, with their PIDs, and of the cancelled jobs
+        self.processes = {}
+        self.cancelled = set()
+        self.next_key = 1
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Create the worker pool; called with the lock held"""
+        # spawn behaves the same on every platform and doesn't fork the download threads
+        context = multiprocessing.get_context('spawn')
+        if self.events is None:
+            self.events = context.Queue()
+            threading.Thread(target=self.relay_events, daemon=True).start()
+        self.executor = ProcessPoolExecutor(self.max_workers, mp_context=context,
+                                            initializer=init_post_processing_worker, initargs=(self.events,))
+
+    def submit(self, params, filename, info, files_to_move, pp_keys, listener=None):
+        """Post-process a download; returns a Future of the final info dict
+
+        listener(status, postprocessor) is called from a relay thread for every postprocessor
+        hook of the job.
+        """
+        with self.lock:
+            key = self.next_key
+            self.next_key += 1
+            if listener:
+                self.listeners[key] = listener
+            if self.executor is None:
+                self.start()
+            try:
+                future = self.executor.submit(run_post_processing, key, params, filename, info, files_to_move,
+                                              pp_keys)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed); replace the pool instead of failing every later job
+                print('[DEBUG] Post-processing pool is broken, restarting it')
+                REGISTRY.inc('downloader_retries_total', kind='post_processing_pool')
+                self.start()
+                future = self.executor.submit(run_post_processing, key, params, filename, info, files_to_move,
+                                              pp_keys)
+        future.key = key
+        future.add_done_callback(lambda f: self.forget(key))
+        return future
+
+    def forget(self, key):
+        with self.lock:
+            self.listeners.pop(key, None)
+            self.processes.pop(key, None)
+            self.cancelled.discard(key)
+
+    def cancel(self, future):
+        """Stop a job's post-processing: a waiting one is dropped, a running one has its ffmpeg killed
+
+        The worker then fails the job and moves on to the next one.
+        """
+        if future.cancel():
+            return
+        with self.lock:
+            self.cancelled.add(future.key)
+            pids = list(self.processes.get(future.key, ()))
+        for pid in pids:
+            kill_process(pid)
+
+    def track_process(self, key, status, pid):
+        with self.lock:
+            if status == 'process_finished':
+                self.processes.get(key, set()).discard(pid)
+                return
+            self.processes.setdefault(key, set()).add(pid)
+            cancelled = key in self.cancelled
+        # Started after the job was cancelled, between two postprocessors
+        if cancelled:
+            kill_process(pid)
+
+    def relay_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            key, status, postprocessor = event
+            if status in ('process_started', 'process_finished'):
+                self.track_process(key, status, postprocessor)
+                continue
+            listener = self.listeners.get(key)
+            if listener:
+                try:
+                    listener(status, postprocessor)
+                except Exception as e:
+                    import traceback
+                    traceback.print_exc()
+                    print(f"Error in post-processing listener: {e}")
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+            if self.events is not None:
+                self.events.put(None)
+                self.events = None
+
+
+class MetadataPrefetcher:
+    """Extracts the info of the next queued jobs on a few threads while the running jobs download
+
+    A job that gets a slot takes the result from its prefetch_future, so it starts transferring
+    right away instead of extracting first. Results whose stream URLs expire before the job starts
+    are extracted again by the job.
+    """
+
+    def __init__(self, depth=2, max_workers=2):
+        # Number of queued jobs, from the head of the queue, extracted ahead
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+
+    def prefetch(self, jobs):
+        """Start extracting the first depth of jobs unless they have been extracted already"""
+        for job in islice(jobs, self.depth):
+            if job.prefetch_future is None and job.info_dict is None and not job.cancelled:
+                job.prefetch_future = self.executor.submit(self.extract, job)
+
+    def extract(self, job):
+        # Closed afterwards like the job's own YoutubeDL, releasing its HTTP sessions and cookie jar
+        with job.backend.create_ydl({
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+            'socket_timeout': DownloadJob.SOCKET_TIMEOUT
+        }) as ydl:
+            return job.prefetch(ydl)
+
+
+def response_socket(response):
+    """The socket a yt-dlp response reads from, or None for request handlers that don't expose one
+
+    urllib's responses wrap http.client's; requests' wrap urllib3's, which wraps http.client's.
+    """
+    fp = getattr(response, 'fp', None)
+    fp = getattr(fp, '_fp', fp)
+    raw = getattr(getattr(fp, 'fp', None), 'raw', None)
+    sock = getattr(raw, '_sock', None)
+    return sock if isinstance(sock, socket.socket) else None
+
+
+class DownloadJob:
+    """A single download; runs the yt-dlp extraction and transfer for one URL"""
+    # Seconds without data before a connection is given up; a cancelled job shuts its connections down instead
+    SOCKET_TIMEOUT = 20
+
+    def __init__(self, job_id, url, output_dir, quality="best", metadata_cache=None, format_id=None, active_id=None,
+                 thumbnail_cache=None, duplicate_finder=None, duplicate_policy="skip", fragment_concurrency=None,
+                 backend=None, bandwidth=None, priority="normal", rate_limit=None, post_processing_pool=None,
+                 format_policy=None, audio_format="original"):
+        self.job_id = job_id
+        self.url = url
+        self.output_dir = output_dir
+        self.quality = quality
+        self.metadata_cache = metadata_cache
+        self.thumbnail_cache = thumbnail_cache
+        # What to do when the video was downloaded before: "skip", "link" into output_dir or "download" again
+        self.duplicate_finder = duplicate_finder
+        self.duplicate_policy = duplicate_policy
+        self.duplicate = False
+        self.fragment_concurrency = fragment_concurrency or FragmentConcurrency(1)
+        # Ranks the extracted formats; without one yt-dlp picks by FORMAT_MAPPING
+        self.format_policy = format_policy
+        # Output of audio_only downloads, one of AUDIO_FORMATS
+        self.audio_format = audio_format
+        # Fetches the chosen formats: yt-dlp itself, the segmented engine or an external program
+        self.backend = backend or DownloadBackend()
+        # Shared BandwidthScheduler; priority and rate_limit (bytes per second) are this job's settings
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.rate_limit = rate_limit
+        # Bytes received so far per stream, to charge the bandwidth for each progress callback
+        self.received = {}
+        self.ydl = None
+        # With a PostProcessingPool the post-processing yt-dlp would run after the download is
+        # recorded in deferred as (filename, info, files_to_move) and run by finish_post_processing
+        self.post_processing_pool = post_processing_pool
+        self.options = None
+        self.deferred = None
+        self.post_processing_future = None
+        # Files this job has written to: .part files, finished streams waiting to be merged, temporary
+        # files of the post-processing. A cancelled job removes them.
+        self.partial_files = set()
+        self.throttled = False
+        # yt-dlp calls the progress hook from every fragment worker
+        self.progress_lock = threading.Lock()
+        # Sockets of the job's HTTP responses, shut down by cancel() to interrupt blocked reads
+        self.sockets = weakref.WeakSet()
+        self.socket_lock = threading.Lock()
+        # Exact format IDs to download, used when resuming so the same .part files are continued
+        self.format_id = format_id
+        # Row id in the active_jobs table
+        self.active_id = active_id
+        self.host = (urlparse(url).hostname or '').lower()
+        self.status = 'queued'
+        self.message = ''
+        self.cancelled = False
+        # Set for a job stopped because the program exits: its partial files stay to be resumed
+        self.keep_files = False
+        self.video_info = {}
+        self.output_path = ""  # Add this to track the actual output file path
+        self.estimator = RateEstimator()
+        # Phase timings, counters and the structured log of this job; stream_offsets holds
+        # the bytes each stream had when this run started it
+        self.trace = JobTrace(job_id)
+        self.stream_offsets = {}
+        self.queued_at = self.trace.created
+        # Retries so far, and the class (one of ERROR_CLASSES) and Retry-After of the last failure
+        self.attempt = 0
+        self.error_kind = None
+        self.retry_after = None
+        # Without a metadata cache a retry reuses the failed attempt's extraction, kept here
+        self.info_dict = None
+        # Extraction started by the MetadataPrefetcher while the job was queued
+        self.prefetch_future = None
+        self.selected_format = None
+        self.progress_callback = None
+        self.thumbnail_callback = None
+        self.format_callback = None
+
+    def build_options(self):
+        """Build the yt-dlp options for this job's quality"""
+        options = self.build_format_options()
+        options.update({
+            # DASH/HLS fragments are fetched by several workers at once
+            'concurrent_fragment_downloads': self.fragment_concurrency.workers_for(self.host),
+            'fragment_retries': 10,
+            'socket_timeout': self.SOCKET_TIMEOUT,
+            # yt-dlp calls these as func(n=attempt)
+            'retry_sleep_functions': {
+                'http': lambda n: self.retry_delay(n, 'http'),
+                'fragment': lambda n: self.retry_delay(n, 'fragment')
+            }
+        })
+        rate = self.bandwidth.rate_for(self.job_id) if self.bandwidth else None
+        if rate:
+            options['ratelimit'] = int(rate)
+        return options
+
+    def build_format_options(self):
+        if self.quality == "audio_only":
+            return {
+                'outtmpl': os.path.join(self.output_dir, OUTPUT_TEMPLATE),
+                'progress_hooks': [self.progress_hook],
+                'postprocessor_hooks': [self.postprocessor_hook],
+                'format': self.format_id or FORMAT_MAPPING[self.quality],
+                'noplaylist': True,
+                'continuedl': True,
+                'quiet': True,
+                'no_warnings': True,
+                'postprocessors': [
+                    {
+                        'key': 'FFmpegExtractAudio',
+                        'preferredcodec': 'mp3',
+                        'preferredquality': '192',
+                    } if self.audio_format == 'mp3' else {
+                        # 'best' copies the stream: Opus moves from WebM into an .opus file, M4A is left as it is
+                        'key': 'FFmpegExtractAudio',
+                        'preferredcodec': 'best'
+                    },
+                    {
+                        'key': 'EmbedThumbnail',
+                        'already_have_thumbnail': True
+                    }
+                ]
+            }
+        return {
+            'outtmpl': os.path.join(self.output_dir, OUTPUT_TEMPLATE),
+            'progress_hooks': [self.progress_hook],
+            'postprocessor_hooks': [self.postprocessor_hook],
+            'format': self.format_id or FORMAT_MAPPING.get(self.quality, 'bestvideo+bestaudio/best'),
+            'merge_output_format': 'mp4',
+            'noplaylist': True,
+            'continuedl': True,
+            'quiet': True,
+            'no_warnings': True,
+            'writethumbnail': True,
+            'postprocessors': [{
+                'key': 'EmbedThumbnail',
+                'already_have_thumbnail': True
+            }]
+        }
+
+    def run(self):
+        """Download the video; returns (success, message)"""
+        print(f'[DEBUG] Download job {self.job_id} started')
+        self.trace.record('queue', self.trace.clock() - self.queued_at)
+        try:
+            with self.trace.phase('duplicate_check'):
+                result = self.check_duplicate()
+            if result:
+                return result
+            if self.cancelled:
+                return False, "Download cancelled"
+            self.options = self.backend.configure(self.build_options())
+            with self.backend.create_ydl(self.options, self.use_bandwidth) as ydl:
+                self.ydl = ydl
+                ydl.urlopen = self.track_requests(ydl.urlopen)
+                if self.post_processing_pool:
+                    ydl.post_process = self.defer_post_processing
+                ydl.add_post_processor(FormatRecorder(self.formats_selected), when='before_dl')
+                if self.thumbnail_cache and self.quality != "audio_only":
+                    ydl.add_post_processor(CachedThumbnailWriter(self.thumbnail_cache), when='video')
+                # 只解析一次页面：先不处理格式地提取信息，再用同一个结果下载
+                video_id = get_video_id(self.url)
+                with self.trace.phase('extract') as fields:
+                    info_dict, self.info_dict = self.info_dict, None
+                    fields['reused'] = info_dict is not None
+                    if info_dict is None:
+                        info_dict = self.take_prefetched()
+                        fields['prefetched'] = info_dict is not None
+                    if info_dict is not None and streams_expiring(info_dict):
+                        print(f'[DEBUG] Stream URLs of {video_id} expire soon, extracting again')
+                        info_dict = None
+                    if info_dict is None:
+                        info_dict, fields['cached'] = self.lookup_info(ydl, video_id)
+                    if info_dict and not self.metadata_cache:
+                        # yt-dlp changes the info dict while downloading; keep it as it was extracted
+                        self.info_dict = json.loads(json.dumps(yt_dlp.YoutubeDL.sanitize_info(info_dict), default=str))
+
+                if not info_dict:
+                    raise Exception("Failed to get video information. Please check if the URL is valid.")
+
+                self.video_info = {
+                    'title': info_dict.get('title', 'Unknown Video'),
+                    'description': info_dict.get('description', ''),
+                    'thumbnail': get_thumbnail_url(info_dict),
+                    'duration': format_duration(int(info_dict.get('duration') or 0)),
+                    'uploader': info_dict.get('uploader', 'Unknown Uploader'),
+                    'view_count': format_count(info_dict.get('view_count') or 0)
+                }
+                if self.video_info['thumbnail'] and self.thumbnail_callback:
+                    self.thumbnail_callback(self.video_info['thumbnail'])
+
+                if self.cancelled:
+                    return False, "Download cancelled"
+
+                self.select_formats(ydl, info_dict)
+                try:
+                    result = ydl.process_ie_result(info_dict, download=True)
+                except Exception as e:
+                    # Stream URLs may have been revoked early; after failures that don't say so they still work
+                    if not self.cancelled and ERROR_CLASSES[classify_error(e)][2]:
+                        self.info_dict = None
+                        if self.metadata_cache:
+                            self.metadata_cache.invalidate(video_id)
+                    raise
+                self.info_dict = None
+
+            if self.cancelled:
+                return False, "Download cancelled"
+
+            # Get the actual output file path
+            self.output_path = get_output_path(result, self.output_dir, self.video_info['title'], self.quality,
+                                               self.audio_format, (result or {}).get('id') or video_id)
+            if not self.throttled:
+                self.fragment_concurrency.succeeded(self.host)
+            return True, "Download completed!"
+
+        except Exception as e:
+            if self.cancelled:
+                return False, "Download cancelled"
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            self.error_kind = classify_error(e)
+            self.retry_after = get_retry_after(e)
+            self.trace.failed(e, self.error_kind)
+            return False, f"Error: {str(e)}"
+        finally:
+            self.ydl = None
+
+    def prepare_retry(self):
+        """Reset what the failed attempt left behind; its partial downloads are continued"""
+        self.attempt += 1
+        # The same formats continue the same .part files
+        if self.selected_format:
+            self.format_id = self.selected_format
+        self.error_kind = None
+        self.retry_after = None
+        self.deferred = None
+        self.throttled = False
+        self.received = {}
+        self.stream_offsets = {}
+        self.estimator = RateEstimator()
+        self.trace.failed_phase = None
+
+    def lookup_info(self, ydl, video_id):
+        """Return (info_dict, cached): the video's info from the metadata cache, or extracted by ydl"""
+        if self.metadata_cache:
+            info_dict = self.metadata_cache.get(video_id)
+            REGISTRY.inc('downloader_cache_requests_total', cache='metadata',
+                         result='miss' if info_dict is None else 'hit')
+            if info_dict is not None:
+                print(f'[DEBUG] Using cached info for: {video_id}')
+                return info_dict, True
+        print(f'[DEBUG] Extracting info for: {self.url}')
+        info_dict = ydl.extract_info(self.url, download=False, process=False)
+        print('[DEBUG] Video info extracted')
+        if self.metadata_cache and info_dict:
+            self.metadata_cache.put(video_id, info_dict)
+        return info_dict, False
+
+    def prefetch(self, ydl):
+        """Extract the video's info with ydl while the job is still queued; runs on a MetadataPrefetcher thread
+
+        Returns None for a job that is cancelled or will be skipped as a duplicate. An error is
+        raised again by take_prefetched, so the job fails and is retried as if it had extracted.
+        """
+        if self.cancelled:
+            return None
+        if self.duplicate_finder and self.duplicate_policy != "download" and \
+                self.duplicate_finder.find(self.url, self.output_dir, self.quality) is not None:
+            return None
+        started = self.trace.clock()
+        fields = {}
+        ydl.urlopen = self.track_requests(ydl.urlopen)
+        try:
+            info_dict, fields['cached'] = self.lookup_info(ydl, get_video_id(self.url))
+        except BaseException:
+            fields['failed'] = True
+            raise
+        finally:
+            self.trace.record('prefetch', self.trace.clock() - started, **fields)
+        return info_dict
+
+    def take_prefetched(self):
+        """Return the prefetched info dict, waiting for an extraction that is still running
+
+        Returns None if nothing was prefetched; a prefetch that hasn't started yet is cancelled.
+        """
+        future, self.prefetch_future = self.prefetch_future, None
+        if future is None or future.cancel():
+            return None
+        if not future.done():
+            print(f'[DEBUG] Waiting for the prefetched info of: {self.url}')
+        return future.result()
+
+    def select_formats(self, ydl, info_dict):
+        """Let the format policy choose from the extracted formats instead of the FORMAT_MAPPING string"""
+        if self.format_id or not self.format_policy:
+            return
+        selection = self.format_policy.select(info_dict.get('formats'), self.quality, info_dict.get('duration'))
+        if selection is None:
+            return
+        print(f'[DEBUG] Selected formats {selection["format_id"]}: {selection["description"]}')
+        # The usual selection stays as a fallback in case yt-dlp drops a format while processing
+        spec = f"{selection['format_id']}/{FORMAT_MAPPING.get(self.quality, 'bv*+ba/b')}"
+        ydl.format_selector = ydl.build_format_selector(spec)
+        self.options['format'] = spec
+
+    def defer_post_processing(self, filename, info, files_to_move=None):
+        """Stands in for YoutubeDL.post_process, keeping the work for finish_post_processing"""
+        self.deferred = (filename, info, files_to_move or {})
+        info['filepath'] = filename
+        return info
+
+    def finish_post_processing(self):
+        """Run the deferred post-processing on the pool and wait for it; returns (success, message)"""
+        filename, info, files_to_move = self.deferred
+        self.deferred = None
+        # What ffmpeg writes before renaming it over filename, and the thumbnails and subtitles to move
+        self.partial_files.add(prepend_extension(filename, 'temp'))
+        self.partial_files.update(files_to_move)
+        pp_keys = [pp.pp_key() for pp in info.get('__postprocessors') or []]
+        params = {key: value for key, value in self.options.items() if key not in LOCAL_OPTIONS}
+        # The postprocessors added for the download, the configured ones and yt-dlp's final file move
+        steps = len(pp_keys) + sum(1 for pp in params.get('postprocessors') or []
+                                   if pp.get('when', 'post_process') == 'post_process') + 1
+        with self.progress_lock:
+            self.estimator.start_postprocessing(steps)
+            self.report_progress({'status': 'postprocessing'}, True)
+        print(f'[DEBUG] Post-processing {filename} ({", ".join(pp_keys) or "no merge"})')
+        try:
+            future = self.post_processing_future = self.post_processing_pool.submit(
+                params, filename, yt_dlp.YoutubeDL.sanitize_info(info), files_to_move, pp_keys,
+                self.post_processing_event)
+            while True:
+                try:
+                    info = future.result(timeout=0.5)
+                    break
+                except FutureTimeoutError:
+                    if self.cancelled:
+                        self.post_processing_pool.cancel(future)
+                        # The worker fails as soon as its ffmpeg is killed; the files are removed after that
+                        wait_for_futures([future])
+                        return False, "Download cancelled"
+                    with self.progress_lock:
+                        self.report_progress({'status': 'postprocessing'})
+        except Exception as e:
+            if self.cancelled:
+                return False, "Download cancelled"
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in post-processing: {str(e)}')
+            kind = classify_error(e)
+            self.error_kind = 'ffmpeg' if kind == 'unknown' else kind
+            self.trace.failed(e, self.error_kind)
+            return False, f"Error: Post-processing failed: {str(e)}"
+        if self.cancelled:
+            return False, "Download cancelled"
+        self.output_path = info.get('filepath') or self.output_path
+        return True, "Download completed!"
+
+    def post_processing_event(self, status, postprocessor):
+        """Postprocessor hook relayed from the post-processing worker"""
+        self.trace_postprocessor(status, postprocessor)
+        with self.progress_lock:
+            if status == 'finished':
+                self.estimator.postprocessor_finished()
+            self.report_progress({'status': 'postprocessing', 'postprocessor': postprocessor}, status == 'finished')
+
+    def check_duplicate(self):
+        """Skip or link the download if the video is already on disk; returns the run() result or None"""
+        if not self.duplicate_finder or self.duplicate_policy == "download":
+            return None
+        existing = self.duplicate_finder.find(self.url, self.output_dir, self.quality)
+        if existing is None:
+            return None
+        self.video_info = existing['video_info']
+        path = existing['path']
+        print(f'[DEBUG] {self.url} was already downloaded to {path}')
+        target = os.path.join(self.output_dir, os.path.basename(path))
+        if self.duplicate_policy == "link" and not os.path.exists(target):
+            try:
+                os.link(path, target)
+            except OSError:
+                # Hard links can't cross drives
+                shutil.copy2(path, target)
+            self.output_path = target
+            return True, f"Linked existing file: {target}"
+        self.output_path = path
+        self.duplicate = True
+        return True, f"Already downloaded: {path}"
+
+    def retry_delay(self, attempt, kind='http'):
+        """yt-dlp asks how long to sleep before retrying; a retry means the server is throttling"""
+        REGISTRY.inc('downloader_retries_total', kind=kind)
+        if not self.throttled:
+            self.throttled = True
+            self.fragment_concurrency.throttled(self.host)
+        return self.fragment_concurrency.retry_delay(attempt)
+
+    def progress_hook(self, d):
+        if self.cancelled:
+            raise Exception("Download cancelled")
+
+        if d['status'] in ('downloading', 'finished'):
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            with self.progress_lock:
+                # Only streams this run writes; 'finished' alone is also reported for files already on disk
+                if d['status'] == 'downloading' and d.get('filename') not in self.stream_offsets:
+                    self.partial_files.update(name for name in (d.get('filename'), d.get('tmpfilename')) if name)
+                self.trace_stream(d)
+                received = self.count_received(d)
+                if total:
+                    downloaded = total if d['status'] == 'finished' else d.get('downloaded_bytes') or 0
+                    # Fragmented downloads only know an estimate extrapolated from the fragments so far
+                    self.estimator.update_stream(d.get('filename'), downloaded, total, d.get('speed'),
+                                                 estimated=not d.get('total_bytes'))
+                    # Only pass on what the listeners use; the full dict also carries the whole info_dict
+                    self.report_progress({key: d.get(key) for key in PROGRESS_FIELDS}, d['status'] == 'finished')
+            # yt-dlp reads on the thread that calls the hook, so waiting here holds back the download.
+            # Backends that read on their own threads charge the bandwidth themselves.
+            if not d.get('bandwidth_charged'):
+                self.use_bandwidth(received)
+    
+    def count_received(self, d):
+        """Bytes of the stream received since its last progress callback"""
+        key = d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        # The first callback of a resumed stream counts what earlier runs downloaded
+        previous = self.received.get(key, downloaded)
+        self.received[key] = max(downloaded, previous)
+        if downloaded > previous:
+            REGISTRY.inc('downloader_downloaded_bytes_total', downloaded - previous)
+        return max(downloaded - previous, 0)
+    
+    def trace_stream(self, d):
+        """Time the download of each stream from its first progress callback to 'finished'"""
+        filename = d.get('filename')
+        downloaded = d.get('downloaded_bytes') or 0
+        if d['status'] == 'downloading':
+            if filename not in self.stream_offsets:
+                self.stream_offsets[filename] = downloaded
+                self.trace.start('download', ('download', filename),
+                                 format_id=(d.get('info_dict') or {}).get('format_id'), resumed_bytes=downloaded)
+            return
+        # A resumed stream's rate only counts what this run received
+        size = (downloaded or d.get('total_bytes') or 0) - self.stream_offsets.get(filename, 0)
+        seconds = self.trace.end(('download', filename), bytes=size)
+        if seconds and size > 0:
+            REGISTRY.observe('downloader_stream_bytes_per_second', size / seconds)
+    
+    def trace_postprocessor(self, status, postprocessor):
+        phase = POSTPROCESSOR_PHASES.get(postprocessor, 'postprocess')
+        if phase is None:
+            return
+        if status == 'started':
+            self.trace.start(phase, ('postprocessor', postprocessor), postprocessor=postprocessor)
+        elif status == 'finished':
+            self.trace.end(('postprocessor', postprocessor))
+    
+    def use_bandwidth(self, size):
+        """Charge size received bytes to the job's share of the bandwidth, waiting while it is over its rate"""
+        if not self.bandwidth or not size:
+            return
+        self.bandwidth.consume(self.job_id, size, lambda: self.cancelled)
+        # yt-dlp's own limiter reads the option on every block; keeping it at the job's rate
+        # smooths the transfer instead of reading in bursts and then sleeping
+        rate = self.bandwidth.rate_for(self.job_id)
+        ydl = self.ydl
+        if ydl is not None:
+            ydl.params['ratelimit'] = int(rate) if rate else None
+    
+    def postprocessor_hook(self, d):
+        if self.cancelled:
+            raise Exception("Download cancelled")
+        
+        self.trace_postprocessor(d['status'], d.get('postprocessor'))
+        # The estimator is shared with progress_hook
+        with self.progress_lock:
+            if d['status'] == 'started':
+                self.estimator.start_postprocessing()
+                self.report_progress({'status': 'postprocessing', 'postprocessor': d.get('postprocessor')}, True)
+            elif d['status'] == 'finished':
+                self.estimator.postprocessor_finished()
+    
+    def report_progress(self, status, final=False):
+        """Pass job-wide progress to the progress callback"""
+        if not self.progress_callback:
+            return
+        estimator = self.estimator
+        if estimator.phase == 'postprocessing':
+            speed_str = "Post-processing"
+        else:
+            speed_str = f"{estimator.rate / 1024:.1f} KB/s" if estimator.rate else "Unknown speed"
+        status.update({
+            'phase': estimator.phase,
+            'downloaded_bytes': estimator.downloaded_bytes,
+            'total_bytes': estimator.total_bytes,
+            'speed': estimator.rate,
+            'eta': estimator.eta,
+            'elapsed': time.monotonic() - estimator.started
+        })
+        self.progress_callback(estimator.percent, speed_str, self.video_info.get('title', 'Unknown Video'), status,
+                               final)
+    
+    def formats_selected(self, info):
+        """Plan the job once yt-dlp has chosen its formats"""
+        formats = info.get('requested_formats') or [info]
+        self.selected_format = info.get('format_id')
+        sizes = [format_size(f, info.get('duration')) for f in formats]
+        # Merging, remuxing and thumbnail embedding each rewrite the file; MP3 conversion re-encodes it
+        copies = (1 if len(formats) > 1 else 0) + 1
+        transcode_duration = (info.get('duration') or 0) if self.quality == "audio_only" and self.audio_format == 'mp3' \
+            else 0
+        self.estimator.set_plan(sizes, copies, transcode_duration)
+        if self.format_callback:
+            self.format_callback(info.get('format_id'), describe_formats(formats),
+                                 sum(sizes) if all(sizes) else None)
+
+    def cancel(self, keep_files=False):
+        """Stop the job: its connections are shut down, post-processing on the pool loses its ffmpeg
+
+        With keep_files the partial files are left for a later run to continue.
+        """
+        self.keep_files = keep_files
+        self.cancelled = True
+        if self.prefetch_future is not None:
+            self.prefetch_future.cancel()
+        self.close_connections()
+        future = self.post_processing_future
+        if future is not None and self.post_processing_pool:
+            self.post_processing_pool.cancel(future)
+
+    def track_requests(self, urlopen):
+        """Wrap a YoutubeDL's urlopen so that cancel() can interrupt the job's requests"""
+        def tracked_urlopen(request):
+            if self.cancelled:
+                raise DownloadCancelled("Download cancelled")
+            response = urlopen(request)
+            sock = response_socket(response)
+            if sock is not None:
+                with self.socket_lock:
+                    self.sockets.add(sock)
+                # Cancelled while the request was on its way
+                if self.cancelled:
+                    self.close_connections()
+            return response
+        return tracked_urlopen
+
+    def close_connections(self):
+        """Shut down the sockets of the job's responses so that reads blocked on them fail at once"""
+        with self.socket_lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def remove_partial_files(self):
+        """Delete what a cancelled job left behind, once nothing writes to the files any more"""
+        if self.keep_files:
+            return
+        for path in list(self.partial_files):
+            # yt-dlp's fragments and their state file, and SegmentedDownloader's chunk list
+            names = [path, path + '.ytdl', path + '.segments', path + '.segments.tmp']
+            names.extend(glob.glob(glob.escape(path) + '-Frag*'))
+            for name in names:
+                try:
+                    if os.path.isfile(name):
+                        os.remove(name)
+                        print(f'[DEBUG] Removed {name}')
+                except OSError as e:
+                    print(f'[DEBUG] Could not remove {name}: {e}')
+        self.partial_files.clear()
+
+
+def preview_formats(url, quality="best", policy=None, metadata_cache=None):
+    """Return what would be downloaded for url without downloading it
+
+    The result has the title and duration of the video and the format_id, description and
+    predicted size chosen by the policy; format_id is None when yt-dlp would have to choose.
+    """
+    video_id = get_video_id(url)
+    info_dict = metadata_cache.get(video_id) if metadata_cache and video_id else None
+    if info_dict is None:
+        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': True}) as ydl:
+            info_dict = ydl.extract_info(url, download=False, process=False)
+        if metadata_cache and video_id and info_dict:
+            metadata_cache.put(video_id, info_dict)
+    if not info_dict:
+        raise Exception("Failed to get video information. Please check if the URL is valid.")
+    selection = (policy or FormatPolicy()).select(info_dict.get('formats'), quality, info_dict.get('duration')) or {}
+    return {
+        'url': url,
+        'title': info_dict.get('title', 'Unknown Video'),
+        'duration': info_dict.get('duration'),
+        'format_id': selection.get('format_id'),
+        'description': selection.get('description'),
+        'size': selection.get('size')
+    }
+
+
+def expand_playlist(url, start=1, end=None, skip_ids=None, is_cancelled=lambda: False):
+    """Yield (url, title) for the entries of a playlist or channel as soon as each one resolves"""
+    skip_ids = skip_ids or set()
+    ydl = yt_dlp.YoutubeDL({
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True
+    })
+    entries = islice(iter_playlist_entries(ydl, url, is_cancelled), max(1, start) - 1, end)
+    for entry in entries:
+        if is_cancelled():
+            return
+        video_id = entry.get('id')
+        if video_id and video_id in skip_ids:
+            continue
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if not entry_url:
+            continue
+        if video_id and not entry_url.startswith('http'):
+            entry_url = f"https://www.youtube.com/watch?v={video_id}"
+        yield entry_url, entry.get('title') or ''
+
+
+def iter_playlist_entries(ydl, url, is_cancelled, depth=0):
+    """Yield video entries as soon as each page of the playlist is fetched"""
+    ie_result = ydl.extract_info(url, download=False, process=False)
+    # Channel URLs resolve to their videos tab first
+    while ie_result and ie_result.get('_type') in ('url', 'url_transparent') and depth < 5:
+        depth += 1
+        ie_result = ydl.extract_info(ie_result['url'], download=False, process=False)
+    if not ie_result:
+        return
+    if ie_result.get('_type') not in ('playlist', 'multi_video'):
+        yield ie_result
+        return
+    for entry in ie_result.get('entries') or []:
+        if is_cancelled():
+            return
+        if not entry:
+            continue
+        # Channel home pages list their tabs as nested playlists
+        if entry.get('_type') == 'playlist' or (entry.get('ie_key') == 'YoutubeTab' and depth < 5):
+            yield from iter_playlist_entries(ydl, entry.get('url') or entry.get('webpage_url'), is_cancelled, depth + 1)
+        else:
+            yield entry
+
+
+class PlaylistExpansion:
+    """Handle for a playlist expansion running in the background"""
+
+    def __init__(self, url):
+        self.url = url
+        self.cancelled = False
+        self.count = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DownloadManager:
+    """Download queue that runs jobs on a bounded pool of worker threads
+
+    Listeners are called as listener(event, job_id, data) from worker threads with
+    event one of 'added', 'started', 'progress', 'thumbnail', 'postprocessing',
+    'retrying', 'finished' and 'playlist_finished' (job_id is None for the latter). A job
+    that reaches 'postprocessing' no longer counts against the download limits. A failed
+    job that the retry policy gives another try is 'retrying' until its backoff is over and
+    then queued again, starting with another 'started'. A cancelled job is 'finished' at
+    once and gives up its slot while its thread stops and removes its partial files. stop()
+    ends every job without a 'finished', for the JobJournal to resume them in the next run.
+    The data of 'finished' includes the job; only the last keep_finished finished jobs
+    stay in jobs.
+    """
+
+    def __init__(self, max_concurrent=3, per_host_limit=2, metadata_cache=None, progress_rate=4.0,
+                 thumbnail_cache=None, duplicate_finder=None, duplicate_policy="skip", fragment_workers=4,
+                 backend=None, bandwidth=None, job_rate_limit=None, post_processing_workers=None, format_policy=None,
+                 audio_format="original", retry_policy=None, prefetch=2, keep_finished=1000):
+        self.max_concurrent = max_concurrent
+        self.per_host_limit = per_host_limit
+        self.metadata_cache = metadata_cache
+        self.thumbnail_cache = thumbnail_cache
+        # Maximum 'progress' events per second and job
+        self.progress_rate = progress_rate
+        # Checked by each job before it extracts anything; the policy applies to jobs submitted afterwards
+        self.duplicate_finder = duplicate_finder
+        self.duplicate_policy = duplicate_policy
+        self.fragment_concurrency = FragmentConcurrency(max(1, fragment_workers))
+        # Backend of jobs submitted from now on
+        self.backend = backend or DownloadBackend()
+        # Shares the global rate limit between running jobs; job_rate_limit caps jobs submitted from now on
+        self.bandwidth = bandwidth or BandwidthScheduler()
+        self.job_rate_limit = job_rate_limit
+        # FormatPolicy and audio_only output (one of AUDIO_FORMATS) of jobs submitted from now on
+        self.format_policy = format_policy or FormatPolicy()
+        self.audio_format = audio_format
+        # Decides whether and when failed jobs are tried again
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Merging, conversion and embedding run on their own processes (one per core by default);
+        # 0 runs them on the download thread, holding its slot
+        self.post_processing_pool = PostProcessingPool(post_processing_workers) \
+            if post_processing_workers != 0 else None
+        # Extracts the info of the next prefetch queued jobs ahead of time; 0 leaves it to each job
+        self.prefetcher = MetadataPrefetcher(prefetch) if prefetch > 0 else None
+        self.jobs = {}
+        # Ids of finished jobs, oldest first; older ones than the last keep_finished are dropped from jobs
+        self.finished = deque()
+        self.keep_finished = keep_finished
+        self.pending = deque()
+        self.active = {}
+        # Threads of the jobs whose post-processing runs on the pool
+        self.post_processing = {}
+        # Jobs waiting out their backoff before a retry, with the timer that queues them again
+        self.retrying = {}
+        # Threads of cancelled jobs that haven't stopped yet
+        self.stopping = {}
+        # Set by stop(); no more jobs are started
+        self.stopped = False
+        self.expanders = []
+        self.listeners = []
+        self.next_job_id = 1
+        # Jobs that left the active set but whose 'finished' listeners are still running
+        self.finishing = 0
+        self.lock = threading.RLock()
+        self.idle = threading.Condition(self.lock)
+        REGISTRY.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Queue gauges for the metrics registry"""
+        with self.lock:
+            counts = {'queued': len(self.pending), 'downloading': len(self.active),
+                      'postprocessing': len(self.post_processing), 'retrying': len(self.retrying),
+                      'stopping': len(self.stopping)}
+        return [('downloader_jobs', {'state': state}, count) for state, count in counts.items()]
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, job_id, data=None):
+        for listener in self.listeners:
+            try:
+                listener(event, job_id, data or {})
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                print(f"Error in download listener: {e}")
+
+    def submit(self, url, output_dir, quality="best", format_id=None, active_id=None, priority="normal"):
+        """Add a URL to the queue and return its job id"""
+        with self.lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs[job_id] = DownloadJob(job_id, url, output_dir, quality, self.metadata_cache,
+                                            format_id, active_id, thumbnail_cache=self.thumbnail_cache,
+                                            duplicate_finder=self.duplicate_finder,
+                                            duplicate_policy=self.duplicate_policy,
+                                            fragment_concurrency=self.fragment_concurrency,
+                                            backend=self.backend, bandwidth=self.bandwidth,
+                                            priority=priority, rate_limit=self.job_rate_limit,
+                                            post_processing_pool=self.post_processing_pool,
+                                            format_policy=self.format_policy, audio_format=self.audio_format)
+            self.pending.append(job_id)
+        self.notify('added', job_id, {'url': url})
+        self.schedule()
+        return job_id
+
+    def submit_playlist(self, url, output_dir, quality="best", start=1, end=None, skip_ids=None, **settings):
+        """Expand a playlist or channel in the background, queueing each entry as it resolves
+
+        settings ('priority' and/or 'rate_limit', as for set_job_bandwidth) apply to every entry.
+        """
+        if settings.get('priority', 'normal') not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        expansion = PlaylistExpansion(url)
+        with self.lock:
+            self.expanders.append(expansion)
+        thread = threading.Thread(
+            target=self.run_expansion,
+            args=(expansion, output_dir, quality, start, end, skip_ids, settings),
+            daemon=True
+        )
+        thread.start()
+        return expansion
+
+    def run_expansion(self, expansion, output_dir, quality, start, end, skip_ids, settings):
+        print(f'[DEBUG] Expanding playlist: {expansion.url}')
+        try:
+            entries = expand_playlist(expansion.url, start, end, skip_ids, lambda: expansion.cancelled)
+            for entry_url, title in entries:
+                job_id = self.submit(entry_url, output_dir, quality, priority=settings.get('priority', 'normal'))
+                if 'rate_limit' in settings:
+                    self.set_job_bandwidth(job_id, rate_limit=settings['rate_limit'])
+                expansion.count += 1
+            if expansion.cancelled:
+                success, message = False, "Playlist expansion cancelled"
+            else:
+                success, message = True, f"Queued {expansion.count} video(s) from playlist"
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f'[DEBUG] Exception in thread: {str(e)}')
+            success, message = False, f"Error: {str(e)}"
+
+        with self.lock:
+            self.expanders.remove(expansion)
+            self.finishing += 1
+        self.notify('playlist_finished', None, {
+            'url': expansion.url, 'success': success, 'message': message, 'count': expansion.count
+        })
+        with self.lock:
+            self.finishing -= 1
+            self.idle.notify_all()
+
+    def set_limits(self, max_concurrent=None, per_host_limit=None, fragment_workers=None):
+        """Change the concurrency limits, starting queued jobs if there is room
+
+        The number of fragment workers applies to jobs started afterwards.
+        """
+        with self.lock:
+            if max_concurrent is not None:
+                self.max_concurrent = max(1, max_concurrent)
+            if per_host_limit is not None:
+                self.per_host_limit = max(1, per_host_limit)
+        if fragment_workers is not None:
+            self.fragment_concurrency.set_max_workers(fragment_workers)
+        self.schedule()
+
+    def set_job_bandwidth(self, job_id, **settings):
+        """Change a queued or running job's 'priority' and/or 'rate_limit'; returns False for unknown jobs"""
+        if settings.get('priority', 'normal') not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if 'priority' in settings:
+                job.priority = settings['priority']
+            if 'rate_limit' in settings:
+                job.rate_limit = settings['rate_limit']
+        self.bandwidth.update_job(job_id, **settings)
+        return True
+
+    def host_count(self, host):
+        return sum(1 for job_id in self.active if self.jobs[job_id].host == host)
+
+    def schedule(self):
+        """Start as many pending jobs as the global and per-host limits allow"""
+        started = []
+        with self.lock:
+            if self.stopped:
+                return
+            skipped = deque()
+            while self.pending and len(self.active) < self.max_concurrent:
+                job_id = self.pending.popleft()
+                if self.host_count(self.jobs[job_id].host) >= self.per_host_limit:
+                    skipped.append(job_id)
+                    continue
+                job = self.jobs[job_id]
+                job.status = 'downloading'
+                thread = threading.Thread(target=self.run_job, args=(job,), daemon=True)
+                self.active[job_id] = thread
+                started.append((job_id, thread))
+            # Jobs blocked by their host limit keep their place at the front of the queue
+            skipped.extend(self.pending)
+            self.pending = skipped
+            if self.prefetcher:
+                self.prefetcher.prefetch(self.jobs[job_id] for job_id in self.pending)
+
+        for job_id, thread in started:
+            self.notify('started', job_id)
+            thread.start()
+
+    def run_job(self, job):
+        throttle = ProgressThrottle(lambda percent, speed, title, status: self.notify('progress', job.job_id, {
+            'percent': percent, 'speed': speed, 'title': title, 'status': status
+        }), self.progress_rate)
+        # The end of each stream is always reported so listeners see it reach 100%
+        job.progress_callback = lambda percent, speed, title, status, final: throttle.update(
+            percent, speed, title, status, force=final)
+        job.thumbnail_callback = lambda url: self.notify('thumbnail', job.job_id, {'url': url})
+        job.format_callback = lambda format_id, description, size: self.notify('format_selected', job.job_id, {
+            'format_id': format_id, 'description': description, 'size': size
+        })
+        with self.lock:
+            self.bandwidth.add_job(job.job_id, job.priority, job.rate_limit)
+        try:
+            success, message = job.run()
+        finally:
+            self.bandwidth.remove_job(job.job_id)
+        if success and job.deferred and self.release_slot(job):
+            success, message = job.finish_post_processing()
+        # The last progress arrives before 'retrying' or 'finished'
+        throttle.flush()
+        if not success and job.keep_files:
+            # Stopped by stop(): not finished, so the journal still has it for the next run
+            print(f'[DEBUG] Download job {job.job_id} stopped, its partial files are kept')
+        else:
+            if not success and self.schedule_retry(job, message):
+                return
+            self.finish_job(job, success, message)
+            if job.status == 'cancelled':
+                job.remove_partial_files()
+        with self.lock:
+            if self.stopping.pop(job.job_id, None):
+                self.idle.notify_all()
+
+    def release_slot(self, job):
+        """Let queued jobs start while this one is post-processed; returns False if it was cancelled"""
+        with self.lock:
+            if job.cancelled:
+                return False
+            self.post_processing[job.job_id] = self.active.pop(job.job_id)
+            job.status = 'postprocessing'
+        self.notify('postprocessing', job.job_id)
+        self.schedule()
+        return True
+
+    def schedule_retry(self, job, message):
+        """Queue a failed job again once its backoff is over; returns False if it isn't retried"""
+        if job.error_kind is None:
+            return False
+        delay = self.retry_policy.delay(job.error_kind, job.attempt + 1, job.retry_after)
+        if delay is None:
+            return False
+        timer = threading.Timer(delay, self.requeue, args=(job,))
+        timer.daemon = True
+        with self.lock:
+            if job.cancelled:
+                return False
+            self.active.pop(job.job_id, None)
+            self.post_processing.pop(job.job_id, None)
+            job.status = 'retrying'
+            job.message = message
+            job.queued_at = job.trace.clock()
+            self.retrying[job.job_id] = timer
+        print(f'[DEBUG] Retrying job {job.job_id} in {delay:.1f}s after a {job.error_kind} error')
+        REGISTRY.inc('downloader_retries_total', kind='job')
+        REGISTRY.log.write('retry', job_id=job.job_id, attempt=job.attempt + 1, kind=job.error_kind,
+                           delay=round(delay, 3), message=message)
+        self.notify('retrying', job.job_id, {
+            'attempt': job.attempt + 1,
+            'retries': self.retry_policy.retries_for(job.error_kind),
+            'delay': delay,
+            'error': job.error_kind,
+            'message': message
+        })
+        timer.start()
+        self.schedule()
+        return True
+
+    def requeue(self, job):
+        with self.lock:
+            # Cancelled while waiting
+            if self.retrying.pop(job.job_id, None) is None:
+                return
+            job.prepare_retry()
+            job.status = 'queued'
+            self.pending.append(job.job_id)
+        self.schedule()
+
+    def finish_job(self, job, success, message):
+        with self.lock:
+            # Cancelled jobs are finished by cancel() while their thread is still stopping
+            if job.status in FINAL_STATES:
+                return
+            self.active.pop(job.job_id, None)
+            self.post_processing.pop(job.job_id, None)
+            job.info_dict = None
+            if success:
+                job.status = 'skipped' if job.duplicate else 'completed'
+            else:
+                job.status = 'cancelled' if job.cancelled else 'failed'
+            job.message = message
+            self.finishing += 1
+        job.trace.finish(job.status, url=job.url, quality=job.quality,
+                         bytes=job.estimator.downloaded_bytes, message=message)
+        self.notify('finished', job.job_id, {
+            'success': success,
+            'message': message,
+            'title': job.video_info.get('title', 'Unknown Video'),
+            'video_info': job.video_info,
+            'job': job
+        })
+        self.schedule()
+        with self.lock:
+            self.finishing -= 1
+            # Only jobs whose 'finished' listeners have run are dropped
+            self.finished.append(job.job_id)
+            while len(self.finished) > self.keep_finished:
+                self.jobs.pop(self.finished.popleft(), None)
+            self.idle.notify_all()
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job
+
+        The job is finished and its slot freed right away. A running job's connections are shut
+        down and its ffmpeg is killed; join_cancelled() waits until its thread has stopped and
+        removed the partial files.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            # Nothing runs for a queued job or one waiting to be retried; it is cleaned up here
+            stopped = True
+            if job_id in self.active:
+                self.stopping[job_id] = self.active.pop(job_id)
+                stopped = False
+            elif job_id in self.post_processing:
+                self.stopping[job_id] = self.post_processing.pop(job_id)
+                stopped = False
+            elif job_id in self.retrying:
+                self.retrying.pop(job_id).cancel()
+            elif job_id in self.pending:
+                self.pending.remove(job_id)
+            else:
+                return False
+            job.cancel()
+        self.finish_job(job, False, "Download cancelled")
+        if stopped:
+            job.remove_partial_files()
+        return True
+
+    def cancel_all(self):
+        with self.lock:
+            for expansion in self.expanders:
+                expansion.cancel()
+            # Queued jobs first, so none of them takes a slot freed by a running one
+            job_ids = list(self.pending) + list(self.retrying) + list(self.active) + list(self.post_processing)
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    def stop(self, preserve=True):
+        """Stop every job because the program exits
+
+        With preserve the jobs are interrupted rather than cancelled: there is no 'finished'
+        event, so the JobJournal keeps their active_jobs rows, and their partial files stay
+        for the next run to resume. Without it they are cancelled like by cancel_all().
+        join_cancelled() waits for their threads.
+        """
+        if not preserve:
+            self.cancel_all()
+            return
+        with self.lock:
+            self.stopped = True
+            for expansion in self.expanders:
+                expansion.cancel()
+            # Jobs waiting for a retry keep their journal rows as well
+            for timer in self.retrying.values():
+                timer.cancel()
+            self.retrying.clear()
+            self.pending.clear()
+            for job_id, thread in list(self.active.items()) + list(self.post_processing.items()):
+                self.stopping[job_id] = thread
+                self.jobs[job_id].cancel(keep_files=True)
+            self.active.clear()
+            self.post_processing.clear()
+            self.idle.notify_all()
+
+    def shutdown(self):
+        """Stop reporting this manager's metrics and its worker pools, once it is no longer used"""
+        REGISTRY.remove_collector(self.collect_metrics)
+        if self.post_processing_pool:
+            self.post_processing_pool.shutdown()
+        if self.prefetcher:
+            self.prefetcher.executor.shutdown(wait=False, cancel_futures=True)
+
+    def join_cancelled(self, timeout=None):
+        """Wait until the threads of cancelled jobs have stopped and cleaned up; returns False on timeout"""
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.stopping, timeout)
+
+    def is_busy(self):
+        with self.lock:
+            return bool(self.pending or self.active or self.post_processing or self.retrying or self.expanders)
+
+    def wait(self, timeout=None):
+        """Block until the queue is empty; returns False on timeout"""
+        with self.lock:
+            return self.idle.wait_for(
+                lambda: not (self.pending or self.active or self.post_processing or self.retrying or self.expanders
+                             or self.finishing),
+                timeout)
+
+
+class JobJournal:
+    """Persists running jobs in the active_jobs table so they can be resumed after a crash or restart"""
+    # Seconds between progress writes for one job
+    UPDATE_INTERVAL = 2.0
+
+    def __init__(self, manager, db_manager):
+        self.manager = manager
+        self.db_manager = db_manager
+        self.last_update = {}
+        manager.add_listener(self.on_event)
+
+    def on_event(self, event, job_id, data):
+        # A cancelled job's thread may still report progress after it was finished and dropped
+        job = self.manager.jobs.get(job_id)
+        if job is None:
+            return
+        if event == 'started':
+            if job.active_id is None:
+                job.active_id = self.db_manager.save_active_job(job.url, job.output_dir, job.quality)
+        elif job.active_id is None:
+            return
+        elif event == 'format_selected':
+            job.format_id = data['format_id']
+            self.db_manager.update_active_job(job.active_id, format_id=data['format_id'])
+        elif event == 'progress':
+            now = time.monotonic()
+            # Post-processing progress has no partial file to record
+            if data['status'].get('phase') == 'postprocessing' or \
+                    now - self.last_update.get(job_id, 0) < self.UPDATE_INTERVAL:
+                return
+            self.last_update[job_id] = now
+            status = data['status']
+            self.db_manager.update_active_job(
+                job.active_id,
+                partial_path=status.get('tmpfilename') or status.get('filename'),
+                downloaded_bytes=status.get('downloaded_bytes'),
+                total_bytes=status.get('total_bytes')
+            )
+        elif event == 'finished':
+            self.last_update.pop(job_id, None)
+            self.db_manager.delete_active_job(job.active_id)
+
+    def resume(self):
+        """Queue the jobs left over from a previous run; returns how many were resumed"""
+        rows = self.db_manager.get_active_jobs()
+        for active_id, url, output_dir, quality, format_id, partial_path, downloaded_bytes, total_bytes in rows:
+            if partial_path and os.path.exists(partial_path):
+                print(f'[DEBUG] Resuming {url} from {partial_path} ({downloaded_bytes} bytes)')
+            else:
+                print(f'[DEBUG] Restarting interrupted download {url}')
+            self.manager.submit(url, output_dir, quality or 'best', format_id, active_id)
+        return len(rows)
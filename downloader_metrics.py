@@ -0,0 +1,292 @@
+"""Metrics and tracing of downloads
+
+REGISTRY collects the counters and histograms of the whole process and renders them in
+the Prometheus text format, served as GET /metrics by the job API or by MetricsServer
+(--metrics-port). A JobTrace times the phases of one download - queue, extract,
+thumbnail, each downloaded stream, merge, post-processing and the database write - and
+every finished phase is written to the structured log, one JSON object per line, once
+REGISTRY.log has been opened (--log-json).
+"""
+import sys
+import json
+import time
+import types
+import bisect
+import weakref
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# Bytes per second
+RATE_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+# Name: (type, help, histogram buckets)
+METRICS = {
+    'downloader_jobs_total': ('counter', "Finished jobs by status", None),
+    'downloader_errors_total': ('counter', "Failed attempts by the phase that failed, the exception type and the "
+                                           "failure class", None),
+    'downloader_retries_total': ('counter', "Retried HTTP requests, fragments, segments, post-processing and jobs",
+                                 None),
+    'downloader_downloaded_bytes_total': ('counter', "Bytes received by all downloads", None),
+    'downloader_cache_requests_total': ('counter', "Metadata and thumbnail cache lookups by result", None),
+    'downloader_phase_seconds': ('histogram', "Duration of each phase of a download", DURATION_BUCKETS),
+    'downloader_stream_bytes_per_second': ('histogram', "Average rate of each downloaded stream", RATE_BUCKETS),
+    'downloader_db_write_seconds': ('histogram', "Duration of each committed batch of database writes",
+                                    DURATION_BUCKETS),
+    'downloader_jobs': ('gauge', "Jobs that are queued, downloading or post-processing", None)
+}
+
+# Phase of the postprocessors reported by yt-dlp's postprocessor hooks; None is not traced
+POSTPROCESSOR_PHASES = {
+    'FFmpegMerger': 'merge',
+    'CachedThumbnailWriter': 'thumbnail',
+    'FormatRecorder': None
+}
+
+
+def format_value(value):
+    """Numbers as Prometheus expects them: integers without a decimal point, floats in full"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf; rendered cumulatively
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class StructuredLog:
+    """Writes events as JSON lines; does nothing until it is opened"""
+
+    def __init__(self):
+        self.stream = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        """Log to a file, appending, or to stderr for '-'"""
+        self.stream = sys.stderr if path == '-' else open(path, 'a', encoding='utf-8')
+
+    def write(self, event, **fields):
+        if self.stream is None:
+            return
+        line = json.dumps({'time': round(time.time(), 3), 'event': event, **fields}, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+class MetricsRegistry:
+    """Counters and histograms keyed by name and labels, plus collectors for gauges"""
+
+    def __init__(self, definitions=METRICS):
+        self.definitions = definitions
+        self.values = {}
+        # References to callables returning [(name, labels dict, value)] of gauges when the metrics are rendered
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.log = StructuredLog()
+
+    def key(self, name, labels):
+        if name not in self.definitions:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.definitions[name][2])
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        """Current value of a counter, or the Histogram of a histogram"""
+        with self.lock:
+            return self.values.get(self.key(name, labels))
+
+    def add_collector(self, collector):
+        """Add a gauge collector; a bound method is held weakly so it doesn't keep its object alive"""
+        ref = weakref.WeakMethod(collector) if isinstance(collector, types.MethodType) else lambda: collector
+        with self.lock:
+            self.collectors.append(ref)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            self.collectors = [ref for ref in self.collectors if ref() is not None and ref() != collector]
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append((labels, value))
+            # Histograms keep changing; render copies of them
+            for name, entries in samples.items():
+                samples[name] = [(labels, (list(value.counts), value.sum, value.count) if isinstance(value, Histogram)
+                                  else value) for labels, value in entries]
+            # Collectors whose object is gone are dropped
+            collectors = [collector for collector in (ref() for ref in self.collectors) if collector is not None]
+            if len(collectors) < len(self.collectors):
+                self.collectors = [ref for ref in self.collectors if ref() is not None]
+        for collector in collectors:
+            for name, labels, value in collector():
+                self.key(name, labels)
+                samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in self.definitions:
+            if name not in samples:
+                continue
+            kind, help_text, buckets = self.definitions[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples[name]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class JobTrace:
+    """Phase timings of one download
+
+    Phases are either timed with the phase() context manager or opened with start() and
+    closed with end(), which allows several at once (e.g. the streams of a DASH download).
+    A phase that happens more than once adds up in phases.
+    """
+
+    def __init__(self, job_id, registry=None, clock=time.monotonic):
+        self.job_id = job_id
+        self.registry = registry or REGISTRY
+        self.clock = clock
+        self.created = clock()
+        self.phases = {}
+        # key -> (phase, start time, log fields)
+        self.open = {}
+        self.failed_phase = None
+        self.lock = threading.Lock()
+
+    def start(self, phase, key=None, **fields):
+        """Open a phase unless one with the same key is open already"""
+        with self.lock:
+            self.open.setdefault(key or phase, (phase, self.clock(), fields))
+
+    def end(self, key, **fields):
+        """Close an open phase and return its duration, or None if it wasn't open"""
+        with self.lock:
+            entry = self.open.pop(key, None)
+        if entry is None:
+            return None
+        phase, started, start_fields = entry
+        return self.record(phase, self.clock() - started, **{**start_fields, **fields})
+
+    def record(self, phase, seconds, **fields):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+        self.registry.observe('downloader_phase_seconds', seconds, phase=phase)
+        self.registry.log.write('phase', job_id=self.job_id, phase=phase, seconds=round(seconds, 3), **fields)
+        return seconds
+
+    @contextmanager
+    def phase(self, phase, **fields):
+        """Time the body as phase; the body may add log fields to the yielded dict"""
+        started = self.clock()
+        try:
+            yield fields
+        except BaseException:
+            self.failed_phase = self.failed_phase or phase
+            fields['failed'] = True
+            raise
+        finally:
+            self.record(phase, self.clock() - started, **fields)
+
+    def failed(self, error, kind='unknown'):
+        """Count a failed attempt against the phase it happened in; kind is its failure class, e.g. 'network'"""
+        with self.lock:
+            phase = self.failed_phase or next((entry[0] for entry in reversed(list(self.open.values()))), 'unknown')
+        self.registry.inc('downloader_errors_total', phase=phase, type=type(error).__name__, kind=kind)
+        self.registry.log.write('error', job_id=self.job_id, phase=phase, type=type(error).__name__, kind=kind,
+                                message=str(error))
+
+    def finish(self, status, **fields):
+        """Close what is still open (cancelled or failed streams) and log the job's summary"""
+        for key in list(self.open):
+            self.end(key, finished=False)
+        self.registry.inc('downloader_jobs_total', status=status)
+        with self.lock:
+            phases = {phase: round(seconds, 3) for phase, seconds in self.phases.items()}
+        self.registry.log.write('job', job_id=self.job_id, status=status,
+                                seconds=round(self.clock() - self.created, 3), phases=phases, **fields)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer:
+    """Serves GET /metrics on its own thread, for the command line front end"""
+
+    def __init__(self, host="127.0.0.1", port=9464, registry=None):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry or REGISTRY
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
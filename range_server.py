@@ -0,0 +1,151 @@
+"""Local HTTP server that honors Range requests, for testing and benchmarking downloads offline
+
+    python range_server.py DIRECTORY --port 8000 --rate 2M
+
+--rate limits every connection to that many bytes per second, like servers that throttle
+single connections, so multi-connection downloads can be compared without a network.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote
+
+from downloader_core import parse_rate
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    server_version = "RangeServer/1.0"
+    protocol_version = "HTTP/1.1"
+    WRITE_SIZE = 64 * 1024
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def do_GET(self):
+        self.serve()
+
+    def send_empty(self, status, headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def serve(self, head=False):
+        path = self.server.resolve(urlparse(self.path).path)
+        if path is None:
+            self.send_empty(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', (self.headers.get('Range') or '').strip())
+        # Malformed or multi-range headers are ignored and the whole file is sent, as RFC 9110 allows
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size or start > end:
+                self.send_empty(416, [('Content-Range', f'bytes */{size}')])
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if head:
+            return
+
+        rate = self.server.rate
+        started = time.monotonic()
+        sent = 0
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = f.read(min(self.WRITE_SIZE, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                    sent += len(data)
+                    if rate:
+                        # Sleep until this connection is back under its rate
+                        delay = sent / rate - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class RangeServer:
+    """Serves the files of a directory on its own thread"""
+
+    def __init__(self, directory, host="127.0.0.1", port=0, rate=None, verbose=False):
+        self.directory = os.path.realpath(directory)
+        self.httpd = ThreadingHTTPServer((host, port), RangeRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.resolve = self.resolve
+        self.httpd.rate = rate
+        self.httpd.verbose = verbose
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def url_for(self, name):
+        return f"http://{self.address[0]}:{self.address[1]}/{name}"
+
+    def resolve(self, url_path):
+        """Map a URL path to a file inside the directory, or None"""
+        path = os.path.realpath(os.path.join(self.directory, unquote(url_path).lstrip('/')))
+        if os.path.commonpath([path, self.directory]) != self.directory or not os.path.isfile(path):
+            return None
+        return path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a directory with HTTP Range support")
+    parser.add_argument('directory', help="directory to serve")
+    parser.add_argument('--host', default="127.0.0.1", help="address to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="port to listen on")
+    parser.add_argument('--rate', type=parse_rate, help="bytes per second per connection, e.g. 2M")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every request")
+    args = parser.parse_args(argv)
+
+    server = RangeServer(args.directory, args.host, args.port, args.rate, args.verbose).start()
+    print(f"Serving {server.directory} on http://{server.address[0]}:{server.address[1]}")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
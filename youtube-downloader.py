@@ -1,271 +1,283 @@
 import os
 import sys
-import yt_dlp
-import sqlite3
-from datetime import datetime
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QLineEdit, QPushButton, QProgressBar, QFileDialog,
                              QMessageBox, QFrame, QGroupBox, QSizePolicy, QSpacerItem,
-                             QTabWidget, QSplitter, QScrollArea, QComboBox)
-from PyQt5.QtCore import QThread, pyqtSignal, Qt, QTimer
+                             QTabWidget, QSplitter, QScrollArea, QComboBox, QSpinBox, QCheckBox,
+                             QTableView, QAbstractItemView, QHeaderView, QMenu, QInputDialog)
+from PyQt5.QtCore import (QObject, QRunnable, QThreadPool, pyqtSignal, Qt, QTimer, QSize,
+                          QAbstractTableModel, QModelIndex, QPersistentModelIndex)
 from PyQt5.QtGui import QFont, QPalette, QColor, QIcon, QPixmap, QImage, QPainter, QPen
-import requests
-from io import BytesIO
 import platform
-import re
+import argparse
+import multiprocessing
+from downloader_core import (DatabaseManager, MetadataCache, ThumbnailCache, DownloadManager, JobJournal, HistorySearch,
+                             DuplicateFinder, FormatPolicy, PRIORITIES,
+                             QUALITY_MAPPING, clean_youtube_url, get_video_id, parse_item_range,
+                             parse_rate, format_rate, parse_bandwidth_profiles)
+from downloader_backends import ExternalBackend, create_backend
+from downloader_metrics import REGISTRY, MetricsServer
 
 
-class DatabaseManager:
-    def __init__(self, db_path="download_history.db"):
-        self.db_path = db_path
-        self.init_database()
-    
-    def init_database(self):
-        """Initialize the database and create tables if they don't exist"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS download_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        title TEXT NOT NULL,
-                        url TEXT NOT NULL,
-                        uploader TEXT,
-                        duration TEXT,
-                        view_count TEXT,
-                        quality TEXT,
-                        output_path TEXT,
-                        download_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        status TEXT DEFAULT 'completed'
-                    )
-                ''')
-                conn.commit()
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            print(f"Database initialization error: {e}")
-    
-    def save_download(self, title, url, uploader, duration, view_count, quality, output_path, status="completed"):
-        """Save a download record to the database"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO download_history 
-                    (title, url, uploader, duration, view_count, quality, output_path, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (title, url, uploader, duration, view_count, quality, output_path, status))
-                conn.commit()
-                return cursor.lastrowid
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            print(f"Error saving download: {e}")
-            return None
-    
-    def get_download_history(self, limit=50):
-        """Get download history from the database"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT id, title, url, uploader, duration, view_count, quality, 
-                           output_path, download_date, status
-                    FROM download_history 
-                    ORDER BY download_date DESC 
-                    LIMIT ?
-                ''', (limit,))
-                return cursor.fetchall()
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            print(f"Error getting download history: {e}")
-            return []
-    
-    def clear_history(self):
-        """Clear all download history"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM download_history')
-                conn.commit()
-                return True
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            print(f"Error clearing history: {e}")
-            return False
-    
-    def delete_download(self, download_id):
-        """Delete a specific download record"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM download_history WHERE id = ?', (download_id,))
-                conn.commit()
-                return True
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            print(f"Error deleting download: {e}")
-            return False
+class DownloadQueue(QObject):
+    """Relays DownloadManager events from its worker threads to the GUI thread as Qt signals"""
+    job_added = pyqtSignal(int, str)
+    job_started = pyqtSignal(int)
+    job_progress = pyqtSignal(int, float, str, str, dict)
+    job_thumbnail = pyqtSignal(int, str)
+    job_format = pyqtSignal(int, str, object)
+    job_retrying = pyqtSignal(int, int, int, float, str)
+    job_finished = pyqtSignal(int, bool, str, str, dict, object)
+    playlist_finished = pyqtSignal(str, bool, str, int)
 
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        manager.add_listener(self.on_event)
 
-class DownloadThread(QThread):
-    progress_signal = pyqtSignal(float, str, str, dict)
-    finished_signal = pyqtSignal(bool, str, str, dict)
-    thumbnail_signal = pyqtSignal(str)
-    
-    def __init__(self, url, output_dir, quality="best"):
+    def on_event(self, event, job_id, data):
+        if event == 'added':
+            self.job_added.emit(job_id, data['url'])
+        elif event == 'started':
+            self.job_started.emit(job_id)
+        elif event == 'progress':
+            self.job_progress.emit(job_id, data['percent'], data['speed'], data['title'], data['status'])
+        elif event == 'thumbnail':
+            self.job_thumbnail.emit(job_id, data['url'])
+        elif event == 'format_selected':
+            self.job_format.emit(job_id, data['description'], data['size'])
+        elif event == 'retrying':
+            self.job_retrying.emit(job_id, data['attempt'], data['retries'], data['delay'], data['error'])
+        elif event == 'finished':
+            self.job_finished.emit(job_id, data['success'], data['message'], data['title'], data['video_info'],
+                                   data['job'])
+        elif event == 'playlist_finished':
+            self.playlist_finished.emit(data['url'], data['success'], data['message'], data['count'])
+
+
+class ThumbnailTask(QRunnable):
+    """Fetches, decodes and scales one thumbnail on the thread pool"""
+
+    def __init__(self, loader, key, url, video_id, width, height):
         super().__init__()
+        self.loader = loader
+        self.key = key
         self.url = url
-        self.output_dir = output_dir
-        self.quality = quality
-        self.cancelled = False
-        self.video_info = {}
-        self.output_path = ""  # Add this to track the actual output file path
-        
+        self.video_id = video_id
+        self.width = width
+        self.height = height
+
     def run(self):
-        print('[DEBUG] DownloadThread started')
-        try:
-            # 获取视频信息（添加extractor_args）
-            ydl_info = yt_dlp.YoutubeDL({
-                'format': 'bestaudio/best',
-                'quiet': True,
-                'no_warnings': True,
-                'extractor_args': {'youtube': {'skip': ['dash', 'hls']}}
-            })
-            print(f'[DEBUG] Extracting info for: {self.url}')
-            info_dict = ydl_info.extract_info(self.url, download=False)
-            print('[DEBUG] Video info extracted')
-            
-            if not info_dict:
-                raise Exception("Failed to get video information. Please check if the URL is valid.")
-                
-            self.video_info = {
-                'title': info_dict.get('title', 'Unknown Video'),
-                'description': info_dict.get('description', ''),
-                'thumbnail': info_dict.get('thumbnail', ''),
-                'duration': self.format_duration(info_dict.get('duration', 0)),
-                'uploader': info_dict.get('uploader', 'Unknown Uploader'),
-                'view_count': self.format_count(info_dict.get('view_count', 0))
-            }
-            if self.video_info['thumbnail']:
-                # 确保在主线程更新UI
-                self.thumbnail_signal.emit(self.video_info['thumbnail'])
-            
-            # 更新格式映射
-            format_mapping = {
-                'best': 'bv*+ba/b',
-                '1080p': 'bv[height<=1080]+ba/b[height<=1080]',
-                '720p': 'bv[height<=720]+ba/b[height<=720]',
-                '480p': 'bv[height<=480]+ba/b[height<=480]',
-                '360p': 'bv[height<=360]+ba/b[height<=360]',
-                'audio_only': 'ba/b'
-            }
+        cache = self.loader.cache
+        # History rows only look in the cache; jobs may go to the network
+        data = cache.get(self.url, self.video_id) if self.url else cache.find(self.video_id)
+        image = QImage()
+        if data:
+            image.loadFromData(data)
+        if image.isNull():
+            self.loader.loaded.emit(self.key, QImage(), "No thumbnail available" if not data else "Invalid image data")
+            return
+        # QImage (unlike QPixmap) may be scaled outside the GUI thread
+        image = image.scaled(self.width, self.height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.loader.loaded.emit(self.key, image, "")
 
-            if self.quality == "audio_only":
-                ydl_opts = {
-                    'outtmpl': os.path.join(self.output_dir, '%(title)s.%(ext)s'),
-                    'progress_hooks': [self.progress_hook],
-                    'format': format_mapping[self.quality],
-                    'noplaylist': True,
-                    'postprocessors': [
-                        {
-                            'key': 'FFmpegExtractAudio',       
-                            'preferredcodec': 'mp3',           
-                            'preferredquality': '192',         
-                        },
-                        {
-                            'key': 'EmbedThumbnail',           
-                            'already_have_thumbnail': True
-                        }
-                    ]
-                }
-            else:
-                ydl_opts = {
-                    'outtmpl': os.path.join(self.output_dir, '%(title)s.%(ext)s'),
-                    'progress_hooks': [self.progress_hook],
-                    'format': format_mapping.get(self.quality, 'bestvideo+bestaudio/best'),
-                    'merge_output_format': 'mp4',  
-                    'noplaylist': True,
-                    'writethumbnail': True,
-                    'postprocessors': [{
-                        'key': 'EmbedThumbnail',
-                        'already_have_thumbnail': True
-                    }]
-                }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([self.url])
-                
-            if not self.cancelled:
-                # Get the actual output file path
-                self.output_path = os.path.join(self.output_dir, f"{self.video_info['title']}.{'mp3' if self.quality == 'audio_only' else 'mp4'}")
-                self.finished_signal.emit(True, "Download completed!", self.video_info['title'], self.video_info)
-                
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            self.finished_signal.emit(False, f"Error: {str(e)}", self.video_info.get('title', 'Unknown Video'), {})
-    
-    def progress_hook(self, d):
-        if self.cancelled:
-            raise Exception("Download cancelled")
-            
-        if d['status'] == 'downloading':
-            total = d.get('total_bytes') or d.get('total_bytes_estimate')
-            if total:
-                percent = d['downloaded_bytes'] / total * 100
-                speed = d.get('speed')
-                speed_str = f"{speed / 1024:.1f} KB/s" if speed else "Unknown speed"
-                self.progress_signal.emit(percent, speed_str, self.video_info.get('title', 'Unknown Video'), d)
-    
-    def cancel(self):
-        self.cancelled = True
-        
-    def format_duration(self, seconds):
-        """Format video duration"""
-        minutes, seconds = divmod(seconds, 60)
-        hours, minutes = divmod(minutes, 60)
-        if hours > 0:
-            return f"{hours}:{minutes:02d}:{seconds:02d}"
-        return f"{minutes}:{seconds:02d}"
-        
-    def format_count(self, count):
-        """Format view count"""
-        if count >= 10**9:
-            return f"{count / 10**9:.1f}B"
-        if count >= 10**6:
-            return f"{count / 10**6:.1f}M"
-        if count >= 10**3:
-            return f"{count / 10**3:.1f}K"
-        return str(count)
+
+class ThumbnailLoader(QObject):
+    """Loads thumbnails through the shared ThumbnailCache without blocking the GUI thread"""
+    loaded = pyqtSignal(object, QImage, str)
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(4)
+
+    def load(self, key, url, video_id, width, height):
+        self.pool.start(ThumbnailTask(self, key, url, video_id, width, height))
+
+
+class HistoryModel(QAbstractTableModel):
+    """Download history read from the database a page at a time as the view scrolls"""
+    COLUMNS = ("Title", "Uploader", "Duration", "Quality", "Date", "Status")
+    FIELDS = (1, 3, 4, 6, 8, 9)  # Position of each column in a history row
+    PAGE_SIZE = 200
+    THUMBNAIL_SIZE = (64, 36)
+    THUMBNAIL_ITEMS = 500  # Decoded thumbnails kept for rows scrolled out of view
+    results_ready = pyqtSignal(int, object, object, int)
+    # Ids of records committed by the database writer thread
+    download_saved = pyqtSignal(object)
+
+    def __init__(self, db_manager, thumbnail_loader, parent=None):
+        super().__init__(parent)
+        self.db_manager = db_manager
+        self.thumbnail_loader = thumbnail_loader
+        self.rows = []
+        self.total = 0
+        self.exhausted = False
+        self.filters = {}
+        # Searches run on their own thread and connection; results come back through the signal
+        self.searcher = HistorySearch(db_manager, self.results_ready.emit, self.PAGE_SIZE)
+        self.generation = 0
+        self.results_ready.connect(self.show_results)
+        self.download_saved.connect(self.add_download)
+        self.thumbnails = OrderedDict()  # Thumbnails by download id
+        self.pending = {}  # Rows waiting for their thumbnail, by download id
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            value = row[self.FIELDS[column]]
+            return str(value) if value not in (None, '') else "Unknown"
+        if role == Qt.ToolTipRole and column == 0:
+            return row[2]
+        if role == Qt.ForegroundRole and column == 5:
+            return QColor("#28a745") if row[9] == "completed" else QColor("#dc3545")
+        if role == Qt.DecorationRole and column == 0:
+            return self.thumbnail(index, row)
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        after = (self.rows[-1][8], self.rows[-1][0]) if self.rows else None
+        page = self.db_manager.get_history_page(after, self.PAGE_SIZE, self.filters)
+        if len(page) < self.PAGE_SIZE:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.endInsertRows()
+
+    def reload(self):
+        """Drop the loaded rows and read the first page again"""
+        self.beginResetModel()
+        self.rows = []
+        self.pending.clear()
+        self.exhausted = False
+        self.total = self.db_manager.count_history(self.filters)
+        self.endResetModel()
+        self.fetchMore()
+
+    def apply_filters(self, filters):
+        """Search in the background; the rows are replaced when the newest search finishes"""
+        self.generation = self.searcher.search(filters)
+
+    def show_results(self, generation, filters, rows, total):
+        if generation != self.generation:
+            return
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.pending.clear()
+        self.filters = filters
+        self.exhausted = len(rows) < self.PAGE_SIZE
+        self.total = total
+        self.endResetModel()
+
+    def add_download(self, download_id):
+        """Insert a newly saved download at the top without reloading the others"""
+        if any(self.filters.values()):
+            # The record may not match the current search, so let the database decide
+            self.apply_filters(self.filters)
+            return
+        row = self.db_manager.get_download(download_id)
+        if row is None:
+            return
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self.rows.insert(0, row)
+        self.endInsertRows()
+        self.total += 1
+
+    def remove_row(self, position):
+        self.beginRemoveRows(QModelIndex(), position, position)
+        row = self.rows.pop(position)
+        self.endRemoveRows()
+        self.pending.pop(row[0], None)
+        self.total -= 1
+
+    def row_data(self, position):
+        return self.rows[position]
+
+    def thumbnail(self, index, row):
+        """Return the row's cached thumbnail, loading it the first time the row is painted"""
+        download_id = row[0]
+        if download_id in self.thumbnails:
+            self.thumbnails.move_to_end(download_id)
+            return self.thumbnails[download_id]
+        if download_id not in self.pending:
+            video_id = get_video_id(row[2])
+            if video_id:
+                # A persistent index follows the row when others are inserted or removed above it
+                self.pending[download_id] = QPersistentModelIndex(index)
+                self.thumbnail_loader.load(('history', download_id), None, video_id, *self.THUMBNAIL_SIZE)
+        return None
+
+    def set_thumbnail(self, download_id, image):
+        index = self.pending.pop(download_id, None)
+        self.thumbnails[download_id] = None if image.isNull() else QPixmap.fromImage(image)
+        while len(self.thumbnails) > self.THUMBNAIL_ITEMS:
+            self.thumbnails.popitem(last=False)
+        if index is not None and index.isValid():
+            cell = self.index(index.row(), 0)
+            self.dataChanged.emit(cell, cell, [Qt.DecorationRole])
 
 
 class YouTubeDownloader(QMainWindow):
+    FINISHED_QUEUE_ROWS = 50  # Rows of finished downloads kept in the queue; older ones are removed
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("YouTube Video Downloader")
         self.setGeometry(100, 100, 1000, 800)  # Increase window size
         self.setMinimumSize(900, 600)  # Increase minimum size
         
-        # Initialize database manager
+        # Initialize database manager and metadata cache
         self.db_manager = DatabaseManager()
+        self.metadata_cache = MetadataCache()
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_loader = ThumbnailLoader(self.thumbnail_cache, self)
+        self.thumbnail_loader.loaded.connect(self.thumbnail_loaded)
+        self.history_model = HistoryModel(self.db_manager, self.thumbnail_loader, self)
         
         # Initialize variables
-        self.download_thread = None
+        self.download_manager = DownloadManager(max_concurrent=3, per_host_limit=2,
+                                                metadata_cache=self.metadata_cache,
+                                                thumbnail_cache=self.thumbnail_cache,
+                                                duplicate_finder=DuplicateFinder(self.db_manager))
+        self.download_queue = DownloadQueue(self.download_manager, parent=self)
+        self.job_journal = JobJournal(self.download_manager, self.db_manager)
+        self.download_queue.job_added.connect(self.add_queue_item)
+        self.download_queue.job_started.connect(self.job_started)
+        self.download_queue.job_progress.connect(self.update_progress)
+        self.download_queue.job_thumbnail.connect(self.load_thumbnail)
+        self.download_queue.job_format.connect(self.show_job_format)
+        self.download_queue.job_retrying.connect(self.show_job_retrying)
+        self.download_queue.job_finished.connect(self.download_finished)
+        self.download_queue.playlist_finished.connect(self.playlist_finished)
+        self.current_job_id = None
+        self.queue_rows = {}  # Store queue row widgets by job id
+        self.finished_rows = deque()  # Job ids of the finished rows, oldest first
         self.download_timer = QTimer(self)
         self.download_timer.timeout.connect(self.update_eta)
         self.eta_remaining = 0
-        self.last_progress_time = 0
-        self.history_widgets = []  # Store history widget references
         
         # Create main widget and layout
         main_widget = QWidget()
@@ -312,7 +324,7 @@ class YouTubeDownloader(QMainWindow):
         url_layout.setContentsMargins(15, 10, 15, 10)
         
         self.url_input = QLineEdit()
-        self.url_input.setPlaceholderText("Enter YouTube video link...")
+        self.url_input.setPlaceholderText("Enter one or more YouTube video links...")
         self.url_input.setMinimumHeight(36)
         self.url_input.setFont(QFont("Segoe UI", 10))  
         self.url_input.setStyleSheet("""
@@ -456,14 +468,184 @@ class YouTubeDownloader(QMainWindow):
         quality_layout.addWidget(QLabel("Video Quality:"))
         
         self.quality_combo = QComboBox()
-        self.quality_combo.addItems(["Best Quality", "1080p", "720p", "480p", "360p", "Audio Only"])
+        self.quality_combo.addItems(list(QUALITY_MAPPING))
         self.quality_combo.setCurrentIndex(0)
         self.quality_combo.setMinimumHeight(32)
         self.quality_combo.setFont(QFont("Segoe UI", 9))  
         quality_layout.addWidget(self.quality_combo)
         
+        self.audio_format_combo = QComboBox()
+        self.audio_format_combo.addItem("Original audio", "original")
+        self.audio_format_combo.addItem("Convert to MP3", "mp3")
+        self.audio_format_combo.setMinimumHeight(32)
+        self.audio_format_combo.setFont(QFont("Segoe UI", 9))
+        self.audio_format_combo.setToolTip("Audio Only downloads keep the Opus/AAC stream as it was uploaded "
+                                           "(.opus or .m4a); converting to MP3 re-encodes it and loses quality")
+        self.audio_format_combo.currentIndexChanged.connect(
+            lambda index: setattr(self.download_manager, 'audio_format', self.audio_format_combo.itemData(index)))
+        quality_layout.addWidget(self.audio_format_combo)
+        
         options_layout.addLayout(quality_layout)
         
+        # Which of the extracted formats are preferred; applies to downloads queued afterwards
+        format_layout = QVBoxLayout()
+        format_layout.addWidget(QLabel("Format:"))
+        
+        format_hbox = QHBoxLayout()
+        self.codec_combo = QComboBox()
+        self.codec_combo.addItem("Any codec", None)
+        self.codec_combo.addItem("AV1", "av1")
+        self.codec_combo.addItem("VP9", "vp9")
+        self.codec_combo.addItem("H.264", "h264")
+        self.codec_combo.setMinimumHeight(32)
+        self.codec_combo.setFont(QFont("Segoe UI", 9))
+        self.codec_combo.setToolTip("Preferred video codec; H.264 plays on almost every device, AV1 and VP9 are smaller")
+        self.codec_combo.currentIndexChanged.connect(self.apply_format_policy)
+        format_hbox.addWidget(self.codec_combo)
+        
+        self.max_size_input = QLineEdit()
+        self.max_size_input.setPlaceholderText("Max size")
+        self.max_size_input.setMinimumHeight(32)
+        self.max_size_input.setMaximumWidth(80)
+        self.max_size_input.setFont(QFont("Segoe UI", 9))
+        self.max_size_input.setToolTip("Prefer formats whose predicted size fits, e.g. 200M")
+        self.max_size_input.editingFinished.connect(self.apply_format_policy)
+        format_hbox.addWidget(self.max_size_input)
+        
+        self.no_transcode_check = QCheckBox("No re-encoding")
+        self.no_transcode_check.setFont(QFont("Segoe UI", 9))
+        self.no_transcode_check.setToolTip("Prefer formats that need no merging, and AAC audio")
+        self.no_transcode_check.toggled.connect(self.apply_format_policy)
+        format_hbox.addWidget(self.no_transcode_check)
+        
+        format_layout.addLayout(format_hbox)
+        options_layout.addLayout(format_layout)
+        
+        # What to do with videos that were downloaded before
+        duplicates_layout = QVBoxLayout()
+        duplicates_layout.addWidget(QLabel("Already Downloaded:"))
+        
+        self.duplicates_combo = QComboBox()
+        self.duplicates_combo.addItem("Skip", "skip")
+        self.duplicates_combo.addItem("Link existing file", "link")
+        self.duplicates_combo.addItem("Download again", "download")
+        self.duplicates_combo.setMinimumHeight(32)
+        self.duplicates_combo.setFont(QFont("Segoe UI", 9))
+        self.duplicates_combo.setToolTip("Videos found in the download history or in the save folder "
+                                         "are skipped, or linked into the save folder if they are elsewhere")
+        self.duplicates_combo.currentIndexChanged.connect(
+            lambda index: setattr(self.download_manager, 'duplicate_policy', self.duplicates_combo.itemData(index)))
+        duplicates_layout.addWidget(self.duplicates_combo)
+        
+        options_layout.addLayout(duplicates_layout)
+        
+        # How the chosen formats are fetched
+        backend_layout = QVBoxLayout()
+        backend_layout.addWidget(QLabel("Downloader:"))
+        
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItem("Built-in", "yt-dlp")
+        self.backend_combo.addItem("Multi-connection", "segmented")
+        if ExternalBackend("aria2c").available:
+            self.backend_combo.addItem("aria2c", "aria2c")
+        self.backend_combo.setMinimumHeight(32)
+        self.backend_combo.setFont(QFont("Segoe UI", 9))
+        self.backend_combo.setToolTip("Multi-connection splits large files into ranges fetched over 8 connections")
+        self.backend_combo.currentIndexChanged.connect(
+            lambda index: setattr(self.download_manager, 'backend', create_backend(self.backend_combo.itemData(index))))
+        backend_layout.addWidget(self.backend_combo)
+        
+        options_layout.addLayout(backend_layout)
+        
+        # Concurrency limits
+        concurrency_layout = QVBoxLayout()
+        concurrency_layout.addWidget(QLabel("Parallel Downloads:"))
+        
+        concurrency_hbox = QHBoxLayout()
+        self.max_jobs_spin = QSpinBox()
+        self.max_jobs_spin.setRange(1, 16)
+        self.max_jobs_spin.setValue(self.download_manager.max_concurrent)
+        self.max_jobs_spin.setMinimumHeight(32)
+        self.max_jobs_spin.setFont(QFont("Segoe UI", 9))
+        self.max_jobs_spin.setToolTip("Maximum number of downloads running at once")
+        self.max_jobs_spin.valueChanged.connect(lambda value: self.download_manager.set_limits(max_concurrent=value))
+        concurrency_hbox.addWidget(self.max_jobs_spin)
+        
+        concurrency_hbox.addWidget(QLabel("Per host:"))
+        self.per_host_spin = QSpinBox()
+        self.per_host_spin.setRange(1, 16)
+        self.per_host_spin.setValue(self.download_manager.per_host_limit)
+        self.per_host_spin.setMinimumHeight(32)
+        self.per_host_spin.setFont(QFont("Segoe UI", 9))
+        self.per_host_spin.setToolTip("Maximum number of downloads from the same host")
+        self.per_host_spin.valueChanged.connect(lambda value: self.download_manager.set_limits(per_host_limit=value))
+        concurrency_hbox.addWidget(self.per_host_spin)
+        
+        concurrency_hbox.addWidget(QLabel("Fragments:"))
+        self.fragments_spin = QSpinBox()
+        self.fragments_spin.setRange(1, 16)
+        self.fragments_spin.setValue(self.download_manager.fragment_concurrency.max_workers)
+        self.fragments_spin.setMinimumHeight(32)
+        self.fragments_spin.setFont(QFont("Segoe UI", 9))
+        self.fragments_spin.setToolTip("Fragments of DASH/HLS formats fetched in parallel by each download; "
+                                       "lowered automatically while a server throttles")
+        self.fragments_spin.valueChanged.connect(lambda value: self.download_manager.set_limits(fragment_workers=value))
+        concurrency_hbox.addWidget(self.fragments_spin)
+        
+        concurrency_layout.addLayout(concurrency_hbox)
+        options_layout.addLayout(concurrency_layout)
+        
+        # Bandwidth shared by all downloads; changes apply to running downloads too
+        bandwidth_layout = QVBoxLayout()
+        bandwidth_layout.addWidget(QLabel("Bandwidth:"))
+        
+        bandwidth_hbox = QHBoxLayout()
+        self.rate_limit_input = QLineEdit()
+        self.rate_limit_input.setPlaceholderText("Unlimited")
+        self.rate_limit_input.setMinimumHeight(32)
+        self.rate_limit_input.setMaximumWidth(90)
+        self.rate_limit_input.setFont(QFont("Segoe UI", 9))
+        self.rate_limit_input.setToolTip("Total download speed shared by all downloads, e.g. 500K or 2M")
+        self.rate_limit_input.editingFinished.connect(self.apply_bandwidth_limits)
+        bandwidth_hbox.addWidget(self.rate_limit_input)
+        
+        self.bandwidth_schedule_input = QLineEdit()
+        self.bandwidth_schedule_input.setPlaceholderText("e.g. 23:00-07:00=unlimited")
+        self.bandwidth_schedule_input.setMinimumHeight(32)
+        self.bandwidth_schedule_input.setFont(QFont("Segoe UI", 9))
+        self.bandwidth_schedule_input.setToolTip("Limits for times of day, replacing the total speed limit while they "
+                                                 "apply, e.g. 23:00-07:00=unlimited, 09:00-17:00=1M")
+        self.bandwidth_schedule_input.editingFinished.connect(self.apply_bandwidth_limits)
+        bandwidth_hbox.addWidget(self.bandwidth_schedule_input)
+        
+        bandwidth_layout.addLayout(bandwidth_hbox)
+        options_layout.addLayout(bandwidth_layout)
+        
+        # Playlist / channel mode
+        playlist_layout = QVBoxLayout()
+        self.playlist_check = QCheckBox("Playlist / Channel")
+        self.playlist_check.setFont(QFont("Segoe UI", 9))
+        self.playlist_check.setToolTip("Download every video of a playlist or channel URL")
+        playlist_layout.addWidget(self.playlist_check)
+        
+        playlist_hbox = QHBoxLayout()
+        playlist_hbox.addWidget(QLabel("Items:"))
+        self.playlist_items_input = QLineEdit()
+        self.playlist_items_input.setPlaceholderText("e.g. 1-50")
+        self.playlist_items_input.setMinimumHeight(32)
+        self.playlist_items_input.setMaximumWidth(80)
+        self.playlist_items_input.setFont(QFont("Segoe UI", 9))
+        self.playlist_items_input.setToolTip("Index range of the entries to download, e.g. 1-50 or 100-")
+        playlist_hbox.addWidget(self.playlist_items_input)
+        
+        self.only_new_check = QCheckBox("Only new")
+        self.only_new_check.setFont(QFont("Segoe UI", 9))
+        self.only_new_check.setToolTip("Skip videos that are already in the download history")
+        playlist_hbox.addWidget(self.only_new_check)
+        
+        playlist_layout.addLayout(playlist_hbox)
+        options_layout.addLayout(playlist_layout)
+        
         # Save path
         path_layout = QVBoxLayout()
         path_layout.addWidget(QLabel("Save Path:"))
@@ -559,6 +741,30 @@ class YouTubeDownloader(QMainWindow):
         progress_group.setLayout(progress_layout)
         main_tab_layout.addWidget(progress_group)
         
+        # Download queue
+        queue_group = QGroupBox("Download Queue")
+        queue_group.setFont(QFont("Segoe UI", 10, QFont.Bold))
+        queue_group_layout = QVBoxLayout()
+        queue_group_layout.setContentsMargins(15, 10, 15, 10)
+        
+        queue_frame = QFrame()
+        queue_frame.setStyleSheet("background-color: #ffffff;")
+        self.queue_frame_layout = QVBoxLayout()
+        self.queue_frame_layout.setContentsMargins(0, 0, 0, 0)
+        self.queue_frame_layout.setSpacing(4)
+        self.queue_frame_layout.addStretch()
+        queue_frame.setLayout(self.queue_frame_layout)
+        
+        queue_scroll = QScrollArea()
+        queue_scroll.setWidgetResizable(True)
+        queue_scroll.setWidget(queue_frame)
+        queue_scroll.setMinimumHeight(120)
+        queue_scroll.setStyleSheet("QScrollArea { border: none; }")
+        queue_group_layout.addWidget(queue_scroll)
+        
+        queue_group.setLayout(queue_group_layout)
+        main_tab_layout.addWidget(queue_group)
+        
         # Button section
         button_layout = QHBoxLayout()
         button_layout.setContentsMargins(0, 5, 0, 5)
@@ -588,7 +794,7 @@ class YouTubeDownloader(QMainWindow):
         """)
         self.download_btn.clicked.connect(self.start_download)
         
-        self.cancel_btn = QPushButton("Cancel Download")
+        self.cancel_btn = QPushButton("Cancel All")
         self.cancel_btn.setMinimumHeight(40)
         self.cancel_btn.setFont(QFont("Segoe UI", 10))  
         self.cancel_btn.setStyleSheet("""
@@ -665,31 +871,84 @@ class YouTubeDownloader(QMainWindow):
         history_controls.addWidget(clear_btn)
         
         history_controls.addStretch()
-        history_layout.addLayout(history_controls)
-        
-        # History content
-        history_frame = QFrame()
-        history_frame.setStyleSheet("background-color: #ffffff; border: 1px solid #e9ecef; border-radius: 4px;")
-        self.history_frame_layout = QVBoxLayout()
-        self.history_frame_layout.setContentsMargins(15, 15, 15, 15)
-        
-        # Empty history message
-        self.history_empty_label = QLabel("No download history")
-        self.history_empty_label.setFont(QFont("Segoe UI", 10))
-        self.history_empty_label.setStyleSheet("color: #6c757d;")
-        self.history_empty_label.setAlignment(Qt.AlignCenter)
-        self.history_empty_label.setMinimumHeight(200)
-        
-        self.history_frame_layout.addWidget(self.history_empty_label)
         
-        history_frame.setLayout(self.history_frame_layout)
-        
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
-        scroll_area.setWidget(history_frame)
-        scroll_area.setStyleSheet("QScrollArea { border: none; }")
+        self.history_count_label = QLabel("No download history")
+        self.history_count_label.setFont(QFont("Segoe UI", 9))
+        self.history_count_label.setStyleSheet("color: #6c757d;")
+        history_controls.addWidget(self.history_count_label)
+        history_layout.addLayout(history_controls)
         
-        history_layout.addWidget(scroll_area)
+        # Search and filters
+        history_filters = QHBoxLayout()
+        
+        self.history_search_input = QLineEdit()
+        self.history_search_input.setPlaceholderText("Search title, uploader or URL")
+        self.history_search_input.setMinimumHeight(30)
+        self.history_search_input.setFont(QFont("Segoe UI", 9))
+        self.history_search_input.setClearButtonEnabled(True)
+        history_filters.addWidget(self.history_search_input, 1)
+        
+        self.history_status_combo = QComboBox()
+        self.history_status_combo.addItems(["All statuses", "completed", "failed"])
+        self.history_status_combo.setMinimumHeight(30)
+        self.history_status_combo.setFont(QFont("Segoe UI", 9))
+        history_filters.addWidget(self.history_status_combo)
+        
+        self.history_quality_combo = QComboBox()
+        self.history_quality_combo.addItem("All qualities", "")
+        for label, quality in QUALITY_MAPPING.items():
+            self.history_quality_combo.addItem(label, quality)
+        self.history_quality_combo.setMinimumHeight(30)
+        self.history_quality_combo.setFont(QFont("Segoe UI", 9))
+        history_filters.addWidget(self.history_quality_combo)
+        
+        self.history_date_combo = QComboBox()
+        for label, days in (("Any time", 0), ("Last 24 hours", 1), ("Last 7 days", 7),
+                            ("Last 30 days", 30), ("Last year", 365)):
+            self.history_date_combo.addItem(label, days)
+        self.history_date_combo.setMinimumHeight(30)
+        self.history_date_combo.setFont(QFont("Segoe UI", 9))
+        history_filters.addWidget(self.history_date_combo)
+        
+        history_layout.addLayout(history_filters)
+        
+        # Search as you type, once typing pauses briefly
+        self.history_search_timer = QTimer(self)
+        self.history_search_timer.setSingleShot(True)
+        self.history_search_timer.setInterval(150)
+        self.history_search_timer.timeout.connect(self.search_history)
+        self.history_search_input.textChanged.connect(self.history_search_timer.start)
+        self.history_status_combo.currentIndexChanged.connect(self.search_history)
+        self.history_quality_combo.currentIndexChanged.connect(self.search_history)
+        self.history_date_combo.currentIndexChanged.connect(self.search_history)
+        
+        # History content; the view only creates what is visible and the model loads pages on demand
+        self.history_view = QTableView()
+        self.history_view.setModel(self.history_model)
+        self.history_view.setFont(QFont("Segoe UI", 9))
+        self.history_view.setStyleSheet("QTableView { background-color: #ffffff; border: 1px solid #e9ecef; border-radius: 4px; }")
+        self.history_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.history_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.history_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.history_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.history_view.setShowGrid(False)
+        self.history_view.setWordWrap(False)
+        self.history_view.setAlternatingRowColors(True)
+        self.history_view.setIconSize(QSize(*HistoryModel.THUMBNAIL_SIZE))
+        self.history_view.verticalHeader().hide()
+        # Fixed row heights keep scrolling independent of the number of rows
+        self.history_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.history_view.verticalHeader().setDefaultSectionSize(HistoryModel.THUMBNAIL_SIZE[1] + 6)
+        self.history_view.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.history_view.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.history_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.history_view.customContextMenuRequested.connect(self.show_history_menu)
+        self.history_view.doubleClicked.connect(lambda index: self.reuse_url(self.history_model.row_data(index.row())[2]))
+        self.history_model.modelReset.connect(self.update_history_count)
+        self.history_model.rowsInserted.connect(self.update_history_count)
+        self.history_model.rowsRemoved.connect(self.update_history_count)
+        
+        history_layout.addWidget(self.history_view)
         history_tab.setLayout(history_layout)
         
         # Add tabs
@@ -732,6 +991,13 @@ class YouTubeDownloader(QMainWindow):
         
         # Load history on startup
         self.load_history()
+        
+        # Continue downloads that were interrupted by a crash or by closing the program
+        resumed = self.job_journal.resume()
+        if resumed:
+            self.status_label.setText(f"Resuming {resumed} interrupted download(s)")
+            self.cancel_btn.setEnabled(True)
+            self.download_timer.start(1000)
     
     def setStyle(self):
         # Set global style with increased tab width
@@ -781,197 +1047,86 @@ class YouTubeDownloader(QMainWindow):
         if path:
             self.path_display.setText(path)
 
-    def clean_youtube_url(self,url):
-        """
-        清理YouTube视频URL，只保留核心的视频标识符部分
-        
-        参数:
-        url (str): 原始的YouTube视频URL
-        
-        返回:
-        str: 清理后的基本URL，只包含视频ID部分
-        """
-        # 处理标准的watch?v=格式，及各个子域名
-        watch_pattern = r'(https?://(www|m|music)\.youtube\.com/watch\?v=[a-zA-Z0-9_-]+)'
-        match = re.match(watch_pattern, url)
-        if match:
-            return match.group(1)
-        
-        # 处理youtu.be短链接格式
-        short_pattern = r'(https?://youtu\.be/[a-zA-Z0-9_-]+)'
-        match = re.match(short_pattern, url)
-        if match:
-            return match.group(1)
-		
-        return url
-	
     def start_download(self):
         print('[DEBUG] Start download clicked')
-        url = self.url_input.text().strip()
+        urls = self.url_input.text().split()
         output_dir = self.path_display.text()
         
-        if not url:
+        if not urls:
             QMessageBox.warning(self, "Input Error", "Please enter a valid YouTube video URL")
             return
-
-        url = self.clean_youtube_url( url )
             
         if not os.path.isdir(output_dir):
             QMessageBox.warning(self, "Path Error", "The specified save path is invalid")
             return
-            
-        # Disable UI elements
-        self.url_input.setEnabled(False)
-        self.download_btn.setEnabled(False)
-        self.cancel_btn.setEnabled(True)
-        self.progress_bar.setValue(0)
-        self.percentage_label.setText("0%")
-        self.speed_label.setText("Preparing to download...")
-        self.eta_label.setText("ETA: --:--")
-        self.status_label.setText("Starting download...")
-        
-        # Reset video information
-        self.title_label.setText("")
-        self.uploader_label.setText("")
-        self.views_label.setText("")
-        self.duration_label.setText("")
-        self.description_label.setText("")
-        self.thumbnail_label.setText("Loading...")
         
         # Get quality option
-        quality_mapping = {
-            "Best Quality": "best",
-            "1080p": "1080p",
-            "720p": "720p",
-            "480p": "480p",
-            "360p": "360p",
-            "Audio Only": "audio_only"
-        }
-        quality = quality_mapping[self.quality_combo.currentText()]
-        
-        # Create and start download thread
-        self.download_thread = DownloadThread(url, output_dir, quality)
-        self.download_thread.progress_signal.connect(self.update_progress)
-        self.download_thread.finished_signal.connect(self.download_finished)
-        self.download_thread.thumbnail_signal.connect(self.load_thumbnail)
-        self.download_thread.start()
+        quality = QUALITY_MAPPING[self.quality_combo.currentText()]
         
-        # Start timer to update ETA
-        self.last_progress_time = 0
-        self.download_timer.start(1000)
-    
-    def cancel_download(self):
-        if self.download_thread and self.download_thread.isRunning():
-            self.download_thread.cancel()
-            self.status_label.setText("Canceling download...")
-    
-    def load_thumbnail(self, url):
-        """加载并显示视频缩略图"""
-        try:
-            if not url:
-                self.thumbnail_label.setText("No thumbnail URL")
+        # Queue every URL; the input stays enabled so more links can be added
+        if self.playlist_check.isChecked():
+            item_range = parse_item_range(self.playlist_items_input.text())
+            if item_range is None:
+                QMessageBox.warning(self, "Input Error", "Items must be a range like 1-50, 10- or 5")
                 return
-                
-            # 添加超时处理
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                data = response.content
-                
-                # 使用QImage加载图片数据
-                image = QImage()
-                image.loadFromData(data)
-                
-                if not image.isNull():
-                    # 转换为QPixmap并缩放
-                    pixmap = QPixmap.fromImage(image)
-                    scaled_pixmap = pixmap.scaled(
-                        self.thumbnail_label.width(),
-                        self.thumbnail_label.height(),
-                        Qt.KeepAspectRatio,
-                        Qt.SmoothTransformation
-                    )
-                    self.thumbnail_label.setPixmap(scaled_pixmap)
-                    self.thumbnail_label.setText("")
-                else:
-                    self.thumbnail_label.setText("Invalid image data")
-            else:
-                self.thumbnail_label.setText(f"HTTP error: {response.status_code}")
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f'[DEBUG] Exception in thread: {str(e)}')
-            self.thumbnail_label.setText(f"Error: {str(e)}")
-            print(f"Error loading thumbnail: {e}")
-    
-    def update_progress(self, percent, speed, title, data):
-        """Update download progress"""
-        # Update progress bar
-        self.progress_bar.setValue(int(percent))
-        self.percentage_label.setText(f"{int(percent)}%")
-        self.speed_label.setText(f"Download speed: {speed}")
-        
-        # Update video information (if not set yet)
-        if not self.title_label.text() and title:
-            self.title_label.setText(title)
+            skip_ids = self.db_manager.get_downloaded_video_ids() if self.only_new_check.isChecked() else None
+            for url in urls:
+                self.download_manager.submit_playlist(url, output_dir, quality, item_range[0], item_range[1], skip_ids)
+        else:
+            for url in urls:
+                self.download_manager.submit(clean_youtube_url(url), output_dir, quality)
         
-        # Calculate estimated time remaining
-        if percent > 0 and percent < 100:
-            current_time = data.get('elapsed', 0)
-            if current_time > self.last_progress_time and current_time > 0:
-                # Calculate average speed and estimated remaining time
-                downloaded_bytes = data.get('downloaded_bytes', 0)
-                total_bytes = data.get('total_bytes') or data.get('total_bytes_estimate', 0)
-                
-                if total_bytes > 0:
-                    avg_speed = downloaded_bytes / current_time if current_time > 0 else 0
-                    remaining_bytes = total_bytes - downloaded_bytes
-                    
-                    if avg_speed > 0:
-                        remaining_seconds = remaining_bytes / avg_speed
-                        self.eta_remaining = remaining_seconds
+        self.url_input.clear()
+        self.cancel_btn.setEnabled(True)
+        self.status_label.setText(f"Added {len(urls)} download(s) to the queue")
         
-        # Update status
-        #self.status_label.setText(f" {int(percent)}% complete")
+        # Start timer to update ETA
+        if not self.download_timer.isActive():
+            self.download_timer.start(1000)
     
-    def update_eta(self):
-        """Update estimated time remaining display"""
-        if self.eta_remaining > 0:
-            mins = int(self.eta_remaining / 60)
-            secs = int(self.eta_remaining % 60)
-            self.eta_label.setText(f"ETA: {mins:02d}:{secs:02d}")
-            self.eta_remaining -= 1
+    def playlist_finished(self, url, success, message, count):
+        """Handle the end of a playlist expansion"""
+        self.status_label.setText(message)
+        if not self.download_manager.is_busy():
+            self.download_timer.stop()
+            self.cancel_btn.setEnabled(False)
+        if not success and "cancelled" not in message:
+            QMessageBox.warning(self, "Playlist Error", f"Failed to expand {url}\n{message}")
+    
+    def cancel_download(self):
+        if self.download_manager.is_busy():
+            self.download_manager.cancel_all()
+            self.status_label.setText("Downloads cancelled")
     
-    def create_history_item(self, download_data):
-        """Create a history item widget"""
+    def add_queue_item(self, job_id, url):
+        """Create a progress row for a queued job"""
         item_frame = QFrame()
         item_frame.setStyleSheet("""
             QFrame {
                 background-color: #f8f9fa;
                 border: 1px solid #e9ecef;
                 border-radius: 4px;
-                margin: 2px 0px;
-            }
-            QFrame:hover {
-                background-color: #e9ecef;
             }
         """)
-        
         layout = QVBoxLayout()
-        layout.setContentsMargins(10, 8, 10, 8)
+        layout.setContentsMargins(10, 6, 10, 6)
+        layout.setSpacing(4)
         
-        # Title and delete button row
-        title_row = QHBoxLayout()
+        top_row = QHBoxLayout()
+        title_label = QLabel(url)
+        title_label.setFont(QFont("Segoe UI", 9, QFont.Bold))
+        title_label.setStyleSheet("color: #212529; border: none;")
+        top_row.addWidget(title_label, 1)
         
-        title_label = QLabel(download_data[1])  # title
-        title_label.setFont(QFont("Segoe UI", 10, QFont.Bold))
-        title_label.setStyleSheet("color: #212529;")
-        title_label.setWordWrap(True)
-        title_row.addWidget(title_label, 1)
+        status_label = QLabel("Queued")
+        status_label.setFont(QFont("Segoe UI", 8))
+        status_label.setStyleSheet("color: #6c757d; border: none;")
+        top_row.addWidget(status_label)
         
-        delete_btn = QPushButton("×")
-        delete_btn.setFixedSize(20, 20)
-        delete_btn.setFont(QFont("Segoe UI", 12, QFont.Bold))
-        delete_btn.setStyleSheet("""
+        cancel_btn = QPushButton("×")
+        cancel_btn.setFixedSize(20, 20)
+        cancel_btn.setFont(QFont("Segoe UI", 12, QFont.Bold))
+        cancel_btn.setStyleSheet("""
             QPushButton {
                 background-color: #e74c3c;
                 color: white;
@@ -982,109 +1137,220 @@ class YouTubeDownloader(QMainWindow):
                 background-color: #c0392b;
             }
         """)
-        delete_btn.clicked.connect(lambda: self.delete_history_item(download_data[0], item_frame))
-        title_row.addWidget(delete_btn)
-        
-        layout.addLayout(title_row)
-        
-        # URL row with copy and reuse buttons
-        url_row = QHBoxLayout()
-        
-        url_label = QLabel(download_data[2])  # url
-        url_label.setFont(QFont("Segoe UI", 8))
-        url_label.setStyleSheet("color: #007bff; text-decoration: underline;")
-        url_label.setWordWrap(True)
-        url_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
-        url_row.addWidget(url_label, 1)
-        
-        # Copy URL button
-        copy_btn = QPushButton("Copy URL")
-        copy_btn.setFixedSize(70, 24)
-        copy_btn.setFont(QFont("Segoe UI", 7))
-        copy_btn.setStyleSheet("""
-            QPushButton {
-                background-color: #6c757d;
-                color: white;
+        cancel_btn.clicked.connect(lambda: self.download_manager.cancel(job_id))
+        top_row.addWidget(cancel_btn)
+        layout.addLayout(top_row)
+        
+        progress_bar = QProgressBar()
+        progress_bar.setRange(0, 100)
+        progress_bar.setValue(0)
+        progress_bar.setMaximumHeight(8)
+        progress_bar.setTextVisible(False)
+        progress_bar.setStyleSheet("""
+            QProgressBar {
                 border: none;
                 border-radius: 3px;
+                background-color: #e9ecef;
             }
-            QPushButton:hover {
-                background-color: #5a6268;
-            }
-        """)
-        copy_btn.clicked.connect(lambda: self.copy_url_to_clipboard(download_data[2]))
-        url_row.addWidget(copy_btn)
-        
-        # Reuse URL button
-        reuse_btn = QPushButton("Reuse")
-        reuse_btn.setFixedSize(50, 24)
-        reuse_btn.setFont(QFont("Segoe UI", 7))
-        reuse_btn.setStyleSheet("""
-            QPushButton {
-                background-color: #28a745;
-                color: white;
-                border: none;
+            QProgressBar::chunk {
+                background-color: #3498db;
                 border-radius: 3px;
             }
-            QPushButton:hover {
-                background-color: #218838;
-            }
         """)
-        reuse_btn.clicked.connect(lambda: self.reuse_url(download_data[2]))
-        url_row.addWidget(reuse_btn)
-        
-        layout.addLayout(url_row)
-        
-        # Details row
-        details_layout = QHBoxLayout()
-        
-        # Left column
-        left_details = QVBoxLayout()
-        left_details.setSpacing(2)
-        
-        uploader_label = QLabel(f"Uploader: {download_data[3] or 'Unknown'}")
-        uploader_label.setFont(QFont("Segoe UI", 8))
-        uploader_label.setStyleSheet("color: #6c757d;")
-        left_details.addWidget(uploader_label)
-        
-        duration_label = QLabel(f"Duration: {download_data[4] or 'Unknown'}")
-        duration_label.setFont(QFont("Segoe UI", 8))
-        duration_label.setStyleSheet("color: #6c757d;")
-        left_details.addWidget(duration_label)
-        
-        views_label = QLabel(f"Views: {download_data[5] or 'Unknown'}")
-        views_label.setFont(QFont("Segoe UI", 8))
-        views_label.setStyleSheet("color: #6c757d;")
-        left_details.addWidget(views_label)
+        layout.addWidget(progress_bar)
         
-        details_layout.addLayout(left_details)
+        item_frame.setLayout(layout)
+        item_frame.setContextMenuPolicy(Qt.CustomContextMenu)
+        item_frame.customContextMenuRequested.connect(
+            lambda pos: self.show_queue_menu(job_id, item_frame.mapToGlobal(pos)))
+        # Keep the trailing stretch as the last item of the layout
+        self.queue_frame_layout.insertWidget(self.queue_frame_layout.count() - 1, item_frame)
+        self.queue_rows[job_id] = {
+            'frame': item_frame,
+            'title': title_label,
+            'status': status_label,
+            'progress': progress_bar,
+            'cancel': cancel_btn
+        }
+    
+    def remove_queue_item(self, job_id):
+        """Remove a finished job's row from the queue"""
+        row = self.queue_rows.pop(job_id, None)
+        if row:
+            self.queue_frame_layout.removeWidget(row['frame'])
+            row['frame'].deleteLater()
+    
+    def show_queue_menu(self, job_id, pos):
+        """Show the bandwidth settings of a queued or running download"""
+        job = self.download_manager.jobs.get(job_id)
+        if job is None or job.status not in ('queued', 'downloading'):
+            return
+        menu = QMenu(self)
+        priority_menu = menu.addMenu("Priority")
+        for name in PRIORITIES:
+            action = priority_menu.addAction(
+                name.capitalize(), lambda name=name: self.download_manager.set_job_bandwidth(job_id, priority=name))
+            action.setCheckable(True)
+            action.setChecked(job.priority == name)
+        menu.addAction(f"Speed Limit ({format_rate(job.rate_limit)})...", lambda: self.set_job_rate_limit(job_id))
+        menu.exec_(pos)
+    
+    def set_job_rate_limit(self, job_id):
+        job = self.download_manager.jobs[job_id]
+        text, ok = QInputDialog.getText(self, "Speed Limit", "Maximum speed of this download, e.g. 500K or 2M "
+                                        "(empty for unlimited):", text=format_rate(job.rate_limit) if job.rate_limit else "")
+        if not ok:
+            return
+        try:
+            self.download_manager.set_job_bandwidth(job_id, rate_limit=parse_rate(text))
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Speed Limit", str(e))
+    
+    def apply_bandwidth_limits(self):
+        """Pass the bandwidth inputs on to the scheduler"""
+        try:
+            limit = parse_rate(self.rate_limit_input.text())
+            profiles = parse_bandwidth_profiles(self.bandwidth_schedule_input.text())
+        except ValueError as e:
+            self.status_label.setText(f"Bandwidth not changed: {e}")
+            return
+        self.download_manager.bandwidth.set_limit(limit)
+        self.download_manager.bandwidth.set_profiles(profiles)
+        self.status_label.setText(f"Bandwidth limit: {format_rate(self.download_manager.bandwidth.effective_limit())}")
+    
+    def apply_format_policy(self):
+        """Build the format policy used by the downloads queued from now on"""
+        try:
+            max_size = parse_rate(self.max_size_input.text())
+        except ValueError as e:
+            self.status_label.setText(f"Format preferences not changed: {e}")
+            return
+        codec = self.codec_combo.currentData()
+        self.download_manager.format_policy = FormatPolicy(
+            max_size=max_size,
+            # Other codecs are still used when a video isn't available in the chosen one
+            video_codecs=[codec] if codec else None,
+            avoid_transcode=self.no_transcode_check.isChecked())
+    
+    def show_job_format(self, job_id, description, size):
+        """Show the chosen formats and the predicted size of a queued download before it transfers"""
+        row = self.queue_rows.get(job_id)
+        if not row:
+            return
+        text = f"{description} · ~{size / (1024 * 1024):.0f} MB" if size else description
+        row['status'].setText(text)
+        row['title'].setToolTip(text)
+    
+    def show_job_retrying(self, job_id, attempt, retries, delay, error):
+        """A failed download waits for its retry; its partial files are kept and continued"""
+        row = self.queue_rows.get(job_id)
+        if row:
+            if row.get('postprocessing'):
+                row['postprocessing'] = False
+                row['progress'].setStyleSheet(row['progress'].styleSheet().replace('#8e44ad', '#3498db'))
+            row['status'].setText(f"Retry {attempt}/{retries} in {delay:.0f}s ({error} error)")
+        if job_id == self.current_job_id:
+            self.speed_label.setText("Waiting to retry...")
+            self.status_label.setText(f"Download failed ({error} error), retrying in {delay:.0f} seconds")
+    
+    def job_started(self, job_id):
+        """Show the most recently started job in the progress and information panels"""
+        row = self.queue_rows.get(job_id)
+        if row:
+            row['status'].setText("Starting...")
         
-        # Right column
-        right_details = QVBoxLayout()
-        right_details.setSpacing(2)
+        self.current_job_id = job_id
+        self.eta_remaining = 0
+        self.progress_bar.setValue(0)
+        self.percentage_label.setText("0%")
+        self.speed_label.setText("Preparing to download...")
+        self.eta_label.setText("ETA: --:--")
+        self.status_label.setText("Starting download...")
         
-        quality_label = QLabel(f"Quality: {download_data[6] or 'Unknown'}")
-        quality_label.setFont(QFont("Segoe UI", 8))
-        quality_label.setStyleSheet("color: #6c757d;")
-        right_details.addWidget(quality_label)
+        # Reset video information
+        self.title_label.setText("")
+        self.uploader_label.setText("")
+        self.views_label.setText("")
+        self.duration_label.setText("")
+        self.description_label.setText("")
+        self.thumbnail_label.setText("Loading...")
+    
+    def load_thumbnail(self, job_id, url):
+        """加载并显示视频缩略图"""
+        if job_id != self.current_job_id:
+            return
+        if not url:
+            self.thumbnail_label.setText("No thumbnail URL")
+            return
+        # 在后台线程下载、解码并缩放，避免界面卡顿
+        video_id = get_video_id(self.download_manager.jobs[job_id].url)
+        self.thumbnail_loader.load(('job', job_id), url, video_id,
+                                   self.thumbnail_label.width(), self.thumbnail_label.height())
+    
+    def thumbnail_loaded(self, key, image, error):
+        """Show a thumbnail decoded by the ThumbnailLoader"""
+        kind, item_id = key
+        if kind == 'job':
+            if item_id != self.current_job_id:
+                return
+            if image.isNull():
+                self.thumbnail_label.setText(error or "Invalid image data")
+            else:
+                self.thumbnail_label.setPixmap(QPixmap.fromImage(image))
+                self.thumbnail_label.setText("")
+        elif kind == 'history':
+            self.history_model.set_thumbnail(item_id, image)
+    
+    def update_progress(self, job_id, percent, speed, title, data):
+        """Update download progress"""
+        row = self.queue_rows.get(job_id)
+        if row:
+            row['progress'].setValue(int(percent))
+            if data.get('phase') == 'postprocessing':
+                # The download slot is free again; the bar restarts in another colour for ffmpeg's work
+                if not row.get('postprocessing'):
+                    row['postprocessing'] = True
+                    row['progress'].setStyleSheet(row['progress'].styleSheet().replace('#3498db', '#8e44ad'))
+                row['status'].setText(f"Post-processing {int(percent)}%")
+            else:
+                row['status'].setText(f"{int(percent)}% - {speed}")
+            if title:
+                row['title'].setText(title)
         
-        date_label = QLabel(f"Date: {download_data[8]}")
-        date_label.setFont(QFont("Segoe UI", 8))
-        date_label.setStyleSheet("color: #6c757d;")
-        right_details.addWidget(date_label)
+        # The main progress panel follows the current job only
+        if job_id != self.current_job_id:
+            return
         
-        status_label = QLabel(f"Status: {download_data[9]}")
-        status_label.setFont(QFont("Segoe UI", 8))
-        status_label.setStyleSheet("color: #28a745;" if download_data[9] == "completed" else "color: #dc3545;")
-        right_details.addWidget(status_label)
+        # Update progress bar
+        self.progress_bar.setValue(int(percent))
+        self.percentage_label.setText(f"{int(percent)}%")
+        if data.get('phase') == 'postprocessing':
+            postprocessor = data.get('postprocessor')
+            self.speed_label.setText(f"Post-processing ({postprocessor})..." if postprocessor else "Post-processing...")
+        else:
+            self.speed_label.setText(f"Download speed: {speed}")
         
-        details_layout.addLayout(right_details)
-        details_layout.addStretch()
+        # Update video information (if not set yet)
+        if not self.title_label.text() and title:
+            self.title_label.setText(title)
         
-        layout.addLayout(details_layout)
+        # The job reports a smoothed ETA covering all streams and post-processing;
+        # update_eta counts it down between progress updates
+        eta = data.get('eta')
+        if eta is not None:
+            self.eta_remaining = eta
+            self.eta_label.setText(f"ETA: {int(eta / 60):02d}:{int(eta % 60):02d}")
         
-        item_frame.setLayout(layout)
-        return item_frame
+        # Update status
+        #self.status_label.setText(f" {int(percent)}% complete")
+    
+    def update_eta(self):
+        """Update estimated time remaining display"""
+        if self.eta_remaining > 0:
+            mins = int(self.eta_remaining / 60)
+            secs = int(self.eta_remaining % 60)
+            self.eta_label.setText(f"ETA: {mins:02d}:{secs:02d}")
+            self.eta_remaining -= 1
     
     def copy_url_to_clipboard(self, url):
         """Copy URL to clipboard"""
@@ -1096,31 +1362,53 @@ class YouTubeDownloader(QMainWindow):
         """Reuse URL in the download input field"""
         self.url_input.setText(url)
         # Switch to download tab
-        self.parent().findChild(QTabWidget).setCurrentIndex(0)
+        self.findChild(QTabWidget).setCurrentIndex(0)
         QMessageBox.information(self, "URL Reused", "URL has been added to the download field!")
     
     def load_history(self):
         """Load and display download history"""
-        # Clear existing history widgets
-        for widget in self.history_widgets:
-            widget.setParent(None)
-        self.history_widgets.clear()
-        
-        # Get history from database
-        history_data = self.db_manager.get_download_history()
-        
-        if not history_data:
-            self.history_empty_label.show()
+        self.history_model.filters = self.history_filters()
+        self.history_model.reload()
+    
+    def history_filters(self):
+        """Collect the search text and filters of the History tab"""
+        status = self.history_status_combo.currentIndex()
+        days = self.history_date_combo.currentData()
+        return {
+            'search': self.history_search_input.text().strip(),
+            'status': self.history_status_combo.currentText() if status else '',
+            'quality': self.history_quality_combo.currentData(),
+            # Download dates are stored in UTC by SQLite
+            'date_from': (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+                         if days else ''
+        }
+    
+    def search_history(self):
+        """Run the History tab search in the background"""
+        self.history_search_timer.stop()
+        self.history_model.apply_filters(self.history_filters())
+    
+    def update_history_count(self):
+        """Show the number of history records"""
+        total = self.history_model.total
+        if any(self.history_model.filters.values()):
+            self.history_count_label.setText(f"{total:,} match(es)")
+        else:
+            self.history_count_label.setText(f"{total:,} download(s)" if total else "No download history")
+    
+    def show_history_menu(self, pos):
+        """Show the actions for the history row under the cursor"""
+        index = self.history_view.indexAt(pos)
+        if not index.isValid():
             return
-        
-        # Hide empty label
-        self.history_empty_label.hide()
-        
-        # Create history items
-        for download_data in history_data:
-            history_item = self.create_history_item(download_data)
-            self.history_frame_layout.addWidget(history_item)
-            self.history_widgets.append(history_item)
+        row = index.row()
+        url = self.history_model.row_data(row)[2]
+        menu = QMenu(self)
+        menu.addAction("Copy URL", lambda: self.copy_url_to_clipboard(url))
+        menu.addAction("Reuse", lambda: self.reuse_url(url))
+        menu.addSeparator()
+        menu.addAction("Delete", lambda: self.delete_history_item(QPersistentModelIndex(index)))
+        menu.exec_(self.history_view.viewport().mapToGlobal(pos))
     
     def clear_history(self):
         """Clear all download history"""
@@ -1139,7 +1427,7 @@ class YouTubeDownloader(QMainWindow):
             else:
                 QMessageBox.critical(self, "Error", "Failed to clear download history!")
     
-    def delete_history_item(self, download_id, item_widget):
+    def delete_history_item(self, index):
         """Delete a specific history item"""
         reply = QMessageBox.question(
             self,
@@ -1149,105 +1437,88 @@ class YouTubeDownloader(QMainWindow):
             QMessageBox.No
         )
         
-        if reply == QMessageBox.Yes:
+        if reply == QMessageBox.Yes and index.isValid():
+            download_id = self.history_model.row_data(index.row())[0]
             if self.db_manager.delete_download(download_id):
-                item_widget.setParent(None)
-                self.history_widgets.remove(item_widget)
-                # Reload history if no items left
-                if not self.history_widgets:
-                    self.load_history()
+                self.history_model.remove_row(index.row())
             else:
                 QMessageBox.critical(self, "Error", "Failed to delete download record!")
     
-    def download_finished(self, success, message, title, video_info):
+    def download_finished(self, job_id, success, message, title, video_info, job):
         """Handle download completion"""
-        # Stop timer
-        self.download_timer.stop()
         
-        # Enable UI elements
-        self.url_input.setEnabled(True)
-        self.download_btn.setEnabled(True)
-        self.cancel_btn.setEnabled(False)
-        
-        # Update video information (if available)
-        if video_info:
-            self.title_label.setText(video_info.get('title', 'Unknown Video'))
-            self.uploader_label.setText(f"Uploader: {video_info.get('uploader', 'Unknown Uploader')}")
-            self.views_label.setText(f"Views: {video_info.get('view_count', '0')}")
-            self.duration_label.setText(f"Duration: {video_info.get('duration', '0:00')}")
-            self.description_label.setText(video_info.get('description', 'No description'))
+        # Update the queue row
+        row = self.queue_rows.get(job_id)
+        if row:
+            if title:
+                row['title'].setText(title)
+            row['cancel'].setEnabled(False)
+            if success:
+                row['progress'].setValue(100)
+                row['status'].setText("Already downloaded" if job.status == 'skipped' else "Completed")
+                row['status'].setToolTip(job.output_path)
+                row['status'].setStyleSheet("color: #28a745; border: none;")
+            else:
+                row['status'].setText("Cancelled" if "Download cancelled" in message else "Failed")
+                row['status'].setToolTip(message)
+                row['status'].setStyleSheet("color: #dc3545; border: none;")
+            # A long playlist would otherwise leave thousands of rows behind
+            self.finished_rows.append(job_id)
+            while len(self.finished_rows) > self.FINISHED_QUEUE_ROWS:
+                self.remove_queue_item(self.finished_rows.popleft())
+        
+        if not self.download_manager.is_busy():
+            # Stop timer
+            self.download_timer.stop()
+            self.cancel_btn.setEnabled(False)
+        
+        if job_id == self.current_job_id:
+            # Update video information (if available)
+            if video_info:
+                self.title_label.setText(video_info.get('title', 'Unknown Video'))
+                self.uploader_label.setText(f"Uploader: {video_info.get('uploader', 'Unknown Uploader')}")
+                self.views_label.setText(f"Views: {video_info.get('view_count', '0')}")
+                self.duration_label.setText(f"Duration: {video_info.get('duration', '0:00')}")
+                self.description_label.setText(video_info.get('description', 'No description'))
+            
+            self.eta_remaining = 0
+            self.eta_label.setText("")
+            if success:
+                self.speed_label.setText("Download completed")
+                self.progress_bar.setValue(100)
+                self.percentage_label.setText("100%")
+            else:
+                self.speed_label.setText("Download failed")
         
         # Display result message
         if success:
-            self.status_label.setText(f"Download completed: {title}")
-            self.speed_label.setText("Download completed")
-            self.eta_label.setText("")
-            self.progress_bar.setValue(100)
-            self.percentage_label.setText("100%")
-            
-            # Show success message
-            QMessageBox.information(self, "Download Complete", f"Video '{title}' downloaded successfully!")
-            
-            # Save to database
-            quality_mapping = {
-                "Best Quality": "best",
-                "1080p": "1080p", 
-                "720p": "720p",
-                "480p": "480p",
-                "360p": "360p",
-                "Audio Only": "audio_only"
-            }
-            quality = quality_mapping[self.quality_combo.currentText()]
-            
-            self.db_manager.save_download(
-                title=title,
-                url=self.download_thread.url,
-                uploader=video_info.get('uploader', 'Unknown Uploader'),
-                duration=video_info.get('duration', '0:00'),
-                view_count=video_info.get('view_count', '0'),
-                quality=quality,
-                output_path=self.download_thread.output_path,
-                status="completed"
-            )
-            
-            # Refresh history tab
-            self.load_history()
+            if job.status == 'skipped':
+                self.status_label.setText(message)
+            else:
+                self.status_label.setText(f"Download completed: {title}")
         else:
             self.status_label.setText(f"Download failed: {message}")
-            self.speed_label.setText("Download failed")
-            self.eta_label.setText("")
-            
-            # Save failed download to database
-            if video_info:
-                quality_mapping = {
-                    "Best Quality": "best",
-                    "1080p": "1080p",
-                    "720p": "720p", 
-                    "480p": "480p",
-                    "360p": "360p",
-                    "Audio Only": "audio_only"
-                }
-                quality = quality_mapping[self.quality_combo.currentText()]
-                
-                self.db_manager.save_download(
-                    title=title,
-                    url=self.download_thread.url,
-                    uploader=video_info.get('uploader', 'Unknown Uploader'),
-                    duration=video_info.get('duration', '0:00'),
-                    view_count=video_info.get('view_count', '0'),
-                    quality=quality,
-                    output_path="",
-                    status="failed"
-                )
-            
-            # Show error message
-            if "Download cancelled" not in message:
-                QMessageBox.critical(self, "Download Failed", message)
         
-        self.download_thread = None
+        # Save to database on the writer thread; the record is added to the history tab once it's committed
+        future = self.db_manager.save_job(job, success, wait=False)
+        if future is not None:
+            future.add_done_callback(self.download_saved)
+    
+    def download_saved(self, future):
+        """Called on the database writer thread when a finished download has been saved"""
+        try:
+            download_id = future.result()
+        except Exception as e:
+            print(f"Error saving download: {e}")
+            return
+        if download_id:
+            self.history_model.download_saved.emit(download_id)
 
 
 if __name__ == "__main__":
+    # Post-processing workers are spawned processes; needed when the program is frozen into an executable
+    multiprocessing.freeze_support()
+    
     # Create application
     app = QApplication(sys.argv)
     
@@ -1262,9 +1533,28 @@ if __name__ == "__main__":
         QMessageBox.critical(None, "Dependency Error", "Please install yt-dlp first: pip install yt-dlp")
         sys.exit(1)
     
+    # Optional local job API, e.g. python youtube-downloader.py --api-port 8765, and metrics
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--api-port', type=int)
+    parser.add_argument('--api-token', default=os.environ.get('DOWNLOADER_API_TOKEN'))
+    parser.add_argument('--metrics-port', type=int)
+    parser.add_argument('--log-json')
+    args, _ = parser.parse_known_args()
+    # Before the window resumes interrupted downloads, so their phases are logged too
+    if args.log_json:
+        REGISTRY.log.open(args.log_json)
+    
     # Create window
     window = YouTubeDownloader()
     window.show()
     
+    if args.metrics_port:
+        MetricsServer(port=args.metrics_port).start()
+    if args.api_port:
+        from downloader_api import JobApiServer
+        api_server = JobApiServer(window.download_manager, window.db_manager,
+                                  window.path_display.text(), port=args.api_port, token=args.api_token)
+        api_server.start()
+    
     # Execute application
     sys.exit(app.exec_())